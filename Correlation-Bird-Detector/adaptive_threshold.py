@@ -0,0 +1,175 @@
+from collections import deque
+
+import numpy as np
+
+from peak_sweep import PeakSweep
+
+# "global" measures thresholds in standard deviations of the whole envelope, as PeakSweep always has. "rolling" and
+# "robust" measure them against the noise floor of the last noise_seconds, from its mean and standard deviation or
+# from its median and median absolute deviation
+THRESHOLD_MODES = ["global", "rolling", "robust"]
+DEFAULT_NOISE_SECONDS = 60.0
+DEFAULT_HOP_SECONDS = 1.0
+# Thresholds in local standard deviations to sweep in the adaptive modes
+ADAPTIVE_THRESHOLDS = np.arange(0, 20, 0.25)
+
+# The robust statistics come from a histogram with BINS_PER_OCTAVE bins per doubling of the envelope, which puts the
+# median and MAD within a few percent of their exact values
+BINS_PER_OCTAVE = 16
+LOWEST_OCTAVE = -64
+HIGHEST_OCTAVE = 128
+N_BINS = (HIGHEST_OCTAVE - LOWEST_OCTAVE) * BINS_PER_OCTAVE
+# The centre of every bin
+BIN_VALUES = 2.0 ** (LOWEST_OCTAVE + (np.arange(N_BINS) + 0.5) / BINS_PER_OCTAVE)
+# The standard deviation of normal noise is 1.4826 times its median absolute deviation
+MAD_TO_STD = 1.4826
+
+
+def _weighted_median(values, weights):
+    order = np.argsort(values, kind="stable")
+    cumulative = np.cumsum(weights[order])
+    return values[order][np.searchsorted(cumulative, cumulative[-1] / 2.0)]
+
+
+class NoiseFloor:
+    """
+    Turns an envelope into scores: how many local standard deviations each sample is above the noise floor of the
+    last window samples. The envelope is split into blocks of hop samples and only a summary of each block is kept,
+    so the state is bounded by the number of blocks in the window and every sample is only looked at once.
+
+    Each block is scored against the window that ends with it, so scores come out one block behind the envelope.
+    The blocks are counted from the start of the stream, so pushing the envelope in chunks of any size gives the same
+    scores as pushing it all at once.
+    """
+
+    def __init__(self, window, hop, method="rolling", min_height=None):
+        """
+        @param window: The number of envelope samples the noise floor is measured over
+        @param hop: The number of samples in each block
+        @param method: "rolling" for the mean and standard deviation, "robust" for the median and MAD
+        @param min_height: An envelope height below which a sample can never be detected, such as MIN_THRESHOLD
+        """
+        if method not in THRESHOLD_MODES[1:]:
+            raise ValueError("Unknown threshold mode " + str(method) + ". Use one of " + ", ".join(THRESHOLD_MODES[1:]))
+        self.hop = max(1, int(hop))
+        self.n_blocks = max(1, int(round(window / float(self.hop))))
+        self.method = method
+        self.min_height = min_height
+
+        self._pending = []
+        self._pending_length = 0
+        self._blocks = deque()
+        # The robust window keeps the sum of the histograms of its blocks
+        self._histogram = np.zeros(N_BINS, dtype=np.int64)
+
+    def update(self, envelope):
+        """
+        @param envelope: The next chunk of the envelope
+        @return: The scores of every block completed by this chunk
+        """
+        envelope = np.asarray(envelope, dtype=np.float64)
+        self._pending.append(envelope)
+        self._pending_length += len(envelope)
+        if self._pending_length < self.hop:
+            return np.zeros(0, dtype=np.float64)
+
+        samples = np.concatenate(self._pending)
+        n_blocks = len(samples) // self.hop
+        scores = [self._score_block(samples[b * self.hop:(b + 1) * self.hop]) for b in range(n_blocks)]
+
+        remainder = samples[n_blocks * self.hop:]
+        self._pending = [remainder]
+        self._pending_length = len(remainder)
+        return np.concatenate(scores)
+
+    def flush(self):
+        """
+        @return: The scores of the last, partial block
+        """
+        samples = np.concatenate(self._pending) if self._pending else np.zeros(0, dtype=np.float64)
+        self._pending = []
+        self._pending_length = 0
+        if len(samples) == 0:
+            return samples
+        return self._score_block(samples)
+
+    def _score_block(self, block):
+        self._add_block(block)
+        centre, scale = self.statistics()
+        if scale > 0:
+            scores = (block - centre) / scale
+        else:
+            # A flat window has no noise to measure against
+            scores = np.zeros(len(block), dtype=np.float64)
+        if self.min_height is not None:
+            scores[block < self.min_height] = -np.inf
+        return scores
+
+    def _add_block(self, block):
+        if self.method == "robust":
+            bins = np.floor((np.log2(np.maximum(block, BIN_VALUES[0])) - LOWEST_OCTAVE) * BINS_PER_OCTAVE)
+            summary = np.bincount(np.clip(bins, 0, N_BINS - 1).astype(np.int64), minlength=N_BINS)
+            self._histogram += summary
+        else:
+            summary = (len(block), block.mean(), ((block - block.mean()) ** 2).sum())
+        self._blocks.append(summary)
+
+        if len(self._blocks) > self.n_blocks:
+            oldest = self._blocks.popleft()
+            if self.method == "robust":
+                self._histogram -= oldest
+
+    def statistics(self):
+        """
+        @return: The centre and scale of the noise floor over the current window
+        """
+        if not self._blocks:
+            return float("nan"), float("nan")
+
+        if self.method == "robust":
+            occupied = np.flatnonzero(self._histogram)
+            values = BIN_VALUES[occupied]
+            counts = self._histogram[occupied]
+            median = _weighted_median(values, counts)
+            return median, MAD_TO_STD * _weighted_median(np.abs(values - median), counts)
+
+        # The blocks are merged with Chan's formula, which stays accurate for envelopes around 1e16
+        counts = np.array([block[0] for block in self._blocks], dtype=np.float64)
+        means = np.array([block[1] for block in self._blocks])
+        m2 = np.array([block[2] for block in self._blocks])
+        mean = (counts * means).sum() / counts.sum()
+        variance = (m2 + counts * (means - mean) ** 2).sum() / counts.sum()
+        return mean, np.sqrt(variance)
+
+
+def local_scores(envelope, rate, method="rolling", noise_seconds=DEFAULT_NOISE_SECONDS,
+                 hop_seconds=DEFAULT_HOP_SECONDS, min_height=None):
+    """
+    @param envelope: The envelope of the correlation
+    @param rate: The sampling rate of the envelope
+    @param method: "rolling" or "robust"
+    @param noise_seconds: How long the noise floor is measured over
+    @param hop_seconds: How often the noise floor is updated
+    @param min_height: An envelope height below which a sample can never be detected, such as MIN_THRESHOLD
+    @return: The score of every sample of the envelope in local standard deviations above the noise floor
+    """
+    noise_floor = NoiseFloor(noise_seconds * rate, hop_seconds * rate, method, min_height)
+    return np.concatenate((noise_floor.update(envelope), noise_floor.flush()))
+
+
+def make_sweep(envelope, distance, rate, threshold_mode="global", noise_seconds=DEFAULT_NOISE_SECONDS,
+               min_height=None):
+    """
+    @param envelope: The envelope of the correlation
+    @param distance: The minimum number of samples between two detections
+    @param rate: The sampling rate of the envelope
+    @param threshold_mode: One of THRESHOLD_MODES
+    @param noise_seconds: How long the noise floor of the adaptive modes is measured over
+    @param min_height: An envelope height the adaptive modes never detect below. The global mode applies it in
+    PeakSweep.sweep() instead
+    @return: The PeakSweep of the envelope, in standard deviations of the whole envelope or of its noise floor
+    """
+    if threshold_mode == "global":
+        return PeakSweep.from_envelope(envelope, distance=distance)
+    scores = local_scores(envelope, rate, threshold_mode, noise_seconds, min_height=min_height)
+    return PeakSweep.from_scores(scores, distance=distance)
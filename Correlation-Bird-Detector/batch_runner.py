@@ -0,0 +1,225 @@
+#!/usr/bin/python
+
+import argparse
+import datetime
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from glob import glob
+
+import numpy as np
+from scipy.io import wavfile
+
+from adaptive_threshold import ADAPTIVE_THRESHOLDS, DEFAULT_NOISE_SECONDS, THRESHOLD_MODES, make_sweep
+from envelope import DEFAULT_WINDOW_SECONDS, compute_envelope
+from peak_io import DetectionWriter, export_csv
+from template_bank import PRECISIONS, TemplateBank
+
+DEFAULT_THRESHOLDS = np.arange(0, 0.005, 0.0001)
+DEFAULT_START = datetime.datetime(year=2000, month=1, day=1)
+
+# Every worker process keeps its own template bank and memory maps of the inputs it has seen
+_template_bank = None
+_inputs = {}
+
+
+def _init_worker(call_filenames, precision="float64"):
+    global _template_bank
+    _template_bank = TemplateBank(call_filenames, precision=precision)
+    _inputs.clear()
+
+
+def load_input(filename):
+    """
+    The wav file is memory mapped rather than read, so every worker shares the operating system's single cached copy
+    of it instead of holding its own.
+
+    @param filename: The path of the input signal
+    @return: The sampling rate and the samples of the input signal
+    """
+    if filename not in _inputs:
+        _inputs[filename] = wavfile.read(filename, mmap=True)
+    return _inputs[filename]
+
+
+def run_directory(input_filename, run_name, threshold_mode="global"):
+    """
+    @param input_filename: The path of the input signal, named after its SNR e.g. "Input Signals/10.wav"
+    @param run_name: The name shared by every input of the run
+    @param threshold_mode: One of adaptive_threshold.THRESHOLD_MODES. The adaptive modes are named at the end, so
+    check_results.py can keep their ROC curves apart
+    @return: The name of the run's output for that input, as used by read_audio.py
+    """
+    snr = os.path.basename(input_filename).split(".wav")[0]
+    name = "Correlation " + snr + "dB " + run_name
+    if threshold_mode != "global":
+        name = name + " " + threshold_mode
+    return name
+
+
+def threshold_mode_of(name):
+    """
+    @param name: The name of a run's output, as returned by run_directory
+    @return: The threshold mode the run was made with
+    """
+    for threshold_mode in THRESHOLD_MODES[1:]:
+        if name.split(".npz")[0].endswith(" " + threshold_mode):
+            return threshold_mode
+    return "global"
+
+
+def run_job(input_filename, indices, thresholds, relative_to_mean=True, envelope_seconds=DEFAULT_WINDOW_SECONDS,
+            envelope_method="boxcar", threshold_mode="global", noise_seconds=DEFAULT_NOISE_SECONDS):
+    """
+    Correlates one input with some of the calls and sweeps the thresholds over each envelope.
+
+    @param input_filename: The path of the input signal
+    @param indices: The indices of the calls in the template bank to detect
+    @param thresholds: An array of thresholds in standard deviations
+    @param relative_to_mean: Whether the thresholds are measured from the mean of the envelope or from zero
+    @param envelope_seconds: The length of the envelope window in seconds
+    @param envelope_method: One of envelope.ENVELOPE_METHODS
+    @param threshold_mode: One of adaptive_threshold.THRESHOLD_MODES
+    @param noise_seconds: How long the noise floor of the adaptive modes is measured over
+    @return: The input filename, its sampling rate, a list of (template index, peaks, counts) and the time taken. The
+    detections at threshold i are peaks[:counts[i]]
+    """
+    start_time = time.time()
+    fs, inputSignal = load_input(input_filename)
+
+    results = []
+    for index, corr in _template_bank.iter_correlations(inputSignal, indices=indices):
+        envelope = compute_envelope(corr, fs, window_seconds=envelope_seconds, method=envelope_method,
+                                    dtype=_template_bank.dtype, overwrite=True)
+        sweep = make_sweep(envelope, _template_bank.rates[index], fs, threshold_mode, noise_seconds)
+        counts = sweep.sweep(thresholds, relative_to_mean=relative_to_mean)
+        # Only the peaks above the lowest threshold are sent back to the parent
+        results.append((index, sweep.peaks[:counts.max(initial=0)], counts))
+
+    return input_filename, fs, results, time.time() - start_time
+
+
+def run_batch(input_filenames, call_filenames, run_name, output_directory="Detected Peaks", workers=None,
+              templates_per_job=1, thresholds=None, relative_to_mean=True, start=DEFAULT_START,
+              envelope_seconds=DEFAULT_WINDOW_SECONDS, envelope_method="boxcar", overwrite=False,
+              threshold_mode="global", noise_seconds=DEFAULT_NOISE_SECONDS, precision="float64"):
+    """
+    Runs every (input, template) job over a pool of processes and writes one .npz file per input, identical to the
+    file written by the serial loop in read_audio.py.
+
+    @param input_filenames: The paths of the input signals
+    @param call_filenames: The paths of the known bird calls
+    @param run_name: The name of the run, which replaces the time the serial loop puts in its output names
+    @param output_directory: The folder to write the .npz files to
+    @param workers: The number of processes. One per core by default, and 1 runs every job in this process
+    @param templates_per_job: How many calls each job correlates against its input
+    @param thresholds: An array of thresholds in standard deviations. DEFAULT_THRESHOLDS in the global mode and
+    adaptive_threshold.ADAPTIVE_THRESHOLDS in the adaptive modes if None
+    @param relative_to_mean: Whether the thresholds are measured from the mean of the envelope or from zero
+    @param start: The time of the first sample of every input
+    @param envelope_seconds: The length of the envelope window in seconds
+    @param envelope_method: One of envelope.ENVELOPE_METHODS
+    @param overwrite: Whether to replace the output of an earlier run with the same name
+    @param threshold_mode: One of adaptive_threshold.THRESHOLD_MODES
+    @param noise_seconds: How long the noise floor of the adaptive modes is measured over
+    @param precision: One of template_bank.PRECISIONS. "float32" halves the memory of every job
+    @return: A list of the .npz files written
+    """
+    call_filenames = list(call_filenames)
+    input_filenames = list(input_filenames)
+    if thresholds is None:
+        thresholds = DEFAULT_THRESHOLDS if threshold_mode == "global" else ADAPTIVE_THRESHOLDS
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+
+    output_filenames = {}
+    for input_filename in input_filenames:
+        output_filename = output_directory + "/" + run_directory(input_filename, run_name, threshold_mode) + ".npz"
+        if os.path.exists(output_filename) and not overwrite:
+            raise IOError(output_filename + " already exists. Choose another run name")
+        output_filenames[input_filename] = output_filename
+
+    n_templates = len(call_filenames)
+    jobs = []
+    for input_filename in input_filenames:
+        for first in range(0, n_templates, templates_per_job):
+            jobs.append((input_filename, list(range(first, min(first + templates_per_job, n_templates)))))
+
+    names = TemplateBank(call_filenames).names
+    jobs_left = dict((input_filename, 0) for input_filename in input_filenames)
+    for input_filename, indices in jobs:
+        jobs_left[input_filename] += 1
+
+    results = dict((input_filename, []) for input_filename in input_filenames)
+    written = []
+    start_time = time.time()
+
+    def finish(job_number, input_filename, fs, job_results, seconds):
+        job_names = ", ".join(names[index] for index, peaks, counts in job_results)
+        print("[" + str(job_number) + "/" + str(len(jobs)) + "] " + os.path.basename(input_filename) + " x " +
+              job_names + " took %s seconds" % seconds)
+
+        results[input_filename].extend(job_results)
+        jobs_left[input_filename] -= 1
+        if jobs_left[input_filename] > 0:
+            return
+
+        # Add the birds in bank order so the file does not depend on which job finished first
+        writer = DetectionWriter(start=start, rate=fs)
+        for index, peaks, counts in sorted(results.pop(input_filename), key=lambda result: result[0]):
+            for threshold, count in zip(thresholds, counts):
+                writer.add(names[index], threshold, peaks[:count])
+        writer.save(output_filenames[input_filename])
+        written.append(output_filenames[input_filename])
+        print("Saved " + output_filenames[input_filename])
+
+    job_arguments = (thresholds, relative_to_mean, envelope_seconds, envelope_method, threshold_mode, noise_seconds)
+
+    if workers == 1:
+        _init_worker(call_filenames, precision)
+        for job_number, (input_filename, indices) in enumerate(jobs):
+            finish(job_number + 1, *run_job(input_filename, indices, *job_arguments))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(call_filenames, precision)) as executor:
+            futures = [executor.submit(run_job, input_filename, indices, *job_arguments)
+                       for input_filename, indices in jobs]
+            for job_number, future in enumerate(as_completed(futures)):
+                finish(job_number + 1, *future.result())
+
+    print("--- " + str(len(jobs)) + " jobs took %s seconds ---" % (time.time() - start_time))
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Correlates every input signal with every bird call in parallel")
+    parser.add_argument("run_name", help="The name of the run, e.g. \"2024-01-01 sweep\". It must be unique")
+    parser.add_argument("--inputs", default="Input Signals/*.wav", help="A glob of the input signals")
+    parser.add_argument("--calls", default="Test Bird Calls/*", help="A glob of the known bird calls")
+    parser.add_argument("--output", default="Detected Peaks", help="The folder to write the detections to")
+    parser.add_argument("--workers", type=int, default=None, help="The number of processes, one per core by default")
+    parser.add_argument("--templates-per-job", type=int, default=1, help="How many calls each job correlates")
+    parser.add_argument("--start", default=DEFAULT_START.isoformat(),
+                        help="The time of the first sample of every input, in ISO format")
+    parser.add_argument("--from-zero", action="store_true",
+                        help="Measure the thresholds from zero instead of the mean, as read_audio.py does in DEBUG_MODE")
+    parser.add_argument("--threshold-mode", choices=THRESHOLD_MODES, default="global",
+                        help="Measure the thresholds against the whole envelope or a rolling noise floor")
+    parser.add_argument("--noise-seconds", type=float, default=DEFAULT_NOISE_SECONDS,
+                        help="How long the rolling noise floor is measured over")
+    parser.add_argument("--precision", choices=PRECISIONS, default="float64",
+                        help="Correlate the raw samples in float64 or the normalised samples in float32")
+    parser.add_argument("--csv", action="store_true", help="Also export the detections as one csv per threshold")
+    parser.add_argument("--overwrite", action="store_true", help="Replace the output of a run with the same name")
+    args = parser.parse_args()
+
+    run_files = run_batch(sorted(glob(args.inputs)), sorted(glob(args.calls)), args.run_name,
+                          output_directory=args.output, workers=args.workers,
+                          templates_per_job=args.templates_per_job, relative_to_mean=not args.from_zero,
+                          start=datetime.datetime.strptime(args.start, "%Y-%m-%dT%H:%M:%S"),
+                          overwrite=args.overwrite, threshold_mode=args.threshold_mode,
+                          noise_seconds=args.noise_seconds, precision=args.precision)
+
+    if args.csv:
+        for run_file in run_files:
+            export_csv(run_file, run_file.split(".npz")[0])
+    print("finished it!")
@@ -0,0 +1,492 @@
+#!/usr/bin/python
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.io import wavfile
+
+from batch_runner import DEFAULT_START, DEFAULT_THRESHOLDS
+from detector import save_peak_data
+from envelope import compute_envelope
+from ingest import DEFAULT_MEMORY_BUDGET, peak_rss_megabytes, sweep_file
+from multichannel import detect_channels, read_channels
+from peak_io import DetectionWriter, format_timestamps, samples_to_datetime64
+from peak_sweep import PeakSweep
+from scoring import score_bird
+from template_bank import PRECISIONS, TemplateBank
+
+RATE = 44100
+# The minimum gap between two calls of the same species in seconds, as in createTestSoundData.m
+GAP = 5
+# The number of gamma distributed intervals drawn for each species before they repeat
+UNIQUE_INTERVALS = 500
+TOLERANCE = 3.0
+# How far apart in seconds the detections of two precisions may be and still agree. Rounding the envelope to float32
+# can move the highest sample of the flat top of a peak by a few milliseconds
+AGREEMENT_SECONDS = 0.1
+BLOCK_SECONDS = 60
+# The furthest a call reaches one microphone after another in a multi-channel recording, a few metres of air
+MAX_DELAY_SECONDS = 0.01
+
+DEFAULT_DURATIONS = [60, 3600, 24 * 3600]
+DEFAULT_TEMPLATE_COUNTS = [1, 10, 100]
+
+
+def synthetic_call(rng, rate=RATE):
+    """
+    @param rng: A np.random.RandomState
+    @param rate: The sampling rate
+    @return: A random frequency sweep with harmonics under a Hann window, between 0.5 and 2.5 seconds long
+    """
+    seconds = rng.uniform(0.5, 2.5)
+    t = np.arange(int(seconds * rate)) / float(rate)
+    start_frequency, end_frequency = rng.uniform(1000, 8000, 2)
+    phase = 2 * np.pi * (start_frequency * t + (end_frequency - start_frequency) * t ** 2 / (2 * seconds))
+
+    call = np.sin(phase) + 0.5 * np.sin(2 * phase) + 0.25 * np.sin(3 * phase)
+    call *= np.hanning(len(call))
+    return (call / np.abs(call).max() * 0.9 * 32767).astype(np.int16)
+
+
+def write_calls(directory, n_templates, rng, rate=RATE):
+    """
+    @param directory: The folder to write the calls to
+    @param n_templates: The number of species
+    @param rng: A np.random.RandomState
+    @param rate: The sampling rate
+    @return: The paths of the calls, one per species
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    filenames = []
+    for i in range(n_templates):
+        filename = os.path.join(directory, "Synthetic Bird %03d.wav" % i)
+        wavfile.write(filename, rate, synthetic_call(rng, rate))
+        filenames.append(filename)
+    return filenames
+
+
+def call_schedule(n_samples, call_length, rng, rate=RATE, gap=GAP):
+    """
+    The calls of one species as createTestSoundData.m places them: gamma distributed silences averaging a little
+    more than the call length plus gap seconds, each followed by a call.
+
+    @param n_samples: The length of the recording
+    @param call_length: The length of the species' call in samples
+    @param rng: A np.random.RandomState
+    @param rate: The sampling rate
+    @param gap: The minimum gap between calls in seconds
+    @return: The first sample of every call, and the times of the centres of the calls that finish in seconds
+    """
+    average_interval = call_length / float(rate) + gap + 10 * rng.rand()
+    intervals = np.floor(rng.gamma(average_interval, 1.0, UNIQUE_INTERVALS) * rate).astype(np.int64)
+
+    # Enough intervals for the whole recording, wrapping around as the generator does
+    n_calls = n_samples // (int(intervals.min()) + call_length) + 2
+    steps = intervals[np.arange(1, n_calls + 1) % UNIQUE_INTERVALS] + call_length
+    starts = np.cumsum(steps) - call_length
+    starts = starts[starts < n_samples]
+
+    centres = starts + call_length / 2.0
+    return starts, centres[centres <= n_samples] / float(rate)
+
+
+def write_mixture(filename, calls, schedules, n_samples, snr, rng, rate=RATE, delays=(0,)):
+    """
+    Writes the sum of every species' calls plus white noise at the given SNR, one block at a time into a memory
+    mapped wav file, so recordings far larger than memory can be made. Each channel hears the calls after its own
+    delay, over noise of its own.
+
+    @param filename: The wav file to write
+    @param calls: The call of each species
+    @param schedules: The first sample of every call of each species
+    @param n_samples: The length of the recording
+    @param snr: The signal to noise ratio in dB
+    @param rng: A np.random.RandomState
+    @param rate: The sampling rate
+    @param delays: The delay of the calls on each channel in samples. One channel by default
+    """
+    block = BLOCK_SECONDS * rate
+    n_channels = len(delays)
+
+    def clean(start, stop):
+        mixture = np.zeros(stop - start, dtype=np.float64)
+        for call, starts in zip(calls, schedules):
+            first = np.searchsorted(starts, start - len(call), side="right")
+            last = np.searchsorted(starts, stop, side="left")
+            for call_start in starts[first:last]:
+                lo = max(call_start, start)
+                hi = min(call_start + len(call), stop)
+                mixture[lo - start:hi - start] += call[lo - call_start:hi - call_start]
+        return mixture
+
+    # The first pass finds the power and peak of the calls, which set the noise level and the scaling
+    power = 0.0
+    peak = 0.0
+    for start in range(0, n_samples, block):
+        mixture = clean(start, min(start + block, n_samples))
+        power += np.dot(mixture, mixture)
+        peak = max(peak, np.abs(mixture).max())
+    noise_std = np.sqrt(power / n_samples / 10 ** (snr / 10.0))
+    scale = 32767 / (peak + 4 * noise_std)
+
+    shape = (n_samples,) if n_channels == 1 else (n_samples, n_channels)
+    wavfile.write(filename, rate, np.zeros(shape, dtype=np.int16))
+    # The samples are the last part of the file wavfile.write makes
+    output = np.memmap(filename, dtype=np.int16, mode="r+",
+                       offset=os.path.getsize(filename) - 2 * n_samples * n_channels, shape=(n_samples, n_channels))
+    for start in range(0, n_samples, block):
+        stop = min(start + block, n_samples)
+        for channel, delay in enumerate(delays):
+            mixture = clean(start - delay, stop - delay) + rng.normal(0, noise_std, stop - start)
+            output[start:stop, channel] = np.clip(np.round(mixture * scale), -32768, 32767).astype(np.int16)
+    output.flush()
+    del output
+
+
+def write_actual_results(directory, names, centres, start=DEFAULT_START):
+    """
+    Writes the csv of every species' calls in the layout of createTestSoundData.m: the start of the recording as a
+    reference row, then the time of the centre of every call.
+
+    @param directory: The folder to write to, e.g. "Actual Results"
+    @param names: The name of each species
+    @param centres: The times of the centres of each species' calls in seconds
+    @param start: The time of the first sample
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for name, seconds in zip(names, centres):
+        timestamps = samples_to_datetime64(np.concatenate(([0.0], seconds)), 1, start)
+        pd.Series(format_timestamps(timestamps)).to_csv(os.path.join(directory, name + ".csv"), index=False,
+                                                        header=False)
+
+
+class StageTimer:
+    """
+    Adds up the wall clock and CPU time spent in each named stage.
+    """
+
+    def __init__(self):
+        self.wall = {}
+        self.cpu = {}
+
+    def start(self):
+        return time.perf_counter(), time.process_time()
+
+    def stop(self, name, started):
+        self.wall[name] = self.wall.get(name, 0.0) + time.perf_counter() - started[0]
+        self.cpu[name] = self.cpu.get(name, 0.0) + time.process_time() - started[1]
+
+
+def run_detector(wav_filename, template_bank, work_directory, timer, mode, batch_size=1, save_csv=False):
+    """
+    Runs every stage of the file pipeline on one recording.
+
+    @return: The PeakSweep and counts of every species
+    """
+    results = []
+    fs, samples = wavfile.read(wav_filename, mmap=True)
+
+    if mode == "stream":
+        started = timer.start()
+        fs, sweeps = sweep_file(wav_filename, template_bank, memory_budget=DEFAULT_MEMORY_BUDGET)
+        timer.stop("stream", started)
+    else:
+        sweeps = []
+        correlations = template_bank.iter_correlations(samples, batch_size=batch_size)
+        for index in range(len(template_bank)):
+            started = timer.start()
+            index, corr = next(correlations)
+            timer.stop("correlate", started)
+
+            started = timer.start()
+            envelope = compute_envelope(corr, fs, dtype=template_bank.dtype, overwrite=True)
+            timer.stop("envelope", started)
+            del corr
+
+            started = timer.start()
+            sweeps.append(PeakSweep.from_envelope(envelope, distance=template_bank.rates[index]))
+            timer.stop("peaks", started)
+            del envelope
+
+    writer = DetectionWriter(start=DEFAULT_START, rate=fs)
+    for index, sweep in enumerate(sweeps):
+        started = timer.start()
+        counts = sweep.sweep(DEFAULT_THRESHOLDS)
+        timer.stop("peaks", started)
+
+        started = timer.start()
+        timestamps = format_timestamps(samples_to_datetime64(sweep.peaks[:counts.max(initial=0)], fs, DEFAULT_START))
+        timer.stop("timestamps", started)
+
+        started = timer.start()
+        writer.add_sweep(template_bank.names[index], DEFAULT_THRESHOLDS, sweep, counts)
+        if save_csv:
+            peaks = pd.DataFrame(dict((threshold, pd.Series(np.sort(timestamps[:count])))
+                                      for threshold, count in zip(DEFAULT_THRESHOLDS, counts)))
+            save_peak_data(peaks, template_bank.filenames[index], directory="benchmark",
+                           output_directory=os.path.join(work_directory, "Detected Peaks"), start_dt=DEFAULT_START)
+        timer.stop("save", started)
+        results.append((sweep, counts))
+
+    started = timer.start()
+    writer.save(os.path.join(work_directory, "Detected Peaks", "benchmark.npz"))
+    timer.stop("save", started)
+    return fs, results
+
+
+def run_multichannel_detector(wav_filename, template_bank, timer, batch_size=1):
+    """
+    Correlates every channel of a recording in one batched pass and fuses their detections.
+
+    @return: The sampling rate and the fused detections of every species at each threshold
+    """
+    fs, channels = read_channels(wav_filename)
+    started = timer.start()
+    sweeps, counts, fused = detect_channels(template_bank, channels, fs, DEFAULT_THRESHOLDS, batch_size=batch_size)
+    timer.stop("channels", started)
+    return fs, fused
+
+
+def detection_agreement(results, reference, tolerance):
+    """
+    @param results: The (PeakSweep, counts) of every species from one run
+    @param reference: The (PeakSweep, counts) of every species from the run to compare with, at the same thresholds
+    @param tolerance: How many samples apart two detections may be and still agree
+    @return: The fraction of the detections of both runs, over every species and threshold, that the other run made too
+    """
+    agreed = 0
+    total = 0
+    for (sweep, counts), (reference_sweep, reference_counts) in zip(results, reference):
+        for count, reference_count in zip(counts, reference_counts):
+            detections = np.sort(sweep.peaks[:count])
+            reference_detections = np.sort(reference_sweep.peaks[:reference_count])
+            for a, b in ((detections, reference_detections), (reference_detections, detections)):
+                total += len(a)
+                if len(b) == 0:
+                    continue
+                # The distance from every detection to the nearest one of the other run
+                right = np.clip(np.searchsorted(b, a), 0, len(b) - 1)
+                left = np.clip(right - 1, 0, len(b) - 1)
+                nearest = np.minimum(np.abs(b[right] - a), np.abs(b[left] - a))
+                agreed += int(np.count_nonzero(nearest <= tolerance))
+    return agreed / float(total) if total else 1.0
+
+
+def run_case(duration, n_templates, snr, seed, mode="auto", batch_size=1, max_batch_bytes=4 * 2**30, save_csv=False,
+             trace_memory=True, work_directory=None, precision="float64", fft_workers=None, compare_precision=False,
+             n_channels=1):
+    """
+    Synthesizes one recording with known calls, detects and scores it, and measures every stage.
+
+    @param duration: The length of the recording in seconds
+    @param n_templates: The number of species
+    @param snr: The signal to noise ratio in dB
+    @param seed: The seed of the random numbers
+    @param mode: "batch" correlates the whole recording at once, "stream" uses ingest.sweep_file and "auto" streams
+    when the batch correlation would need more than max_batch_bytes. Recordings with several channels are always
+    correlated whole by multichannel.detect_channels
+    @param batch_size: How many calls to correlate at once in batch mode
+    @param max_batch_bytes: The largest batch correlation "auto" allows
+    @param save_csv: Whether to also time detector.save_peak_data writing the csv layout
+    @param trace_memory: Whether to measure the peak memory allocated with tracemalloc
+    @param work_directory: The folder for the synthesized files. A temporary folder that is removed if None
+    @param precision: One of template_bank.PRECISIONS
+    @param fft_workers: The number of threads the FFTs are split over
+    @param compare_precision: Whether to run the float64 path afterwards and measure how many detections agree
+    @param n_channels: The number of microphones. Each hears the calls up to MAX_DELAY_SECONDS later than the first,
+    and the fused detections of all of them are scored
+    @return: A dictionary of the measurements
+    """
+    rng = np.random.RandomState(seed)
+    n_samples = int(duration * RATE)
+    keep = work_directory is not None
+    if work_directory is None:
+        work_directory = tempfile.mkdtemp(prefix="bird-benchmark-")
+
+    try:
+        filenames = write_calls(os.path.join(work_directory, "Test Bird Calls"), n_templates, rng)
+        template_bank = TemplateBank(filenames, precision=precision, workers=fft_workers)
+        schedules = []
+        centres = []
+        for call in template_bank.calls:
+            starts, call_centres = call_schedule(n_samples, len(call), rng)
+            schedules.append(starts)
+            centres.append(call_centres)
+
+        wav_filename = os.path.join(work_directory, "Input Signals", "%g.wav" % snr)
+        if not os.path.isdir(os.path.dirname(wav_filename)):
+            os.makedirs(os.path.dirname(wav_filename))
+        delays = (0,)
+        if n_channels > 1:
+            delays = np.concatenate(([0], rng.randint(0, int(MAX_DELAY_SECONDS * RATE) + 1, n_channels - 1)))
+        write_mixture(wav_filename, template_bank.calls, schedules, n_samples, snr, rng, delays=delays)
+        write_actual_results(os.path.join(work_directory, "Actual Results"), template_bank.names, centres)
+
+        if n_channels > 1:
+            mode = "channels"
+        elif mode == "auto":
+            # The input spectrum, a batch of spectra and correlations, and the envelope
+            itemsize = np.dtype(template_bank.dtype).itemsize
+            batch_bytes = template_bank.fft_size(n_samples) * itemsize * (2 + 3 * batch_size)
+            mode = "stream" if batch_bytes > max_batch_bytes else "batch"
+
+        timer = StageTimer()
+        if trace_memory:
+            tracemalloc.start()
+        wall_started = time.perf_counter()
+        cpu_started = time.process_time()
+
+        if mode == "channels":
+            fs, detected = run_multichannel_detector(wav_filename, template_bank, timer, batch_size)
+        else:
+            fs, results = run_detector(wav_filename, template_bank, work_directory, timer, mode, batch_size, save_csv)
+            detected = [[sweep.peaks[:count] for count in counts] for sweep, counts in results]
+
+        started = timer.start()
+        youden = []
+        for call_detected, call_centres in zip(detected, centres):
+            actual = np.round(call_centres * 1e9).astype(np.int64)
+            detections = [np.sort(np.round(samples * (1e9 / fs)).astype(np.int64)) for samples in call_detected]
+            table = score_bird("", DEFAULT_THRESHOLDS, actual, detections, total_events=int(duration),
+                               tolerance=TOLERANCE)
+            youden.append(float((table["True Positive Rate"] - table["False Alarm Rate"]).max()))
+        timer.stop("scoring", started)
+
+        wall_seconds = time.perf_counter() - wall_started
+        cpu_seconds = time.process_time() - cpu_started
+        peak_traced = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        if trace_memory:
+            tracemalloc.stop()
+
+        agreement = None
+        if compare_precision and precision != "float64" and mode != "channels":
+            reference_bank = TemplateBank(filenames, workers=fft_workers)
+            fs, reference = run_detector(wav_filename, reference_bank, work_directory, StageTimer(), mode, batch_size)
+            agreement = detection_agreement(results, reference, int(AGREEMENT_SECONDS * fs))
+    finally:
+        if not keep:
+            shutil.rmtree(work_directory, ignore_errors=True)
+
+    return {
+        "duration_seconds": duration,
+        "templates": n_templates,
+        "snr_db": snr,
+        "seed": seed,
+        "mode": mode,
+        "batch_size": batch_size,
+        "channels": n_channels,
+        "precision": precision,
+        "fft_workers": fft_workers,
+        "calls": int(sum(len(call_centres) for call_centres in centres)),
+        "detections_at_lowest_threshold": int(sum(max(len(samples) for samples in call_detected)
+                                                  for call_detected in detected)),
+        "stage_wall_seconds": timer.wall,
+        "stage_cpu_seconds": timer.cpu,
+        "wall_seconds": wall_seconds,
+        "cpu_seconds": cpu_seconds,
+        # Below 1 is faster than real time
+        "real_time_factor": wall_seconds / duration,
+        "audio_hours_per_core_hour": duration / cpu_seconds if cpu_seconds > 0 else None,
+        "peak_traced_mb": peak_traced / 2.0**20 if peak_traced is not None else None,
+        # The most this process held at once, which only describes this case when it ran in a process of its own
+        "peak_rss_mb": peak_rss_megabytes(),
+        "mean_best_youden_index": float(np.mean(youden)),
+        # The fraction of detections the float64 path agrees with, if it was compared
+        "float64_agreement": agreement,
+    }
+
+
+def run_isolated_case(*args, **kwargs):
+    """
+    Runs run_case in a freshly started process. The peak RSS of a process never goes down, so every case measured
+    in one process after the largest would report the largest case's memory.
+
+    @return: The dictionary of run_case
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        return executor.submit(run_case, *args, **kwargs).result()
+
+
+def run_benchmark(durations=DEFAULT_DURATIONS, template_counts=DEFAULT_TEMPLATE_COUNTS, snr=10.0, seed=0,
+                  isolate=True, **kwargs):
+    """
+    @param durations: The lengths of the recordings in seconds
+    @param template_counts: The numbers of species
+    @param snr: The signal to noise ratio in dB
+    @param seed: The seed of the first case. Every case uses its own
+    @param isolate: Whether to run every case in a process of its own, so that its peak RSS is its own. Without it
+    the peak RSS of a case is the most any case so far has needed
+    @return: A dictionary describing the machine and every case
+    """
+    runs = []
+    for duration in durations:
+        for n_templates in template_counts:
+            print("Benchmarking " + str(duration) + " seconds with " + str(n_templates) + " templates...")
+            run = (run_isolated_case if isolate else run_case)(duration, n_templates, snr, seed + len(runs), **kwargs)
+            run["isolated"] = isolate
+            print("--- Real-time factor %.4f, %.1f audio hours per core hour, peak RSS %.1f MB ---" %
+                  (run["real_time_factor"], run["audio_hours_per_core_hour"] or 0, run["peak_rss_mb"]))
+            if run["float64_agreement"] is not None:
+                print("--- %.4f%% of the detections agree with float64 ---" % (100 * run["float64_agreement"]))
+            runs.append(run)
+
+    return {
+        "created": datetime.datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "runs": runs,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Times the detector on synthetic recordings with known calls")
+    parser.add_argument("--durations", default=",".join(str(d) for d in DEFAULT_DURATIONS),
+                        help="Comma separated recording lengths in seconds")
+    parser.add_argument("--templates", default=",".join(str(t) for t in DEFAULT_TEMPLATE_COUNTS),
+                        help="Comma separated numbers of species")
+    parser.add_argument("--snr", type=float, default=10.0, help="The signal to noise ratio in dB")
+    parser.add_argument("--seed", type=int, default=0, help="The seed of the random numbers")
+    parser.add_argument("--mode", choices=["auto", "batch", "stream"], default="auto",
+                        help="Correlate whole recordings, stream them or choose by size")
+    parser.add_argument("--batch-size", type=int, default=1, help="How many calls to correlate at once")
+    parser.add_argument("--precision", choices=PRECISIONS, default="float64",
+                        help="Correlate the raw samples in float64 or the normalised samples in float32")
+    parser.add_argument("--fft-workers", type=int, default=None,
+                        help="The number of threads the FFTs are split over. -1 uses every core")
+    parser.add_argument("--compare-precision", action="store_true",
+                        help="Also run the float64 path and report how many of the detections agree with it")
+    parser.add_argument("--channels", type=int, default=1,
+                        help="The number of microphones. Their fused detections are scored")
+    parser.add_argument("--csv", action="store_true", help="Also time writing the csv layout with save_peak_data")
+    parser.add_argument("--no-tracemalloc", action="store_true", help="Skip tracing allocations, which costs a little")
+    parser.add_argument("--in-process", action="store_true",
+                        help="Run every case in this process. Its peak RSS is then the most any case so far needed")
+    parser.add_argument("--keep", default=None, help="A folder to keep the synthesized files in")
+    parser.add_argument("--output", default="benchmark.json", help="The file to write the results to")
+    args = parser.parse_args()
+
+    report = run_benchmark(durations=[float(d) for d in args.durations.split(",")],
+                           template_counts=[int(t) for t in args.templates.split(",")], snr=args.snr,
+                           seed=args.seed, mode=args.mode, batch_size=args.batch_size, save_csv=args.csv,
+                           trace_memory=not args.no_tracemalloc, work_directory=args.keep, precision=args.precision,
+                           fft_workers=args.fft_workers, compare_precision=args.compare_precision,
+                           n_channels=args.channels, isolate=not args.in_process)
+    with open(args.output, "w") as output_file:
+        json.dump(report, output_file, indent=2)
+    print("Saved " + args.output)
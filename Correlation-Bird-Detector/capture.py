@@ -0,0 +1,413 @@
+#!/usr/bin/python
+
+import argparse
+import bisect
+import threading
+import time
+
+import numpy as np
+
+from adaptive_threshold import DEFAULT_NOISE_SECONDS
+from envelope import DEFAULT_WINDOW_SECONDS
+from ingest import open_wav
+from instrumentation import DISABLED
+from streaming_detector import StreamingDetector
+from template_bank import TemplateBank
+
+RATE = 44100
+CHUNK = 1024
+MIC_INDEX = 2
+BUFFER_SECONDS = 30
+
+
+class RingBuffer:
+    """
+    A preallocated buffer of int16 audio between one writer and one or more readers. Every reader has its own cursor
+    and space is only reused once every reader has passed it.
+
+    A writer that can wait, such as a file being replayed as fast as possible, blocks until there is room, which
+    slows it to the speed of the readers. A writer that cannot wait, such as a microphone callback, drops the frames
+    that do not fit. The dropped frames are counted and the stream position of every gap is kept, so the readers can
+    still put the right time on what they find.
+    """
+
+    def __init__(self, capacity, n_readers=1):
+        """
+        @param capacity: The number of frames the buffer holds
+        @param n_readers: The number of readers
+        """
+        self.capacity = int(capacity)
+        self._buffer = np.zeros(self.capacity, dtype=np.int16)
+        self._condition = threading.Condition()
+        self._read = [0] * n_readers
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self.closed = False
+        # The buffer position of every gap and the frames dropped up to and including it
+        self._gap_positions = []
+        self._gap_totals = []
+
+    def __len__(self):
+        # The frames the slowest reader has not read yet
+        with self._condition:
+            return self.frames_written - min(self._read)
+
+    def write(self, samples, block=False, timeout=None):
+        """
+        @param samples: The next int16 frames
+        @param block: Whether to wait for room instead of dropping the frames that do not fit
+        @param timeout: The longest to wait for room in seconds. None waits as long as it takes
+        @return: The number of frames written
+        """
+        samples = np.asarray(samples, dtype=np.int16)
+        written = 0
+        with self._condition:
+            while written < len(samples) and not self.closed:
+                free = self.capacity - (self.frames_written - min(self._read))
+                if free == 0 and block:
+                    if not self._condition.wait(timeout):
+                        break
+                    continue
+                if free == 0:
+                    break
+
+                n = min(free, len(samples) - written)
+                start = self.frames_written % self.capacity
+                first = min(n, self.capacity - start)
+                self._buffer[start:start + first] = samples[written:written + first]
+                self._buffer[:n - first] = samples[written + first:written + n]
+                self.frames_written += n
+                written += n
+                self._condition.notify_all()
+
+            dropped = len(samples) - written
+            if dropped:
+                self.frames_dropped += dropped
+                self._gap_positions.append(self.frames_written)
+                self._gap_totals.append(self.frames_dropped)
+        return written
+
+    def read(self, reader=0, max_frames=CHUNK, min_frames=1, timeout=None):
+        """
+        @param reader: The index of the reader
+        @param max_frames: The most frames to return
+        @param min_frames: The fewest frames to wait for. Fewer are only returned once the buffer is closed
+        @param timeout: The longest to wait in seconds. None waits as long as it takes
+        @return: The buffer position of the first frame and a copy of the frames, which is empty once the buffer is
+        closed and read to the end, or on a timeout
+        """
+        with self._condition:
+            position = self._read[reader]
+            deadline = None if timeout is None else time.time() + timeout
+            while self.frames_written - position < min_frames and not self.closed:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return position, np.zeros(0, dtype=np.int16)
+                self._condition.wait(remaining)
+
+            n = min(max_frames, self.frames_written - position)
+            start = position % self.capacity
+            first = min(n, self.capacity - start)
+            samples = np.concatenate((self._buffer[start:start + first], self._buffer[:n - first]))
+            self._read[reader] = position + n
+            self._condition.notify_all()
+        return position, samples
+
+    def stream_position(self, position):
+        """
+        @param position: A buffer position
+        @return: The position in the stream including every frame dropped before it
+        """
+        with self._condition:
+            gap = bisect.bisect_right(self._gap_positions, position)
+            return position + (self._gap_totals[gap - 1] if gap else 0)
+
+    def discard(self):
+        # Skips every reader past the frames not read yet
+        with self._condition:
+            self._read = [self.frames_written] * len(self._read)
+            self._condition.notify_all()
+
+    def close(self):
+        # The writer has finished. Readers get the rest of the frames and then empty reads
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+
+class WavSource:
+    """
+    Replays a wav file as if it were a microphone, in chunks on its own thread. At speed 1 the chunks arrive in real
+    time, at speed 10 ten times faster, and at speed None as fast as the readers take them.
+    """
+
+    def __init__(self, filename, speed=1.0, chunk=CHUNK, block=None, loop=False):
+        """
+        @param filename: The wav file to replay
+        @param speed: How many times faster than real time to replay. None for as fast as the readers allow
+        @param chunk: The frames delivered at once
+        @param block: Whether to wait for room in the buffer instead of dropping frames. Only when speed is None by
+        default, because a live source cannot wait
+        @param loop: Whether to start again at the end of the file
+        """
+        self.rate, self._samples = open_wav(filename)
+        self.speed = speed
+        self.chunk = chunk
+        self.block = speed is None if block is None else block
+        self.loop = loop
+        self.frames_captured = 0
+        # Overflows reported by the audio device. A file never has any
+        self.overflows = 0
+        self.finished = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self, ring):
+        self._thread = threading.Thread(target=self._run, args=(ring,), name="WavSource")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, ring):
+        started = time.perf_counter()
+        position = 0
+        while not self._stopping.is_set():
+            if position >= len(self._samples):
+                if not self.loop:
+                    break
+                position = 0
+
+            chunk = np.asarray(self._samples[position:position + self.chunk])
+            if self.speed:
+                # Wait until the last frame of the chunk would have been recorded
+                due = started + (self.frames_captured + len(chunk)) / float(self.rate * self.speed)
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+            ring.write(chunk, block=self.block)
+            self.frames_captured += len(chunk)
+            position += len(chunk)
+        # Nothing more is coming, so the readers can finish what is left
+        ring.close()
+        self.finished.set()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+class MicrophoneSource:
+    """
+    Records the microphone with a PyAudio callback, which PortAudio calls on its own thread as every chunk arrives.
+    The callback never waits, so when the buffer is full the chunk is dropped and counted.
+    """
+
+    def __init__(self, rate=RATE, chunk=CHUNK, mic_index=MIC_INDEX):
+        self.rate = rate
+        self.chunk = chunk
+        self.mic_index = mic_index
+        self.frames_captured = 0
+        # PortAudio flags an overflow when it lost input before the callback ran, without saying how much
+        self.overflows = 0
+        self.finished = threading.Event()
+        self._audio = None
+        self._stream = None
+
+    def start(self, ring):
+        import pyaudio
+
+        def callback(in_data, frame_count, time_info, status):
+            if status & pyaudio.paInputOverflow:
+                self.overflows += 1
+            ring.write(np.frombuffer(in_data, np.int16), block=False)
+            self.frames_captured += frame_count
+            return None, pyaudio.paContinue
+
+        self._audio = pyaudio.PyAudio()
+        self._stream = self._audio.open(
+            format=pyaudio.paInt16,
+            channels=1,
+            rate=self.rate,
+            frames_per_buffer=self.chunk,
+            input_device_index=self.mic_index,
+            input=True,
+            stream_callback=callback)
+        self._stream.start_stream()
+
+    def stop(self):
+        if self._stream is not None:
+            self._stream.stop_stream()
+            self._stream.close()
+            self._audio.terminate()
+            self._stream = None
+        self.finished.set()
+
+
+class CapturePipeline:
+    """
+    Captures audio into a RingBuffer while worker threads correlate it, so nothing is missed while the calls are
+    being searched for. Each worker runs a StreamingDetector over its share of the calls and reads the whole stream
+    through its own cursor. The detectors carry the last call length of every block into the next, so the blocks
+    overlap and calls on a block edge are still found. The FFTs release the GIL, so the workers run in parallel.
+
+    The counters prove the coverage: every frame the source captured was either processed by every worker or
+    dropped, and coverage() is the fraction that was processed.
+    """
+
+    def __init__(self, source, template_bank, height=None, envelope_seconds=DEFAULT_WINDOW_SECONDS, workers=1,
+                 buffer_seconds=BUFFER_SECONDS, block_size=None, on_detections=None, metrics=DISABLED,
+                 threshold_mode="global", noise_seconds=DEFAULT_NOISE_SECONDS, min_height=None):
+        """
+        @param source: A WavSource or MicrophoneSource
+        @param template_bank: The TemplateBank holding the calls to detect
+        @param height: The minimum envelope height of a detection. None reports every local maximum
+        @param envelope_seconds: How long the squared correlation is averaged over
+        @param workers: The number of worker threads. The calls are shared out between them
+        @param buffer_seconds: How much audio the ring buffer holds
+        @param block_size: The number of new samples correlated per FFT. Defaults to the longest call length
+        @param on_detections: Called with each list of (template index, stream sample, envelope height) detections,
+        one call at a time
+        @param metrics: The instrumentation.Metrics to report to
+        @param threshold_mode: One of adaptive_threshold.THRESHOLD_MODES. height is a score in the adaptive modes
+        @param noise_seconds: How long the noise floor of the adaptive modes is measured over
+        @param min_height: An envelope height the adaptive modes never detect below
+        """
+        self.source = source
+        self.template_bank = template_bank
+        self.rate = source.rate
+        self.on_detections = on_detections
+        self.metrics = metrics
+        self.lock = threading.Lock()
+
+        workers = max(1, min(workers, len(template_bank)))
+        self.ring = RingBuffer(buffer_seconds * self.rate, n_readers=workers)
+        self._indices = [list(range(len(template_bank)))[w::workers] for w in range(workers)]
+        # Every worker shares the caller's bank, with its precision and cached spectra, and detects its own calls
+        self._detectors = [StreamingDetector(template_bank, height=height, rate=self.rate,
+                                             envelope_seconds=envelope_seconds, block_size=block_size,
+                                             threshold_mode=threshold_mode, noise_seconds=noise_seconds,
+                                             min_height=min_height, indices=indices)
+                           for indices in self._indices]
+        self.frames_processed = [0] * workers
+        self.errors = []
+        self._threads = []
+        self._reported_dropped = 0
+
+    def start(self):
+        for worker in range(len(self._detectors)):
+            thread = threading.Thread(target=self._work, args=(worker,), name="CaptureWorker-" + str(worker))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        self.source.start(self.ring)
+
+    def _work(self, worker):
+        detector = self._detectors[worker]
+        try:
+            while True:
+                position, samples = self.ring.read(worker, max_frames=detector.block_size)
+                if len(samples) == 0:
+                    break
+                with self.metrics.span("correlate", samples=len(samples)):
+                    detections = detector.push(samples)
+                self.frames_processed[worker] += len(samples)
+                self._report(worker, detections)
+            self._report(worker, detector.flush())
+        except Exception as error:
+            # A worker that dies would otherwise stall the buffer silently
+            self.errors.append(error)
+            self.ring.close()
+            raise
+
+    def _report(self, worker, detections):
+        if not detections or self.on_detections is None:
+            return
+        detections = [(i, self.ring.stream_position(sample), height) for i, sample, height in detections]
+        with self.lock:
+            self.on_detections(detections)
+
+    def update_metrics(self):
+        self.metrics.set_queue_depth(len(self.ring))
+        dropped = self.ring.frames_dropped
+        self.metrics.add_dropped_frames(dropped - self._reported_dropped)
+        self._reported_dropped = dropped
+
+    @property
+    def frames_captured(self):
+        return self.source.frames_captured
+
+    @property
+    def frames_dropped(self):
+        return self.ring.frames_dropped
+
+    def coverage(self):
+        """
+        @return: The fraction of the captured frames that every worker has processed
+        """
+        if self.frames_captured == 0:
+            return 1.0
+        return min(self.frames_processed) / float(self.frames_captured)
+
+    def stop(self, drain=True):
+        """
+        Stops the source and waits for the workers to finish.
+
+        @param drain: Whether the workers process the frames still in the buffer first
+        """
+        self.source.stop()
+        if not drain:
+            self.ring.discard()
+        self.ring.close()
+        for thread in self._threads:
+            thread.join()
+        self.update_metrics()
+
+    def run(self, seconds=None, poll_seconds=1.0, on_poll=None):
+        """
+        Runs the pipeline until the source finishes, or for the given time.
+
+        @param seconds: How long to run for. Until the source finishes if None
+        @param poll_seconds: How often to update the metrics and call on_poll
+        @param on_poll: Called with the pipeline every poll_seconds and once more after it stops, holding its lock
+        """
+        self.start()
+        started = time.time()
+        try:
+            while not self.source.finished.wait(poll_seconds):
+                self.update_metrics()
+                if on_poll is not None:
+                    with self.lock:
+                        on_poll(self)
+                if seconds is not None and time.time() - started >= seconds:
+                    break
+        finally:
+            self.stop()
+        if on_poll is not None:
+            with self.lock:
+                on_poll(self)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replays a recording through the capture pipeline and reports the "
+                                                 "coverage")
+    parser.add_argument("input", help="The wav file to replay")
+    parser.add_argument("--calls", default="Test Bird Calls", help="The folder of known bird calls")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="How many times faster than real time to replay. 0 replays as fast as the workers allow")
+    parser.add_argument("--workers", type=int, default=1, help="The number of worker threads")
+    parser.add_argument("--buffer-seconds", type=int, default=BUFFER_SECONDS, help="How much audio the buffer holds")
+    args = parser.parse_args()
+
+    template_bank = TemplateBank.from_directory(args.calls)
+    source = WavSource(args.input, speed=args.speed or None)
+    detections = []
+    pipeline = CapturePipeline(source, template_bank, workers=args.workers, buffer_seconds=args.buffer_seconds,
+                               on_detections=detections.extend)
+
+    start_time = time.time()
+    pipeline.run()
+    print("--- Took %s seconds ---" % (time.time() - start_time))
+    print("Captured " + str(pipeline.frames_captured) + " frames, dropped " + str(pipeline.frames_dropped) +
+          ", processed " + str(min(pipeline.frames_processed)) + ", coverage %.4f%%" % (100 * pipeline.coverage()))
+    print("Found " + str(len(detections)) + " peaks")
@@ -0,0 +1,387 @@
+#!/usr/bin/python
+
+import argparse
+import datetime
+import json
+import os
+import time
+from glob import glob
+
+import numpy as np
+from scipy import signal
+from scipy.io import wavfile
+
+from batch_runner import DEFAULT_START, DEFAULT_THRESHOLDS, run_directory
+from envelope import DEFAULT_WINDOW_SECONDS, HILBERT_TAPS, compute_envelope, window_length
+from instrumentation import DISABLED
+from peak_io import DetectionWriter
+from peak_sweep import PeakSweep
+from scoring import score_detections
+from template_bank import TemplateBank
+
+# The screening pass runs on audio decimated by SCREEN_FACTOR and high-passed at LOW_HZ. Bird calls lie within
+# 50Hz - 12kHz, as the wavelet detector notes
+SCREEN_FACTOR = 2
+LOW_HZ = 50.0
+# Coarse envelope samples this many standard deviations above the coarse envelope's mean are correlated in full
+SCREEN_THRESHOLD = 0.0
+DEFAULT_SCREEN_THRESHOLDS = [0.0, 0.5, 1.0, 2.0, 4.0]
+
+
+def band_limit(samples, rate, factor=SCREEN_FACTOR, low_hz=LOW_HZ):
+    """
+    @param samples: The audio to screen
+    @param rate: Its sampling rate
+    @param factor: How much to decimate it by
+    @param low_hz: The cut-off of the high-pass filter that removes wind and handling noise
+    @return: The high-passed audio decimated by factor
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    high_pass = signal.butter(4, low_hz, "highpass", fs=rate, output="sos")
+    samples = signal.sosfiltfilt(high_pass, samples)
+    if factor == 1:
+        return samples
+    return signal.decimate(samples, factor)
+
+
+class ScreeningBank(TemplateBank):
+    """
+    The calls of a TemplateBank, band-limited and decimated in the same way as the input of the screening pass. The
+    spectra are cached per FFT size as in TemplateBank.
+    """
+
+    def __init__(self, template_bank, factor=SCREEN_FACTOR, low_hz=LOW_HZ):
+        """
+        @param template_bank: The TemplateBank of the calls at full rate
+        @param factor: How much to decimate the calls by
+        @param low_hz: The cut-off of the high-pass filter
+        """
+        TemplateBank.__init__(self, template_bank.filenames, precision=template_bank.precision,
+                              workers=template_bank.workers,
+                              calls=[(fs // factor, band_limit(call, fs, factor, low_hz))
+                                     for fs, call in zip(template_bank.rates, template_bank.calls)])
+        self.factor = factor
+        self.low_hz = low_hz
+
+
+def _runs(indices):
+    # The [start, stop) of every run of consecutive indices
+    if len(indices) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    breaks = np.flatnonzero(np.diff(indices) > 1)
+    starts = np.concatenate(([indices[0]], indices[breaks + 1]))
+    stops = np.concatenate((indices[breaks], [indices[-1]])) + 1
+    return np.column_stack((starts, stops))
+
+
+def merge_intervals(intervals):
+    """
+    @param intervals: An (n, 2) array of [start, stop) intervals
+    @return: The sorted union of the intervals, with overlapping and touching intervals merged
+    """
+    intervals = np.asarray(intervals, dtype=np.int64).reshape(-1, 2)
+    if len(intervals) == 0:
+        return intervals
+    intervals = intervals[np.argsort(intervals[:, 0], kind="stable")]
+    reach = np.maximum.accumulate(intervals[:, 1])
+    first = np.concatenate(([True], intervals[1:, 0] > reach[:-1]))
+    groups = np.cumsum(first) - 1
+    stops = np.zeros(groups[-1] + 1, dtype=np.int64)
+    np.maximum.at(stops, groups, intervals[:, 1])
+    return np.column_stack((intervals[first, 0], stops))
+
+
+def screen(screening_bank, inputSignal, rate, screen_threshold=SCREEN_THRESHOLD,
+           envelope_seconds=DEFAULT_WINDOW_SECONDS, envelope_method="boxcar", metrics=DISABLED):
+    """
+    Correlates the band-limited, decimated input with every screening call and marks where each coarse envelope is
+    high enough to be worth correlating at full rate.
+
+    @param screening_bank: The ScreeningBank of the calls
+    @param inputSignal: The audio samples at full rate
+    @param rate: The sampling rate of the input
+    @param screen_threshold: How many standard deviations above the mean of its coarse envelope a sample must be
+    @param envelope_seconds: How long the squared correlation is averaged over
+    @param envelope_method: One of envelope.ENVELOPE_METHODS
+    @param metrics: The instrumentation.Metrics the time of each step is reported to
+    @return: A list of the coarse envelope of every call and a list of the [start, stop) coarse envelope samples
+    above the screening threshold
+    """
+    factor = screening_bank.factor
+    with metrics.span("correlate", samples=len(inputSignal)):
+        coarse = band_limit(inputSignal, rate, factor, screening_bank.low_hz)
+
+    envelopes = []
+    candidates = []
+    for index, corr in screening_bank.iter_correlations(coarse, batch_size=1):
+        with metrics.span("envelope", species=screening_bank.names[index], samples=len(corr)):
+            envelope = compute_envelope(corr, rate / float(factor), window_seconds=envelope_seconds,
+                                        method=envelope_method)
+        envelopes.append(envelope)
+        candidates.append(_runs(np.flatnonzero(envelope >= envelope.mean() + screen_threshold * envelope.std())))
+    return envelopes, candidates
+
+
+def cascade_sweeps(template_bank, screening_bank, inputSignal, rate, screen_threshold=SCREEN_THRESHOLD,
+                   envelope_seconds=DEFAULT_WINDOW_SECONDS, envelope_method="boxcar", metrics=DISABLED):
+    """
+    Runs the full-rate correlation only around the samples the screening pass marks, with a call length of context on
+    both sides. Inside those windows the envelope is the same as the full pass's. Outside them it is never computed,
+    so the mean and standard deviation the thresholds are measured in are completed from the coarse envelope, scaled
+    to match the full-rate envelope where both are known.
+
+    The windows are correlated in chunks of one fixed length, which keeps the template bank to a single FFT size.
+
+    @param template_bank: The TemplateBank of the calls at full rate
+    @param screening_bank: The ScreeningBank of the same calls
+    @param inputSignal: The audio samples to search through
+    @param rate: The sampling rate of the input
+    @param screen_threshold: How many standard deviations above the mean of its coarse envelope a sample must be to
+    be correlated at full rate
+    @param envelope_seconds: How long the squared correlation is averaged over
+    @param envelope_method: "boxcar" or "hilbert". The exponential envelope never forgets, so it cannot be windowed
+    @param metrics: The instrumentation.Metrics the time of each step is reported to
+    @return: A list of the PeakSweep of every call in bank order and the fraction of the full-rate correlation skipped
+    """
+    if envelope_method not in ["boxcar", "hilbert"]:
+        raise ValueError("The cascade needs an envelope of finite length, not " + str(envelope_method))
+
+    factor = screening_bank.factor
+    n_samples = len(inputSignal)
+    window = window_length(envelope_seconds, rate)
+    n_envelope = max(n_samples - window + 1, 0)
+    # A full-rate envelope sample depends on the input up to a call length and a window away
+    context = int(template_bank.lengths.max())
+    if envelope_method == "hilbert":
+        context += HILBERT_TAPS
+
+    coarse_envelopes, candidates = screen(screening_bank, inputSignal, rate, screen_threshold, envelope_seconds,
+                                          envelope_method, metrics)
+
+    # The wanted full-rate envelope samples of every call, widened by an envelope window on both sides
+    wanted = []
+    for runs in candidates:
+        intervals = np.column_stack((runs[:, 0] * factor - window, runs[:, 1] * factor + window))
+        wanted.append(merge_intervals(np.clip(intervals, 0, n_envelope)))
+    windows = merge_intervals(np.concatenate(wanted))
+
+    # Each chunk is long enough for a typical window and the context on both sides of it
+    typical = int(np.median(windows[:, 1] - windows[:, 0])) if len(windows) else 0
+    chunk = min(n_samples, template_bank.fft_size(2 * context + window + max(typical, context)) -
+                int(template_bank.lengths.max()) + 1)
+    pieces = [[] for index in range(len(template_bank))]
+    correlated = 0
+
+    for start, stop in windows:
+        while start < stop:
+            first = int(min(max(start - context, 0), n_samples - chunk))
+            last = first + chunk
+            # The edges of the input are zero-padded in the full pass too, so they need no context
+            valid_start = first if first == 0 else first + context
+            valid_stop = last - window + 1 if last == n_samples else last - window + 1 - context
+
+            indices = [index for index in range(len(template_bank))
+                       if np.any((wanted[index][:, 0] < valid_stop) & (wanted[index][:, 1] > valid_start))]
+            correlated += chunk * len(indices)
+            segment = inputSignal[first:last]
+
+            for index, corr in template_bank.iter_correlations(segment, indices=indices):
+                with metrics.span("envelope", species=template_bank.names[index], samples=len(corr)):
+                    envelope = compute_envelope(corr, rate, window_seconds=envelope_seconds, method=envelope_method)
+                pieces[index].append((valid_start, envelope[valid_start - first:valid_stop - first]))
+            start = max(start + 1, valid_stop)
+
+    sweeps = []
+    for index in range(len(template_bank)):
+        with metrics.span("peak-find", species=template_bank.names[index]):
+            sweeps.append(_sweep(_join(pieces[index]), n_envelope, coarse_envelopes[index], factor,
+                                 template_bank.rates[index]))
+
+    total = float(n_samples * len(template_bank))
+    return sweeps, 1.0 - correlated / total if total else 0.0
+
+
+def _join(pieces):
+    # The pieces of envelope in order of their first sample, joined into runs of consecutive samples
+    runs = []
+    for start, values in pieces:
+        if runs and start < runs[-1][1]:
+            values = values[runs[-1][1] - start:]
+            start = runs[-1][1]
+        if len(values) == 0:
+            continue
+        if runs and start == runs[-1][1]:
+            runs[-1][2].append(values)
+            runs[-1][1] += len(values)
+        else:
+            runs.append([start, start + len(values), [values]])
+    return [(start, np.concatenate(values)) for start, stop, values in runs]
+
+
+def _select_by_distance(peaks, heights, distance):
+    # The distance suppression of signal.find_peaks over peaks that were found in separate runs
+    distance = np.ceil(distance)
+    keep = np.ones(len(peaks), dtype=bool)
+    for i in np.argsort(heights, kind="stable")[::-1]:
+        if keep[i]:
+            keep[np.searchsorted(peaks, peaks[i] - distance, side="right"):i] = False
+            keep[i + 1:np.searchsorted(peaks, peaks[i] + distance, side="left")] = False
+    return keep
+
+
+def _sweep(runs, n_envelope, coarse_envelope, factor, distance):
+    coarse_envelope = coarse_envelope[:(n_envelope - 1) // factor + 1]
+    known = np.zeros(len(coarse_envelope), dtype=bool)
+    counts = []
+    means = []
+    m2 = []
+    fine_sum = 0.0
+    peaks = [np.zeros(0, dtype=np.int64)]
+    heights = [np.zeros(0, dtype=np.float64)]
+    for start, values in runs:
+        counts.append(len(values))
+        means.append(values.mean())
+        m2.append(((values - means[-1]) ** 2).sum())
+
+        first = -(-start // factor)
+        last = -(-(start + len(values)) // factor)
+        known[first:last] = True
+        fine_sum += values[first * factor - start::factor].sum()
+
+        # Every local maximum away from the ends of the run, as an edge may only be the edge of the window
+        run_peaks, properties = signal.find_peaks(values)
+        peaks.append(run_peaks + start)
+        heights.append(values[run_peaks])
+
+    # The coarse samples whose full-rate sample was never computed stand in for it, scaled by how the two envelopes
+    # compare where both are known
+    n_skipped = n_envelope - sum(counts)
+    if n_skipped > 0 and not known.all():
+        coarse_sum = coarse_envelope[known].sum()
+        skipped = coarse_envelope[~known] * (fine_sum / coarse_sum if coarse_sum > 0 else 1.0)
+        counts.append(n_skipped)
+        means.append(skipped.mean())
+        m2.append(skipped.var() * n_skipped)
+
+    if not counts:
+        return PeakSweep([], [], 0.0, 0.0)
+    counts = np.array(counts, dtype=np.float64)
+    means = np.array(means)
+    mean = (counts * means).sum() / counts.sum()
+    std = np.sqrt((np.array(m2) + counts * (means - mean) ** 2).sum() / counts.sum())
+
+    peaks = np.concatenate(peaks)
+    heights = np.concatenate(heights)
+    keep = _select_by_distance(peaks, heights, distance)
+    return PeakSweep(peaks[keep], heights[keep], mean, std)
+
+
+def full_sweeps(template_bank, inputSignal, rate, envelope_seconds=DEFAULT_WINDOW_SECONDS, envelope_method="boxcar"):
+    """
+    @param template_bank: The TemplateBank of the calls
+    @param inputSignal: The audio samples to search through
+    @param rate: The sampling rate of the input
+    @param envelope_seconds: How long the squared correlation is averaged over
+    @param envelope_method: One of envelope.ENVELOPE_METHODS
+    @return: A list of the PeakSweep of every call over the whole input, as detect_correlation_peaks finds them
+    """
+    sweeps = []
+    for index, corr in template_bank.iter_correlations(inputSignal, batch_size=1):
+        envelope = compute_envelope(corr, rate, window_seconds=envelope_seconds, method=envelope_method)
+        sweeps.append(PeakSweep.from_envelope(envelope, distance=template_bank.rates[index]))
+    return sweeps
+
+
+def save_sweeps(filename, template_bank, sweeps, thresholds, start, rate):
+    """
+    @param filename: The .npz file to write
+    @param template_bank: The TemplateBank of the calls
+    @param sweeps: The PeakSweep of every call in bank order
+    @param thresholds: The thresholds in standard deviations
+    @param start: The time of the first sample of the input
+    @param rate: The sampling rate of the input
+    """
+    writer = DetectionWriter(start=start, rate=rate)
+    for name, sweep in zip(template_bank.names, sweeps):
+        writer.add_sweep(name, thresholds, sweep, sweep.sweep(thresholds))
+    writer.save(filename)
+
+
+def recall_loss(full_filename, cascade_filename):
+    """
+    Scores both runs against "Actual Results" in the same way as check_results.py does with FAST_SCORING.
+
+    @param full_filename: The .npz file of the full pass
+    @param cascade_filename: The .npz file of the cascade
+    @return: The mean and largest drop in true positive rate over every bird and threshold, and the mean change in
+    false alarm rate
+    """
+    full = dict(score_detections(full_filename))
+    cascade = dict(score_detections(cascade_filename))
+    recall = []
+    false_alarms = []
+    for bird_name in full:
+        recall.append(full[bird_name]["True Positive Rate"].values - cascade[bird_name]["True Positive Rate"].values)
+        false_alarms.append(cascade[bird_name]["False Alarm Rate"].values - full[bird_name]["False Alarm Rate"].values)
+    recall = np.concatenate(recall).astype(np.float64)
+    false_alarms = np.concatenate(false_alarms).astype(np.float64)
+    return float(recall.mean()), float(recall.max()), float(false_alarms.mean())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the coarse-to-fine cascade with the full correlation over "
+                                                 "a range of screening thresholds")
+    parser.add_argument("run_name", help="The name of the run. The cascade runs are named after it and the threshold")
+    parser.add_argument("--inputs", default="Input Signals/*.wav", help="A glob of the input signals")
+    parser.add_argument("--calls", default="Test Bird Calls/*", help="A glob of the known bird calls")
+    parser.add_argument("--output", default="Detected Peaks", help="The folder to write the detections to")
+    parser.add_argument("--screen-thresholds", type=float, nargs="+", default=DEFAULT_SCREEN_THRESHOLDS,
+                        help="The screening thresholds to try, in standard deviations of the coarse envelope")
+    parser.add_argument("--factor", type=int, default=SCREEN_FACTOR, help="How much the screening pass decimates by")
+    parser.add_argument("--start", default=DEFAULT_START.isoformat(),
+                        help="The time of the first sample of every input, in ISO format")
+    parser.add_argument("--report", default=None, help="A JSON file to write the comparison to")
+    args = parser.parse_args()
+
+    start = datetime.datetime.strptime(args.start, "%Y-%m-%dT%H:%M:%S")
+    template_bank = TemplateBank(sorted(glob(args.calls)))
+    screening_bank = ScreeningBank(template_bank, args.factor)
+    has_truth = os.path.isdir("Actual Results")
+    report = []
+
+    for input_filename in sorted(glob(args.inputs)):
+        fs, inputSignal = wavfile.read(input_filename, mmap=True)
+        if inputSignal.ndim > 1:
+            inputSignal = inputSignal[:, 0]
+
+        started = time.perf_counter()
+        # A bank of its own, so the spectra of the full-length FFT are not kept through the cascade
+        sweeps = full_sweeps(TemplateBank(template_bank.filenames), inputSignal, fs)
+        full_seconds = time.perf_counter() - started
+        full_filename = args.output + "/" + run_directory(input_filename, args.run_name) + ".npz"
+        save_sweeps(full_filename, template_bank, sweeps, DEFAULT_THRESHOLDS, start, fs)
+
+        for screen_threshold in args.screen_thresholds:
+            started = time.perf_counter()
+            sweeps, skipped = cascade_sweeps(template_bank, screening_bank, inputSignal, fs, screen_threshold)
+            seconds = time.perf_counter() - started
+            cascade_filename = (args.output + "/" +
+                                run_directory(input_filename, args.run_name + " screen %g" % screen_threshold) + ".npz")
+            save_sweeps(cascade_filename, template_bank, sweeps, DEFAULT_THRESHOLDS, start, fs)
+
+            row = {"input": input_filename, "screen_threshold": screen_threshold, "skipped_fraction": skipped,
+                   "seconds": seconds, "full_seconds": full_seconds}
+            if has_truth:
+                row["mean_recall_loss"], row["max_recall_loss"], row["mean_false_alarm_change"] = \
+                    recall_loss(full_filename, cascade_filename)
+            report.append(row)
+            print(os.path.basename(input_filename) + " screened at %g std: skipped %.1f%% of the correlation, "
+                  "%.2f seconds against %.2f for the full pass" % (screen_threshold, 100 * skipped, seconds,
+                                                                  full_seconds) +
+                  (", recall loss %.4f mean %.4f max" % (row["mean_recall_loss"], row["max_recall_loss"])
+                   if has_truth else ""))
+
+    if args.report is not None:
+        with open(args.report, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+    print("finished it!")
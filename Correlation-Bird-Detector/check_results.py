@@ -1,22 +1,222 @@
+import argparse
+import hashlib
+import io
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
 import pandas as pd
 from glob import glob
-from pandas.io.common import EmptyDataError
+from pandas.errors import EmptyDataError
+
+from batch_runner import threshold_mode_of
+from peak_io import load_detections
+from scoring import COLUMNS, TIMESTAMP_FORMAT, TOLERANCE, TOTAL_EVENTS, area_under_curve, score_bird, to_offsets, \
+    truth_offsets
 
-all_tests = glob("Detected Peaks/*")
+DETECTED_DIRECTORY = "Detected Peaks"
+ACTUAL_DIRECTORY = "Actual Results"
+ROC_DIRECTORY = "ROC Data"
+# Every run's ROC table in one file, the area under each curve, and the hashes the tables were scored from
+ROC_TABLE = "ROC.csv"
+AUC_TABLE = "AUC.csv"
+CACHE_INDEX = "score_cache.csv"
+RUN_COLUMNS = ["Run", "SNR", "Threshold Mode"]
 
-# DO NOT set tolerance to an integer! Use
-TOLERANCE = 3.0
-TOTAL_EVENTS = 600
+# Score every threshold of a bird at once with scoring.score_bird. Set to False to use score_threshold instead
+FAST_SCORING = True
+# Only let a detection match a single call (fast scoring only)
+ONE_TO_ONE = False
 
-columns = ["Bird", "Threshold (# std)", "True Positives", "False Positives", "True Negatives", "False Negatives",
-           "False Alarm Rate", "True Positive Rate"]
+columns = COLUMNS
 results = pd.DataFrame(columns=columns)
 
-for testName in all_tests:
-    print("Testing " + testName + "...")
-    snr_folder_name = testName.split("/")[-1]
+# The ground truth of every bird, parsed once and shared with the worker processes
+_actual_calls = {}
+
+
+def read_csv_tests(bird_directory):
+    """
+    @param bird_directory: A folder of csv files named after the threshold they were detected at, each starting with
+    the start of the recording as the reference row
+    @return: A generator of (threshold, detected timestamps) pairs. The timestamps are None if the file is empty
+    """
+    # The names of the files in the bird's directory will be their threshold
+    threshold_tests = glob(bird_directory + "/*")
+
+    for threshold_test in threshold_tests:
+        # Get the threshold from the filename
+        threshold = threshold_test.split("/")[-1]
+        threshold = threshold.split(".csv")[0]
+
+        # There is a chance that the csv will be empty (if no detections were made)
+        try:
+            detected_peaks = pd.read_csv(threshold_test, header=None)
+            detected_peaks = detected_peaks.dropna(how="any")
+            if len(detected_peaks) == 0:
+                raise EmptyDataError
+        except EmptyDataError:
+            yield threshold, None
+            continue
+
+        yield threshold, pd.to_datetime(detected_peaks[detected_peaks.columns[0]], format=TIMESTAMP_FORMAT)
+
+
+def read_npz_tests(detections, tested, start, bird_name):
+    """
+    @param detections: The detections of a run, as returned by peak_io.load_detections
+    @param tested: Every bird and threshold of the run, as returned by peak_io.load_detections
+    @param start: The time the recording started
+    @param bird_name: The bird to read the detections of
+    @return: A generator of (threshold, detected timestamps) pairs. The timestamps are None if nothing was detected
+    """
+    groups = detections.groupby(["Bird", "Threshold"], observed=True)["Timestamp"]
+
+    for threshold in tested.loc[tested["Bird"] == bird_name, "Threshold"]:
+        try:
+            timestamps = groups.get_group((bird_name, threshold)).values
+        except KeyError:
+            yield str(threshold), None
+            continue
+
+        # The start of the recording goes first as the reference time, as in the csv files written by MATLAB
+        yield str(threshold), pd.Series(np.concatenate(([np.datetime64(start, "ns")], timestamps.astype("datetime64[ns]"))))
+
+
+def _rate(count, total):
+    """
+    @param count: The number of events counted
+    @param total: The number of events they were counted out of
+    @return: count / total, or NaN if there were no events, as scoring.score_bird gives
+    """
+    if total == 0:
+        return float("nan")
+    return float(count) / float(total)
+
+
+def score_threshold(bird_name, threshold, detected_peaks, actual_calls_df, reference_is_detection=True):
+    """
+    @param bird_name: The name of the bird
+    @param threshold: The threshold the detections were made at
+    @param detected_peaks: A Series of detected timestamps whose first row is the start of the recording, or None
+    @param actual_calls_df: The actual calls of the bird, read from "Actual Results"
+    @param reference_is_detection: Whether the first row of detected_peaks is also a detection, as the first version
+    of this script counted it. Every layout scored by score_run starts with a separate reference row
+    @return: A row of the results table
+    """
+    true_positive = false_positive = true_negative = false_negative = 0
+
+    if detected_peaks is None:
+        # Every call but the reference row was missed
+        false_negative = len(actual_calls_df) - 1
+        true_negative = TOTAL_EVENTS - false_negative - true_positive - false_positive
+
+        # Calculate true positive rate and false alarm rate
+        TPR = _rate(true_positive, true_positive + false_negative)
+        FAR = _rate(false_positive, false_positive + true_negative)
+        return [bird_name, threshold, true_positive, false_positive, true_negative, false_negative, FAR, TPR]
+
+    actual_calls = pd.to_datetime(actual_calls_df[actual_calls_df.columns[0]], format=TIMESTAMP_FORMAT)
 
-    birds = glob(testName + "/*")
+    # The first timestamp is a reference for when the recording started (t=0).
+    # Use this to line up the timestamps
+    time_diff = detected_peaks.iloc[0] - actual_calls[0]
+    actual_calls = actual_calls + time_diff
+
+    # Delete the reference times (first row)
+    actual_calls = actual_calls[1:]
+    detected_peaks = detected_peaks.iloc[1:]
+
+    for timestamp in actual_calls:
+        start_date = timestamp - pd.Timedelta(seconds=TOLERANCE/2)
+        end_date = timestamp + pd.Timedelta(seconds=TOLERANCE/2)
+
+        mask = (detected_peaks > start_date) & (detected_peaks < end_date)
+        masked_times = detected_peaks.loc[mask]
+
+        if len(masked_times) >= 1:
+            true_positive = true_positive + 1
+        else:
+            false_negative = false_negative + 1
+
+    false_positive = len(detected_peaks) - true_positive
+    if reference_is_detection:
+        false_positive = false_positive + 1
+    true_negative = TOTAL_EVENTS - true_positive - false_positive - false_negative
+
+    if true_negative < 0:
+        print("Impossible results! True negative was " + str(true_negative))
+        true_negative = 0
+    if false_positive < 0:
+        print("Impossible results! False positive was " + str(false_positive))
+        false_positive = 0
+
+    # if true_negative < 0:
+    #     raise ValueError("Impossible results! True negative was " + str(true_negative))
+    # if false_positive < 0:
+    #     raise ValueError("Impossible results! False positive was " + str(false_positive))
+
+    # Calculate true positive rate and false alarm rate
+    TPR = _rate(true_positive, true_positive + false_negative)
+    FAR = _rate(false_positive, false_positive + true_negative)
+    return [bird_name, threshold, true_positive, false_positive, true_negative, false_negative, FAR, TPR]
+
+
+def read_actual_calls(bird_name):
+    """
+    @param bird_name: The name of the bird
+    @return: The actual calls of the bird from "Actual Results", whose first row is the reference time
+    """
+    if bird_name not in _actual_calls:
+        _actual_calls[bird_name] = pd.read_csv(ACTUAL_DIRECTORY + "/" + bird_name + ".csv", header=None)
+    return _actual_calls[bird_name]
+
+
+def score_tests(bird_name, threshold_tests, actual_calls_df, reference_is_detection=True):
+    """
+    @param bird_name: The name of the bird
+    @param threshold_tests: A list of (threshold, detected timestamps) pairs, as from read_csv_tests or read_npz_tests
+    @param actual_calls_df: The actual calls of the bird, read from "Actual Results"
+    @param reference_is_detection: Whether the first row of the detected timestamps is also a detection
+    @return: The results table of the bird with a row for every threshold
+    """
+    if FAST_SCORING:
+        threshold_tests = list(threshold_tests)
+
+        detected_times = []
+        extra_detections = []
+        for threshold, detected_peaks in threshold_tests:
+            if detected_peaks is None:
+                detected_times.append(np.zeros(0, dtype=np.int64))
+                extra_detections.append(0)
+            else:
+                detected_times.append(to_offsets(detected_peaks))
+                extra_detections.append(1 if reference_is_detection else 0)
+
+        return score_bird(bird_name, [threshold for threshold, _ in threshold_tests], truth_offsets(actual_calls_df),
+                          detected_times, TOTAL_EVENTS, TOLERANCE, extra_detections=extra_detections,
+                          one_to_one=ONE_TO_ONE)
+
+    results = pd.DataFrame(columns=columns)
+    for threshold, detected_peaks in threshold_tests:
+        results.loc[len(results)] = score_threshold(bird_name, threshold, detected_peaks, actual_calls_df,
+                                                    reference_is_detection=reference_is_detection)
+    return results
+
+
+def score_run(testName, bird_names=None):
+    """
+    @param testName: A run in "Detected Peaks", either an .npz file or a folder of csv files per bird and threshold
+    @param bird_names: The birds to score. Every bird of the run if None
+    @return: A generator of (bird name, results table) pairs for every bird of the run
+    """
+    # A run is either an .npz file of every detection or a folder of csv files per bird and threshold
+    if testName.endswith(".npz"):
+        detections, tested, start, rate = load_detections(testName)
+        birds = list(tested["Bird"].cat.categories)
+    else:
+        birds = glob(testName + "/*")
 
     # # Find every second which the detector has an occurance
     # combined_actual = pd.DataFrame()
@@ -37,18 +237,15 @@ for testName in all_tests:
     # TOTAL_EVENTS = seconds_of_occurrences.nunique()
 
     for bird_directory in birds:
-        results = pd.DataFrame(columns=columns)
-
         csv_file_name = bird_directory.split("/")[-1]
         actual_calls_filename = csv_file_name.split("--")[-1] + ".csv"
         bird_name = actual_calls_filename.split(".csv")[0]
+        if bird_names is not None and bird_name not in bird_names:
+            continue
 
         print("Checking " + bird_name + "...")
 
-        actual_calls_df = pd.read_csv("Actual Results/" + actual_calls_filename, header=None)
-
-        # The names of the files in the bird's directory will be their threshold
-        threshold_tests = glob(bird_directory + "/*")
+        actual_calls_df = read_actual_calls(bird_name)
 
         # # The test with 0 stds will contain all the peaks present in the signal. We need that info
         # try:
@@ -60,75 +257,214 @@ for testName in all_tests:
 
         # TOTAL_EVENTS = len(all_peaks)
 
-        for threshold_test in threshold_tests:
+        if testName.endswith(".npz"):
+            threshold_tests = read_npz_tests(detections, tested, start, bird_directory)
+        else:
+            threshold_tests = read_csv_tests(bird_directory)
+
+        # Both layouts are scored against the start of the recording, which is not a detection
+        yield bird_name, score_tests(bird_name, threshold_tests, actual_calls_df, reference_is_detection=False)
+
+
+
+def hash_bytes(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def hash_run(path):
+    """
+    @param path: An .npz run, or the folder of csv files of one bird of a csv run
+    @return: The hash of the detections' contents. A folder's hash covers the name and contents of every file in it
+    """
+    digest = hashlib.sha1()
+    filenames = [path] if os.path.isfile(path) else sorted(glob(path + "/*"))
+    for filename in filenames:
+        digest.update(os.path.basename(filename).encode("utf-8") + b"\0")
+        with open(filename, "rb") as run_file:
+            for block in iter(lambda: run_file.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def settings_key():
+    # Scores made with other settings cannot be reused. The csv runs used to count their first row as a detection
+    return "tolerance=%r events=%r fast=%r one_to_one=%r reference=start" % (TOLERANCE, TOTAL_EVENTS, FAST_SCORING,
+                                                                            ONE_TO_ONE)
 
-            true_positive = false_positive = true_negative = false_negative = 0
 
-            # Get the threshold from the filename
-            threshold = threshold_test.split("/")[-1]
-            threshold = threshold.split(".csv")[0]
+def list_tests(directory=DETECTED_DIRECTORY):
+    """
+    @param directory: The folder the runs are saved in
+    @return: Every run in it, leaving out the history logs and indices of the microphone mode
+    """
+    return sorted(path for path in glob(directory + "/*")
+                  if os.path.isdir(path) or (path.endswith(".npz") and not path.endswith(".index.npz")))
 
-            # There is a chance that the csv will be empty (if no detections were made)
+
+def run_birds(testName):
+    """
+    @param testName: A run in "Detected Peaks"
+    @return: A list of (bird name, path to hash) for every bird of the run. The birds of an .npz run all share the file
+    """
+    if testName.endswith(".npz"):
+        with np.load(testName) as data:
+            return [(str(bird_name), testName) for bird_name in data["birds"]]
+    return [(bird_directory.split("/")[-1].split("--")[-1], bird_directory)
+            for bird_directory in sorted(glob(testName + "/*"))]
+
+
+def snr_of(run_name):
+    """
+    @param run_name: The name of a run, e.g. "Correlation 10dB 2024-01-01 12:00:00" or "Wavelet 10.00dB ..."
+    @return: The SNR of its input in dB, or NaN if the name does not have one
+    """
+    for word in run_name.split(" "):
+        if word.endswith("dB"):
             try:
-                detected_peaks = pd.read_csv(threshold_test, header=None)
-                detected_peaks = detected_peaks.dropna(how="any")
-                if len(detected_peaks) is 0:
-                    raise EmptyDataError
-            except EmptyDataError:
-                false_negative = len(actual_calls_df)
-                true_negative = TOTAL_EVENTS - false_negative - true_positive - false_positive
-
-                # Calculate true positive rate and false alarm rate
-                TPR = float(true_positive) / float(true_positive + false_negative)
-                FAR = float(false_positive) / float(false_positive + true_negative)
-                results.loc[len(results)] = [bird_name, threshold, true_positive, false_positive, true_negative, false_negative, TPR, FAR]
-                continue
-
-            detected_peaks[detected_peaks.columns[0]] = pd.to_datetime(detected_peaks[detected_peaks.columns[0]],
-                                                                       format="%Y-%m-%dT%H:%M:%S.%f")
-            actual_calls = pd.to_datetime(actual_calls_df[actual_calls_df.columns[0]], format="%Y-%m-%dT%H:%M:%S.%f")
-
-            # The first timestamp is a reference for when the recording started (t=0).
-            # Use this to line up the timestamps
-            time_diff = detected_peaks[detected_peaks.columns[0]].iloc[0] - actual_calls[0]
-            actual_calls = actual_calls + time_diff
-
-            # Delete the reference times (first row)
-            actual_calls = actual_calls[1:]
-            detected_peaks = detected_peaks.iloc[1:]
-
-            for timestamp in actual_calls:
-                start_date = timestamp - pd.Timedelta(seconds=TOLERANCE/2)
-                end_date = timestamp + pd.Timedelta(seconds=TOLERANCE/2)
-
-                mask = (detected_peaks[detected_peaks.columns[0]] > start_date) & (detected_peaks[detected_peaks.columns[0]] < end_date)
-                masked_times = detected_peaks.loc[mask]
-
-                if len(masked_times) >= 1:
-                    true_positive = true_positive + 1
-                else:
-                    false_negative = false_negative + 1
-
-            false_positive = len(detected_peaks) - true_positive + 1
-            true_negative = TOTAL_EVENTS - true_positive - false_positive - false_negative
-
-            if true_negative < 0:
-                print("Impossible results! True negative was " + str(true_negative))
-                true_negative = 0
-            if false_positive < 0:
-                print("Impossible results! False positive was " + str(false_positive))
-                false_positive = 0
-
-            # if true_negative < 0:
-            #     raise ValueError("Impossible results! True negative was " + str(true_negative))
-            # if false_positive < 0:
-            #     raise ValueError("Impossible results! False positive was " + str(false_positive))
-
-            # Calculate true positive rate and false alarm rate
-            TPR = float(true_positive) / float(true_positive + false_negative)
-            FAR = float(false_positive) / float(false_positive + true_negative)
-            results.loc[len(results)] = [bird_name, threshold, true_positive, false_positive, true_negative, false_negative, FAR, TPR]
-
-        results.to_csv("ROC Data/" + bird_name + ".csv", index=False)
+                return float(word[:-2])
+            except ValueError:
+                pass
+    return float("nan")
+
+
+def load_truth(bird_names):
+    """
+    Reads the ground truth of every bird once, both to hash it and to parse it.
+
+    @param bird_names: The birds to read
+    @return: A dictionary of the hash of every bird's ground truth
+    """
+    hashes = {}
+    for bird_name in bird_names:
+        with open(ACTUAL_DIRECTORY + "/" + bird_name + ".csv", "rb") as actual_file:
+            data = actual_file.read()
+        hashes[bird_name] = hash_bytes(data)
+        _actual_calls[bird_name] = pd.read_csv(io.BytesIO(data), header=None)
+    return hashes
+
+
+def _init_worker(actual_calls):
+    _actual_calls.clear()
+    _actual_calls.update(actual_calls)
+
+
+def _score_job(testName, bird_names):
+    return testName, list(score_run(testName, bird_names))
+
+
+def _read_table(filename, columns):
+    if os.path.exists(filename):
+        # Thresholds are kept as the strings they were scored under, as a freshly scored table has them
+        return pd.read_csv(filename, dtype={"Run": str, "Bird": str, "Threshold (# std)": str})
+    return pd.DataFrame(columns=columns)
+
+
+def evaluate(directory=DETECTED_DIRECTORY, roc_directory=ROC_DIRECTORY, workers=None, rescore=False):
+    """
+    Scores every run in directory into one ROC table, reusing the scores of every (run, bird) whose detections,
+    ground truth and scoring settings hash the same as when it was last scored. The runs left to score are scored
+    in parallel, one process per run.
+
+    @param directory: The folder the runs are saved in
+    @param roc_directory: The folder to write the ROC table, the AUC table and the cache index to
+    @param workers: The number of processes. One per core by default, and 1 scores in this process
+    @param rescore: Whether to ignore the cache and score everything again
+    @return: The ROC table and the AUC table
+    """
+    table_columns = RUN_COLUMNS + COLUMNS
+    index_columns = ["Run", "Bird", "Detections Hash", "Truth Hash", "Settings"]
+    roc_filename = os.path.join(roc_directory, ROC_TABLE)
+    index_filename = os.path.join(roc_directory, CACHE_INDEX)
+
+    cached_table = _read_table(roc_filename, table_columns)
+    cached_index = _read_table(index_filename, index_columns)
+    if rescore:
+        cached_index = cached_index.iloc[:0]
+    cached_keys = dict((tuple(row[:2]), tuple(row[2:])) for row in cached_index[index_columns].itertuples(index=False))
+
+    tests = list_tests(directory)
+    birds = dict((testName, run_birds(testName)) for testName in tests)
+    truth_hashes = load_truth(sorted(set(bird_name for pairs in birds.values() for bird_name, path in pairs)))
+    settings = settings_key()
+
+    index_rows = []
+    keep = set()
+    jobs = []
+    run_hashes = {}
+    for testName in tests:
+        run_name = os.path.basename(testName)
+        stale = []
+        for bird_name, path in birds[testName]:
+            if path not in run_hashes:
+                run_hashes[path] = hash_run(path)
+            key = (run_hashes[path], truth_hashes[bird_name], settings)
+            index_rows.append([run_name, bird_name] + list(key))
+            if cached_keys.get((run_name, bird_name)) == key:
+                keep.add((run_name, bird_name))
+            else:
+                stale.append(bird_name)
+        if stale:
+            jobs.append((testName, stale))
+
+    print("Reusing %d cached scores, scoring %d birds in %d runs" %
+          (len(keep), sum(len(stale) for testName, stale in jobs), len(jobs)))
+    start_time = time.time()
+
+    tables = []
+    if len(cached_table):
+        reused = [(run_name, bird_name) in keep for run_name, bird_name in zip(cached_table["Run"],
+                                                                                cached_table["Bird"])]
+        tables.append(cached_table.loc[reused, table_columns])
+
+    def finish(testName, scored):
+        run_name = os.path.basename(testName)
+        print("Scored " + run_name)
+        for bird_name, bird_results in scored:
+            bird_results = bird_results.copy()
+            bird_results.insert(0, "Threshold Mode", threshold_mode_of(run_name))
+            bird_results.insert(0, "SNR", snr_of(run_name))
+            bird_results.insert(0, "Run", run_name)
+            tables.append(bird_results)
+
+    if workers == 1 or len(jobs) <= 1:
+        for testName, stale in jobs:
+            finish(*_score_job(testName, stale))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(dict(_actual_calls),)) as executor:
+            futures = [executor.submit(_score_job, testName, stale) for testName, stale in jobs]
+            for future in as_completed(futures):
+                finish(*future.result())
+    print("--- Scoring took %s seconds ---" % (time.time() - start_time))
+
+    # Runs and birds are kept in a fixed order, so the table does not depend on which job finished first
+    roc_table = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=table_columns)
+    roc_table = roc_table.sort_values(["Run", "Bird"], kind="stable").reset_index(drop=True)
+
+    auc_rows = []
+    for (run_name, bird_name), bird_results in roc_table.groupby(["Run", "Bird"], sort=True):
+        auc_rows.append([run_name, bird_results["SNR"].iloc[0], bird_results["Threshold Mode"].iloc[0], bird_name,
+                         area_under_curve(bird_results["False Alarm Rate"], bird_results["True Positive Rate"])])
+    auc_table = pd.DataFrame(auc_rows, columns=RUN_COLUMNS + ["Bird", "AUC"])
+
+    if not os.path.isdir(roc_directory):
+        os.makedirs(roc_directory)
+    roc_table.to_csv(roc_filename, index=False)
+    auc_table.to_csv(os.path.join(roc_directory, AUC_TABLE), index=False)
+    # The index is written last, so an interrupted run is scored again rather than trusted
+    pd.DataFrame(index_rows, columns=index_columns).to_csv(index_filename, index=False)
+    return roc_table, auc_table
+
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scores every run in \"Detected Peaks\" against \"Actual Results\"")
+    parser.add_argument("--detected", default=DETECTED_DIRECTORY, help="The folder the runs are saved in")
+    parser.add_argument("--output", default=ROC_DIRECTORY, help="The folder to write the ROC and AUC tables to")
+    parser.add_argument("--workers", type=int, default=None, help="The number of processes, one per core by default")
+    parser.add_argument("--rescore", action="store_true", help="Ignore the cache and score every run again")
+    args = parser.parse_args()
 
+    roc_table, auc_table = evaluate(args.detected, args.output, workers=args.workers, rescore=args.rescore)
+    for run_name, run_auc in auc_table.groupby("Run", sort=True):
+        print(run_name + ": " + ", ".join("%s AUC %.4f" % (bird_name, area)
+                                           for bird_name, area in zip(run_auc["Bird"], run_auc["AUC"])))
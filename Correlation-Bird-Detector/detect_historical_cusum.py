@@ -1,3 +1,20 @@
+import math
+from collections import deque
+
+import numpy as np
+
+NO_CHANGE = 0
+CHANGE_UP = 1
+CHANGE_DOWN = -1
+NOT_ENOUGH_DATA = -2
+
+MESSAGES = {
+    NOT_ENOUGH_DATA: "Not enough data to detect change ",
+    NO_CHANGE: "--- No change detected ",
+    CHANGE_UP: "--- Change detected! Average calls went up ",
+    CHANGE_DOWN: "--- Change detected! Average calls went down ",
+}
+
 
 def detect_historical_cusum(detections, look_back, threshold, weights=None, look_back_mean=None):
     """
@@ -8,6 +25,8 @@ def detect_historical_cusum(detections, look_back, threshold, weights=None, look
     @param threshold: The threshold value of
     @return: A declaration of whether change had been detected
     """
+    # Index by position even if the counts are a Series indexed by date
+    detections = np.asarray(detections)
 
     # If we don't have enough historical data, we cannot make a judgement on whether change was detected
     if len(detections) < look_back:
@@ -38,5 +57,146 @@ def detect_historical_cusum(detections, look_back, threshold, weights=None, look
     return False, "--- No change detected "
 
 
+def detect_cusum_matrix(counts, look_back, threshold, weights=None, look_back_mean=None):
+    """
+    Vectorised detect_historical_cusum for many species and days at once. Entry [s, t] is the result of
+    detect_historical_cusum(counts[s, :t + 1], ...), so the last column is the result on each full history.
+
+    @param counts: A (species, days) array of the call occurrences at each day
+    @param look_back: How many days the algorithm should look back
+    @param threshold: The threshold value of the sums
+    @param weights: An array the same size as look_back which determines how the cusum weights each sample
+    @param look_back_mean: How many days the algorithm should look back when calculating previous average
+    @return: A (species, days) array of CHANGE_UP, CHANGE_DOWN, NO_CHANGE or NOT_ENOUGH_DATA, and the positive and
+    negative sums
+    """
+    counts = np.atleast_2d(np.asarray(counts, dtype=np.float64))
+    n_species, n_days = counts.shape
+    if weights is not None and len(weights) < look_back:
+        raise ValueError("The weights array needs to be the same size as look_back. ")
+
+    # The mean of every prefix, or of the days from look_back_mean to look_back before its end, from cumulative sums
+    cumulative = np.zeros((n_species, n_days + 1))
+    np.cumsum(counts, axis=1, out=cumulative[:, 1:])
+    ends = np.arange(1, n_days + 1)
+    if look_back_mean is None:
+        starts = np.zeros(n_days, dtype=np.int64)
+        stops = ends
+    else:
+        starts = np.maximum(ends - look_back_mean, 0)
+        stops = np.maximum(ends - look_back, 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        lengths = (stops - starts).astype(np.float64)
+        lengths[lengths <= 0] = np.nan
+        previous_mean = (cumulative[:, stops] - cumulative[:, starts]) / lengths
+
+    cusum_pos = np.zeros((n_species, n_days))
+    cusum_neg = np.zeros((n_species, n_days))
+    # Add the days in the same order as detect_historical_cusum so the sums match exactly
+    for i in range(1, look_back):
+        recent = np.full((n_species, n_days), np.nan)
+        # A history shorter than i days has nothing to add
+        recent[:, i - 1:] = counts[:, :max(n_days - i + 1, 0)]
+        weight = 0 if weights is None else weights[i]
+
+        with np.errstate(invalid="ignore"):
+            cusum_pos += np.where(recent > previous_mean + weight, np.abs(recent - previous_mean), 0)
+            cusum_neg += np.where(recent < previous_mean - weight, np.abs(recent - previous_mean), 0)
+
+    changes = np.where(cusum_pos > threshold, CHANGE_UP, np.where(cusum_neg > threshold, CHANGE_DOWN, NO_CHANGE))
+    changes[:, :look_back - 1] = NOT_ENOUGH_DATA
+    return changes, cusum_pos, cusum_neg
+
+
+class OnlineCusum:
+    """
+    detect_historical_cusum kept up to date one day at a time. The reference mean and variance are running sums over
+    every day, or over a sliding window when look_back_mean is given, and only the last look_back - 1 days are kept
+    for the sums. An update therefore costs the same on the thousandth day as on the fifth.
+
+    With reset=False every update returns what detect_historical_cusum would on all of the days so far. With
+    reset=True the history is forgotten after a change is detected, so the new level becomes the reference.
+    """
+
+    def __init__(self, look_back, threshold, weights=None, look_back_mean=None, reset=False):
+        """
+        @param look_back: How many days the algorithm should look back
+        @param threshold: The threshold value of the sums
+        @param weights: An array the same size as look_back which determines how the cusum weights each sample
+        @param look_back_mean: How many days the algorithm should look back when calculating previous average
+        @param reset: Whether to forget the history after a change is detected
+        """
+        if weights is not None and len(weights) < look_back:
+            raise ValueError("The weights array needs to be the same size as look_back. ")
+        self.look_back = look_back
+        self.threshold = threshold
+        self.weights = weights
+        self.look_back_mean = look_back_mean
+        self.reset = reset
+        self.clear()
+
+    def clear(self):
+        self.days = 0
+        self.cusum_pos = self.cusum_neg = 0
+        # Every count still needed: the recent days and, with look_back_mean, the reference window before them
+        self._kept = deque(maxlen=max(self.look_back, (self.look_back_mean or 0) + 1))
+        self._count = 0
+        self._sum = 0.0
+        self._sum_squares = 0.0
+
+    def _add_reference(self, value, sign):
+        self._count += sign
+        self._sum += sign * value
+        self._sum_squares += sign * value * value
+
+    @property
+    def mean(self):
+        return self._sum / self._count if self._count > 0 else float("nan")
+
+    @property
+    def std(self):
+        if self._count <= 0:
+            return float("nan")
+        return math.sqrt(max(self._sum_squares / self._count - self.mean ** 2, 0.0))
+
+    def update(self, count):
+        """
+        @param count: The number of calls on the next day
+        @return: Whether change was detected and a message, as returned by detect_historical_cusum
+        """
+        count = float(count)
+        self.days += 1
+        self._kept.append(count)
+
+        if self.look_back_mean is None:
+            self._add_reference(count, 1)
+        elif self.look_back_mean > self.look_back:
+            # The reference window is detections[-look_back_mean:-look_back]. One day enters it and one leaves
+            if self.days > self.look_back:
+                self._add_reference(self._kept[-(self.look_back + 1)], 1)
+            if self.days > self.look_back_mean:
+                self._add_reference(self._kept[-(self.look_back_mean + 1)], -1)
+
+        if self.days < self.look_back:
+            return False, MESSAGES[NOT_ENOUGH_DATA]
+
+        previous_mean = self.mean
+        self.cusum_pos = self.cusum_neg = 0
+        for i in range(1, self.look_back):
+            value = self._kept[-i]
+            weight = 0 if self.weights is None else self.weights[i]
+            if value > previous_mean + weight:
+                self.cusum_pos += abs(value - previous_mean)
+            if value < previous_mean - weight:
+                self.cusum_neg += abs(value - previous_mean)
 
+        if self.cusum_pos > self.threshold:
+            change = CHANGE_UP
+        elif self.cusum_neg > self.threshold:
+            change = CHANGE_DOWN
+        else:
+            change = NO_CHANGE
 
+        if change != NO_CHANGE and self.reset:
+            self.clear()
+        return change != NO_CHANGE, MESSAGES[change]
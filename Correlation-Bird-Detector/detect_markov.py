@@ -1,27 +1,124 @@
-import pymc as pm
-import matplotlib.pyplot as plt
+import argparse
+
 import numpy as np
-import matplotlib.ticker as plticker
 import pandas as pd
+from scipy.special import gammaln
+
+from history_store import HistoryStore
 
 THRESHOLD = 0.05
+SAMPLES = 40000
+BURN = 10000
+BINS = 50
 
-def detect_markov(filename):
-    historical_peaks = pd.read_csv(filename)
-    historical_peaks[historical_peaks.columns[0]] = pd.to_datetime(historical_peaks[historical_peaks.columns[0]],
-                                                                   format="%Y-%m-%dT%H:%M:%S.%f")
 
-    # Count how many occurrences happened for each day
-    daily_counts = historical_peaks[historical_peaks.columns[0]].dt.normalize().value_counts()
+class ChangepointPosterior:
+    """
+    The exact posterior of the single changepoint model: the daily counts before tau are Poisson(lambda_1) and the
+    counts from tau on are Poisson(lambda_2), with Exponential(alpha) priors on both rates and tau uniform on 0..n.
 
-    count_data = daily_counts.values
-    n_count_data = len(count_data)
-    plt.bar(np.arange(n_count_data), count_data, color="#348ABD")
-    plt.xlabel("Time (min)")
-    plt.ylabel("Count of calls")
-    plt.xlim(0, n_count_data);
-    plt.savefig("bird_count.pdf", format="pdf", bbox_inches="tight")
+    The Exponential prior is Gamma(1, alpha), which is conjugate to the Poisson. Integrating the rates out leaves a
+    closed form for the probability of every tau, and given tau each rate is Gamma distributed again. Cumulative sums
+    give the counts on either side of every tau, so the whole posterior costs O(n) instead of an MCMC run.
+    """
+
+    def __init__(self, count_data, alpha=None):
+        """
+        @param count_data: The number of calls on each day, in date order
+        @param alpha: The rate of the Exponential priors. 1 / mean(count_data) by default, as in the MCMC model
+        """
+        count_data = np.asarray(count_data, dtype=np.float64)
+        n_count_data = len(count_data)
+        if alpha is None:
+            alpha = 1.0 / count_data.mean()
+        self.alpha = alpha
+        self.taus = np.arange(n_count_data + 1)
+
+        before = np.concatenate(([0.0], np.cumsum(count_data)))
+        after = before[-1] - before
+        self.shape_1 = 1.0 + before
+        self.rate_1 = alpha + self.taus
+        self.shape_2 = 1.0 + after
+        self.rate_2 = alpha + (n_count_data - self.taus)
+
+        # The factorials of the counts are the same for every tau and cancel out
+        log_probability = (gammaln(self.shape_1) - self.shape_1 * np.log(self.rate_1) +
+                           gammaln(self.shape_2) - self.shape_2 * np.log(self.rate_2))
+        probability = np.exp(log_probability - log_probability.max())
+        self.tau_probability = probability / probability.sum()
+
+    def tau_mean(self):
+        return float(np.dot(self.tau_probability, self.taus))
+
+    def lambda_means(self):
+        """
+        @return: The posterior means of lambda_1 and lambda_2
+        """
+        return (float(np.dot(self.tau_probability, self.shape_1 / self.rate_1)),
+                float(np.dot(self.tau_probability, self.shape_2 / self.rate_2)))
+
+    def sample(self, samples=SAMPLES, random_state=None):
+        """
+        Independent draws from the joint posterior: tau from its exact distribution, then each rate from its Gamma
+        distribution given tau.
+
+        @param samples: The number of draws
+        @param random_state: A seed or np.random.RandomState
+        @return: Arrays of the lambda_1, lambda_2 and tau draws
+        """
+        if not isinstance(random_state, np.random.RandomState):
+            random_state = np.random.RandomState(random_state)
+        tau_samples = random_state.choice(self.taus, size=samples, p=self.tau_probability)
+        lambda_1_samples = random_state.gamma(self.shape_1[tau_samples], 1.0 / self.rate_1[tau_samples])
+        lambda_2_samples = random_state.gamma(self.shape_2[tau_samples], 1.0 / self.rate_2[tau_samples])
+        return lambda_1_samples, lambda_2_samples, tau_samples
+
+    def overlap_area(self, points=2000):
+        """
+        @param points: The number of points the densities are evaluated at
+        @return: The area shared by the posterior densities of lambda_1 and lambda_2, from 0 (certain change) to 1
+        """
+        means = np.concatenate((self.shape_1 / self.rate_1, self.shape_2 / self.rate_2))
+        stds = np.sqrt(np.concatenate((self.shape_1, self.shape_2))) / np.concatenate((self.rate_1, self.rate_2))
+        grid = np.linspace(0, (means + 10 * stds).max(), points)
+
+        def density(shape, rate):
+            log_grid = np.log(np.maximum(grid, np.finfo(np.float64).tiny))
+            log_pdf = (shape[:, None] * np.log(rate[:, None]) - gammaln(shape[:, None]) +
+                       (shape[:, None] - 1) * log_grid[None, :] - rate[:, None] * grid[None, :])
+            return np.dot(self.tau_probability, np.exp(log_pdf))
+
+        shared = np.minimum(density(self.shape_1, self.rate_1), density(self.shape_2, self.rate_2))
+        return float(np.sum((shared[1:] + shared[:-1]) / 2 * np.diff(grid)))
+
+
+def histogram_overlap(lambda_1_samples, lambda_2_samples, bins=BINS):
+    """
+    @param lambda_1_samples: Draws of lambda_1
+    @param lambda_2_samples: Draws of lambda_2
+    @param bins: The number of histogram bins
+    @return: The sum over the bins of the smaller of the two histogram densities
+    """
+    combined_samples = np.append(lambda_1_samples, lambda_2_samples)
+    value_range = [combined_samples.min(), combined_samples.max()]
+
+    hist_lambda_1 = np.histogram(lambda_1_samples, bins=bins, density=True, range=value_range)
+    hist_lambda_2 = np.histogram(lambda_2_samples, bins=bins, density=True, range=value_range)
+    return np.minimum(hist_lambda_1[0], hist_lambda_2[0]).sum()
+
+
+def sample_pymc(count_data, samples=SAMPLES, burn=BURN):
+    """
+    The original MCMC fit of the model, kept to cross-check ChangepointPosterior. Needs PyMC 2.
 
+    @param count_data: The number of calls on each day, in date order
+    @param samples: The number of MCMC iterations
+    @param burn: The number of iterations discarded at the start
+    @return: Arrays of the lambda_1, lambda_2 and tau samples
+    """
+    import pymc as pm
+
+    n_count_data = len(count_data)
     alpha = 1.0 / count_data.mean()
     # Recall count_data is the variable that holds our txt counts
 
@@ -42,32 +139,100 @@ def detect_markov(filename):
 
     # Mysterious code to be explained in Chapter 3.
     mcmc = pm.MCMC(model)
-    mcmc.sample(40000, 10000, 1)
+    mcmc.sample(samples, burn, 1)
 
-    lambda_1_samples = mcmc.trace('lambda_1')[:]
-    lambda_2_samples = mcmc.trace('lambda_2')[:]
-    tau_samples = mcmc.trace('tau')[:]
+    return mcmc.trace('lambda_1')[:], mcmc.trace('lambda_2')[:], mcmc.trace('tau')[:]
 
-    combined_samples = np.append(lambda_1_samples, lambda_2_samples)
 
-    hist_lambda_1 = np.histogram(lambda_1_samples, bins=50, density=True, range=[combined_samples.min(), combined_samples.max()])
-    hist_lambda_2 = np.histogram(lambda_2_samples, bins=50, density=True, range=[combined_samples.min(), combined_samples.max()])
+def daily_counts_from_store(bird_name, store):
+    """
+    @param bird_name: The name of the bird
+    @param store: The HistoryStore of the detections, as read_audio.py writes it
+    @return: The number of detections on every day from the first to the last, in date order
+    """
+    daily_counts = store.daily_counts(bird_name)
+    if len(daily_counts) == 0:
+        return daily_counts
+    # The index only has the days with detections
+    return daily_counts.asfreq("D", fill_value=0)
+
+
+def daily_counts_from_csv(filename):
+    """
+    @param filename: A legacy historical csv of detection timestamps, as written before the HistoryStore
+    @return: The number of detections on every day from the first to the last, in date order
+    """
+    historical_peaks = pd.read_csv(filename, header=None)
+    timestamps = pd.to_datetime(historical_peaks[historical_peaks.columns[0]], format="%Y-%m-%dT%H:%M:%S.%f")
+
+    # Count how many occurrences happened for each day. Days without any calls are counts of zero
+    daily_counts = timestamps.dt.normalize().value_counts().sort_index()
+    return daily_counts.asfreq("D", fill_value=0)
+
+
+def detect_change(count_data, threshold=THRESHOLD, backend="exact", samples=SAMPLES, random_state=None):
+    """
+    @param count_data: The number of calls on each day, in date order
+    @param threshold: The largest overlap of the rate posteriors that still counts as a change
+    @param backend: "exact" for ChangepointPosterior, or "pymc" for the original MCMC
+    @param samples: The number of posterior draws the histograms are made from
+    @param random_state: A seed or np.random.RandomState for the exact draws
+    @return: Whether change was detected, the posterior mean of tau and the overlap of the rate histograms
+    """
+    count_data = np.asarray(count_data, dtype=np.float64)
+    if len(count_data) == 0 or count_data.sum() == 0:
+        return False, float("nan"), 1.0
+
+    if backend == "pymc":
+        lambda_1_samples, lambda_2_samples, tau_samples = sample_pymc(count_data, samples=samples)
+        tau_mean = tau_samples.mean()
+    elif backend == "exact":
+        posterior = ChangepointPosterior(count_data)
+        lambda_1_samples, lambda_2_samples, tau_samples = posterior.sample(samples, random_state)
+        tau_mean = posterior.tau_mean()
+    else:
+        raise ValueError("Unknown backend " + str(backend))
 
     # Overlap ranges from 0% to 100%. If there was less than a 5% area overlap, we say a change occurred.
-    result = []
-    overlap = 0
-    for x in range(0, 50, 1):
-        mini = min(hist_lambda_1[0][x], hist_lambda_2[0][x])
-        result.append(mini)
-        overlap = overlap + mini
-
-    if overlap <= THRESHOLD:
-        return True, tau_samples.mean(), overlap
+    overlap = histogram_overlap(lambda_1_samples, lambda_2_samples)
+    return bool(overlap <= threshold), float(tau_mean), float(overlap)
+
+
+def detect_markov(bird_name, store=None, backend="exact", plot=False, legacy_csv=None):
+    """
+    @param bird_name: The name of the bird
+    @param store: The HistoryStore of the detections. The one in "Detected Peaks" if None
+    @param backend: "exact" for ChangepointPosterior, or "pymc" for the original MCMC
+    @param plot: Whether to save a bar chart of the daily counts to bird_count.pdf
+    @param legacy_csv: A legacy historical csv of the bird's detections to read instead of the store
+    @return: Whether change was detected, the posterior mean of tau and the overlap of the rate histograms
+    """
+    if legacy_csv is not None:
+        count_data = daily_counts_from_csv(legacy_csv).values
     else:
-        return True, tau_samples.mean(), overlap
+        if store is None:
+            store = HistoryStore()
+        count_data = daily_counts_from_store(bird_name, store).values
+    if plot:
+        plot_counts(count_data)
+    return detect_change(count_data, backend=backend)
+
+
+def plot_counts(count_data):
+    import matplotlib.pyplot as plt
+
+    n_count_data = len(count_data)
+    plt.bar(np.arange(n_count_data), count_data, color="#348ABD")
+    plt.xlabel("Time (min)")
+    plt.ylabel("Count of calls")
+    plt.xlim(0, n_count_data);
+    plt.savefig("bird_count.pdf", format="pdf", bbox_inches="tight")
 
 
 def plot_graphs(lambda_1_samples, lambda_2_samples, tau_samples, n_count_data):
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as plticker
+
     fig = plt.figure()
     fig.subplots_adjust(hspace=0.5)
     ax = fig.add_subplot(311)
@@ -111,4 +276,16 @@ def plot_graphs(lambda_1_samples, lambda_2_samples, tau_samples, n_count_data):
     fig.savefig("Detect_change.pdf", format="pdf", bbox_inches="tight")
 
 
-detect_markov("Detected Peaks/XXXXXX.csv")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Detects a change in how often a bird calls from its daily counts")
+    parser.add_argument("bird_name", help="The name of the bird, as in the history")
+    parser.add_argument("--output", default="Detected Peaks", help="The folder the history is kept in")
+    parser.add_argument("--legacy-csv", default=None,
+                        help="Read the detections from a historical csv written before the history store instead")
+    parser.add_argument("--backend", choices=["exact", "pymc"], default="exact",
+                        help="Use the exact posterior or the original MCMC")
+    parser.add_argument("--plot", action="store_true", help="Save a bar chart of the daily counts to bird_count.pdf")
+    args = parser.parse_args()
+
+    print(detect_markov(args.bird_name, HistoryStore(args.output), backend=args.backend, plot=args.plot,
+                        legacy_csv=args.legacy_csv))
@@ -0,0 +1,424 @@
+import datetime
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import signal
+from scipy.io import wavfile
+
+import detect_historical_cusum as detect_cusum
+from adaptive_threshold import DEFAULT_NOISE_SECONDS, make_sweep
+from envelope import DEFAULT_WINDOW_SECONDS, compute_envelope
+from history_store import HistoryStore
+from instrumentation import DISABLED
+from online_changepoint import PoissonGammaChangepoint
+from peak_io import format_timestamps, samples_to_datetime64, to_datetime64
+from streaming_detector import deinterleave
+from template_bank import bird_name_from_filename, read_call
+
+# Importing this module has no side effects and does not need an audio stack. PyAudio is only imported once a
+# microphone is opened
+CHANNELS = 1
+RATE = 44100
+CHUNK = 1024
+MIC_INDEX = 2
+RECORD_SECONDS = 20
+OUTPUT_DIRECTORY = "Detected Peaks"
+# An envelope height of the raw int16 correlation. TemplateBank.scale_height converts it for the float32 path
+MIN_THRESHOLD = 1 * 10**16
+DEBUG_START = datetime.datetime(year=2000, month=1, day=1)
+
+
+def _open_microphone(rate=RATE, chunk=CHUNK, mic_index=MIC_INDEX, channels=CHANNELS):
+    import pyaudio
+
+    audio = pyaudio.PyAudio()
+    stream = audio.open(
+        format=pyaudio.paInt16,
+        channels=channels,
+        rate=rate,
+        frames_per_buffer=chunk,
+        input_device_index=mic_index,
+        input=True)
+    return audio, stream
+
+
+def list_audio_devices():
+    # Index 2 is the microphone!
+    import pyaudio
+
+    audio = pyaudio.PyAudio()
+    for i in range(audio.get_device_count()):
+        dev = audio.get_device_info_by_index(i)
+        print(i, dev["name"], dev["maxInputChannels"])
+    audio.terminate()
+
+
+def get_audio_from_file(filename):
+    print("Using existing data...")
+    fs, amplitude = wavfile.read("Input Signals/" + filename)
+    return amplitude
+
+
+class _MicReader:
+    """
+    Reads chunks from an open PyAudio stream and reports the capture time, the frames waiting in the stream and the
+    frames dropped to the metrics. PortAudio drops input it has no room for without saying how much, so the frames
+    the clock says have arrived but that were neither read nor waiting to be read are counted as dropped.
+    """
+
+    def __init__(self, stream, chunk, rate, metrics):
+        self.stream = stream
+        self.chunk = chunk
+        self.rate = rate
+        self.metrics = metrics
+        self.frames_read = 0
+        self.frames_dropped = 0
+        self._opened = time.perf_counter()
+        self._slack = chunk + int(stream.get_input_latency() * rate) if metrics.enabled else 0
+
+    def read(self):
+        with self.metrics.span("capture", samples=self.chunk):
+            data = self.stream.read(self.chunk, exception_on_overflow=False)
+        self.frames_read += self.chunk
+
+        if self.metrics.enabled:
+            waiting = self.stream.get_read_available()
+            self.metrics.set_queue_depth(waiting)
+            arrived = int((time.perf_counter() - self._opened) * self.rate)
+            missing = arrived - self.frames_read - waiting - self._slack
+            if missing > self.frames_dropped:
+                self.metrics.add_dropped_frames(missing - self.frames_dropped)
+                self.frames_dropped = missing
+        return data
+
+
+def get_mic_data(record_seconds=RECORD_SECONDS, rate=RATE, chunk=CHUNK, mic_index=MIC_INDEX, metrics=DISABLED,
+                 channels=CHANNELS):
+    # A device with several channels gives an (n_channels, n_samples) array, as multichannel.sweep_channels takes
+    audio, stream = _open_microphone(rate, chunk, mic_index, channels)
+    reader = _MicReader(stream, chunk, rate, metrics)
+
+    print("recording...")
+    frames = []
+
+    for i in range(0, int(rate / chunk * record_seconds)):
+        data = reader.read()
+        # data = stream.read(chunk)
+
+        frames.append(data)
+    byteAudio = b''.join(frames)
+    print("finished recording")
+
+    # stop Recording
+    stream.stop_stream()
+    stream.close()
+    audio.terminate()
+    amplitude = np.frombuffer(byteAudio, np.int16)
+    if channels > 1:
+        return deinterleave(amplitude, channels)
+    return amplitude
+
+
+def get_mic_chunks(rate=RATE, chunk=CHUNK, mic_index=MIC_INDEX, metrics=DISABLED, channels=CHANNELS):
+    # Yields chunk frames at a time from the microphone until the stream is closed. Several channels are yielded as
+    # interleaved frames, which a MultiChannelStreamingDetector takes directly
+    audio, stream = _open_microphone(rate, chunk, mic_index, channels)
+    reader = _MicReader(stream, chunk, rate, metrics)
+
+    print("streaming...")
+    try:
+        while True:
+            yield np.frombuffer(reader.read(), np.int16)
+    finally:
+        stream.stop_stream()
+        stream.close()
+        audio.terminate()
+
+
+def iter_timed_correlations(template_bank, inputSignal, metrics=DISABLED, batch_size=None):
+    """
+    TemplateBank.iter_correlations with each correlation timed as a "correlate" span of its bird. When several calls
+    are inverse transformed together the whole batch is timed against the first bird in it.
+
+    @param template_bank: The TemplateBank holding the calls
+    @param inputSignal: The audio samples to search through
+    @param metrics: The instrumentation.Metrics to report to
+    @param batch_size: How many calls to inverse transform at once. All of them by default
+    @return: A generator of (template index, correlation) pairs in bank order
+    """
+    correlations = template_bank.iter_correlations(inputSignal, batch_size=batch_size)
+    for i in range(len(template_bank)):
+        with metrics.span("correlate", species=template_bank.names[i], samples=len(inputSignal)):
+            index, corr = next(correlations)
+        yield index, corr
+
+
+def sweep_correlation_peaks(inputSignal, fileNameToDetect, corr=None, fs=None, rate=RATE,
+                            envelope_seconds=DEFAULT_WINDOW_SECONDS, envelope_method="boxcar", threshold_mode="global",
+                            noise_seconds=DEFAULT_NOISE_SECONDS, min_height=None, overwrite=False, metrics=DISABLED):
+    """
+    @param inputSignal: The audio samples to search through
+    @param fileNameToDetect: The path of the known bird call
+    @param corr: The correlation of the input with the call, e.g. from a TemplateBank. Computed here if None
+    @param fs: The sampling rate of the call. Read from the call if corr is None
+    @param rate: The sampling rate of the input
+    @param envelope_seconds: How long the squared correlation is averaged over
+    @param envelope_method: One of envelope.ENVELOPE_METHODS
+    @param threshold_mode: One of adaptive_threshold.THRESHOLD_MODES. The adaptive modes sweep the envelope in
+    standard deviations of its local noise floor instead of the whole envelope
+    @param noise_seconds: How long the noise floor of the adaptive modes is measured over
+    @param min_height: An envelope height the adaptive modes never detect below. The global mode applies it in sweep()
+    @param overwrite: Whether the envelope may be written over corr, which is then lost
+    @param metrics: The instrumentation.Metrics the time of each step is reported to
+    @return: The PeakSweep of the correlation envelope
+    """
+    bird_name = bird_name_from_filename(fileNameToDetect)
+
+    # The correlation can be handed in from a TemplateBank, which correlates every call in one pass
+    if corr is None:
+        with metrics.span("correlate", species=bird_name, samples=len(inputSignal)):
+            # Correlate the data with a plover call
+            fs, call_to_detect = read_call(fileNameToDetect)
+            call_to_detect = call_to_detect[::-1]
+
+            corr = signal.fftconvolve(inputSignal, call_to_detect, mode="same")
+
+    # Find the envelope of the cross correlation by squaring and filtering. A float32 correlation keeps a float32
+    # envelope
+    dtype = np.float32 if corr.dtype == np.float32 else np.float64
+    with metrics.span("envelope", species=bird_name, samples=len(corr)):
+        envelope = compute_envelope(corr, rate, window_seconds=envelope_seconds, method=envelope_method, dtype=dtype,
+                                    overwrite=overwrite)
+
+    # The calls must at least be separated by 5s. The peaks are found once and every threshold is read off the sweep
+    with metrics.span("peak-find", species=bird_name, samples=len(envelope)):
+        return make_sweep(envelope, fs, rate, threshold_mode, noise_seconds, min_height)
+
+
+def detect_correlation_peaks(inputSignal, fileNameToDetect, start_dt, thresholds=[3], relative_to_mean=True,
+                             min_height=None, days=0, corr=None, fs=None, rate=RATE,
+                             envelope_seconds=DEFAULT_WINDOW_SECONDS, envelope_method="boxcar", threshold_mode="global",
+                             noise_seconds=DEFAULT_NOISE_SECONDS, overwrite=False, metrics=DISABLED):
+    """
+    @param inputSignal: The audio samples to search through
+    @param fileNameToDetect: The path of the known bird call
+    @param start_dt: The time of the first sample of the input
+    @param thresholds: The thresholds in standard deviations, of the whole envelope or of its local noise floor
+    @param relative_to_mean: Whether the thresholds are measured from the mean of the envelope or from zero. The old
+    DEBUG_MODE measured them from zero
+    @param min_height: An envelope height the thresholds are never allowed to go below, such as MIN_THRESHOLD
+    @param days: How many days after start_dt the input was recorded
+    @param corr: The correlation of the input with the call. Computed here if None
+    @param fs: The sampling rate of the call. Read from the call if corr is None
+    @param rate: The sampling rate of the input
+    @param envelope_seconds: How long the squared correlation is averaged over
+    @param envelope_method: One of envelope.ENVELOPE_METHODS
+    @param threshold_mode: One of adaptive_threshold.THRESHOLD_MODES
+    @param noise_seconds: How long the noise floor of the adaptive modes is measured over
+    @param overwrite: Whether the envelope may be written over corr, which is then lost
+    @param metrics: The instrumentation.Metrics the time of each step is reported to
+    @return: A DataFrame with a column of detection timestamps for each threshold
+    """
+    sweep = sweep_correlation_peaks(inputSignal, fileNameToDetect, corr=corr, fs=fs, rate=rate,
+                                    envelope_seconds=envelope_seconds, envelope_method=envelope_method,
+                                    threshold_mode=threshold_mode, noise_seconds=noise_seconds, min_height=min_height,
+                                    overwrite=overwrite, metrics=metrics)
+    if threshold_mode != "global":
+        # The minimum height has already been applied to the envelope
+        min_height = None
+
+    bird_name = bird_name_from_filename(fileNameToDetect)
+
+    print("Finding signal peaks of " + bird_name)
+    df = pd.DataFrame()
+
+    # The minimum height is a way to avoid the system detecting calls when there's nothing similar at all
+    with metrics.span("peak-find", species=bird_name):
+        counts = sweep.sweep(thresholds, relative_to_mean=relative_to_mean, min_height=min_height)
+
+    with metrics.span("serialize", species=bird_name):
+        # The detections at every threshold are a prefix of the swept peaks, so each timestamp is only formatted once
+        recording_start = start_dt + datetime.timedelta(days=days)
+        timestamps = samples_to_datetime64(sweep.peaks[:counts.max(initial=0)], rate, recording_start)
+        delta = format_timestamps(timestamps).astype(object)
+
+        for threshold, count in zip(thresholds, counts):
+            in_time_order = np.argsort(sweep.peaks[:count], kind="stable")
+            df[threshold] = pd.Series(delta[:count][in_time_order])
+
+    return df
+
+
+def save_peak_data(peaks, filename, directory=None, use_mic=False, output_directory=OUTPUT_DIRECTORY, store=None,
+                   start_dt=None):
+    """
+    @param peaks: A DataFrame with a column of detection timestamps for each threshold
+    @param filename: The path of the known bird call
+    @param directory: The run folder inside output_directory. Named after the current time if None
+    @param use_mic: Whether to append the first column to the bird's history instead
+    @param output_directory: The folder the detections are kept in
+    @param store: The HistoryStore to append to. One in output_directory if None
+    @param start_dt: The time of the first sample of the input, written as the reference row of every csv file. Only
+    needed without use_mic
+    """
+    bird_name = bird_name_from_filename(filename)
+
+    if not os.path.isdir(output_directory):
+        os.makedirs(output_directory)
+
+    if use_mic:
+        if store is None:
+            store = HistoryStore(output_directory)
+        if len(peaks.columns):
+            store.append(bird_name, peaks[peaks.columns[0]].dropna().values.astype(str))
+    else:
+        if start_dt is None:
+            raise ValueError("The csv files need the start of the recording as their reference row")
+        reference = format_timestamps([to_datetime64(start_dt)])
+
+        subdirectory = directory
+        if directory is None:
+            subdirectory = "Correlation " + datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        bird_directory = output_directory + "/" + subdirectory + "/" + bird_name
+        if not os.path.isdir(bird_directory):
+            os.makedirs(bird_directory)
+
+        for threshold in peaks.columns:
+            peaks_dropped_nan = peaks[threshold].dropna(how="any")
+            # The start of the recording and then one timestamp per line without a header, as peak_io.export_csv
+            # writes and check_results.py reads. The file is named after the threshold as a float, which pandas may
+            # have turned into an integer column
+            peaks_dropped_nan = pd.concat([pd.Series(reference), peaks_dropped_nan], ignore_index=True)
+            peaks_dropped_nan.to_csv(bird_directory + "/" + str(float(threshold)) + ".csv", index=False, header=False)
+
+
+def save_streamed_peaks(detections, filenames, start_dt, days=0, rate=RATE, output_directory=OUTPUT_DIRECTORY,
+                        store=None):
+    """
+    Groups the streamed detections by bird and appends them to the history.
+
+    @param detections: A list of (template index, sample, envelope height) from a StreamingDetector
+    @param filenames: The path of the call of each template index
+    @param start_dt: The time of the first sample of the stream
+    @param days: How many days after start_dt the stream started
+    @param rate: The sampling rate of the stream
+    @param output_directory: The folder the detections are kept in
+    @param store: The HistoryStore to append to. One in output_directory if None
+    """
+    if store is None:
+        store = HistoryStore(output_directory)
+
+    samples = {}
+    for index, sample, height in detections:
+        samples.setdefault(index, []).append(sample)
+
+    stream_start = start_dt + datetime.timedelta(days=days)
+    for index in sorted(samples):
+        store.append(bird_name_from_filename(filenames[index]), samples_to_datetime64(samples[index], rate, stream_start))
+
+
+def check_for_change(filenames, start_dt, days, output_directory=OUTPUT_DIRECTORY, store=None):
+    """
+    Runs the CUSUM change detector over the daily call counts in the history of every bird.
+
+    @param filenames: The paths of the known bird calls
+    @param start_dt: The time the recording started
+    @param days: How many days have been recorded
+    @param output_directory: The folder the detections are kept in
+    @param store: The HistoryStore holding the detections. One in output_directory if None
+    @return: A dictionary of whether change was detected for each bird with any data
+    """
+    print("Checking for change detection...")
+    if store is None:
+        store = HistoryStore(output_directory)
+    changes = {}
+
+    # Birds whose counts cover the same days are checked together in one pass
+    groups = {}
+    for fileNameToDetect in filenames:
+        bird_name = bird_name_from_filename(fileNameToDetect)
+
+        # Every day since the start is counted, even the days without any detections
+        daily_counts = store.daily_counts(bird_name, start=start_dt, days=days)
+        if daily_counts.sum() == 0:
+            print("There was no data to examine for " + bird_name)
+            continue
+        groups.setdefault(tuple(daily_counts.index.asi8), []).append((bird_name, daily_counts.values))
+
+    for group in groups.values():
+        counts = np.array([daily_counts for bird_name, daily_counts in group])
+        results, cusum_pos, cusum_neg = detect_cusum.detect_cusum_matrix(counts, threshold=2, look_back=5)
+
+        for (bird_name, daily_counts), result in zip(group, results[:, -1]):
+            print(detect_cusum.MESSAGES[result] + "for " + bird_name)
+            changes[bird_name] = result in (detect_cusum.CHANGE_UP, detect_cusum.CHANGE_DOWN)
+
+    return changes
+
+
+def update_changepoints(filenames, start_dt, days, changepoints, output_directory=OUTPUT_DIRECTORY, store=None):
+    """
+    Feeds the daily call counts that have not been seen yet into an online changepoint detector for every bird, so a
+    change is reported as soon as the day that shows it has been counted.
+
+    @param filenames: The paths of the known bird calls
+    @param start_dt: The time the recording started
+    @param days: How many days have been recorded
+    @param changepoints: A dictionary of the PoissonGammaChangepoint of each bird, filled in as birds are first seen
+    @param output_directory: The folder the detections are kept in
+    @param store: The HistoryStore holding the detections. One in output_directory if None
+    @return: A dictionary of whether change was detected for each bird
+    """
+    if store is None:
+        store = HistoryStore(output_directory)
+    changes = {}
+    first_day = pd.Timestamp(start_dt).normalize()
+
+    for fileNameToDetect in filenames:
+        bird_name = bird_name_from_filename(fileNameToDetect)
+        if bird_name not in changepoints:
+            changepoints[bird_name] = PoissonGammaChangepoint()
+        changepoint = changepoints[bird_name]
+
+        daily_counts = store.daily_counts(bird_name, start=start_dt, days=days)
+        daily_counts = daily_counts[daily_counts.index >= first_day].values[:days]
+
+        change = False
+        for count in daily_counts[changepoint.days:]:
+            change, message = changepoint.update(count)
+            if change:
+                print(message + "for " + bird_name + " (probability %.2f, %.1f to %.1f calls a day)" %
+                      (changepoint.change_probability, changepoint.rate_before, changepoint.rate_after))
+        changes[bird_name] = change
+
+    return changes
+
+
+def check_changes(filenames, start_dt, days, changepoints, change_detector="cusum", output_directory=OUTPUT_DIRECTORY,
+                  store=None, metrics=DISABLED, first_day=None):
+    """
+    Checks the history for change once a day has been recorded. The online detector takes every new day as it is
+    counted, the CUSUM refits the history every 5 days.
+
+    @param filenames: The paths of the known bird calls
+    @param start_dt: The time the recording started
+    @param days: How many days have been recorded
+    @param changepoints: A dictionary of the PoissonGammaChangepoint of each bird, used by the online detector
+    @param change_detector: "cusum" for check_for_change or "bocpd" for update_changepoints
+    @param output_directory: The folder the detections are kept in
+    @param store: The HistoryStore holding the detections. One in output_directory if None
+    @param metrics: The instrumentation.Metrics the time of the check is reported to
+    @param first_day: The day the online detector counts from. The day of start_dt if None
+    @return: A dictionary of whether change was detected for each bird, or None if it was not a day to check
+    """
+    if change_detector == "bocpd":
+        with metrics.span("change-check"):
+            return update_changepoints(filenames, start_dt if first_day is None else first_day, days, changepoints,
+                                       output_directory=output_directory, store=store)
+    elif days % 5 == 0:
+        with metrics.span("change-check"):
+            return check_for_change(filenames, start_dt, days, output_directory=output_directory, store=store)
+    return None
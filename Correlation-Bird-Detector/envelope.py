@@ -0,0 +1,174 @@
+import numpy as np
+from scipy import signal
+
+# 10000 samples at 44.1kHz, the window the envelope was originally smoothed over
+DEFAULT_WINDOW_SECONDS = 10000 / 44100.0
+
+# Number of envelope samples worked on at a time. Only block sized temporaries are ever allocated
+BLOCK_SIZE = 1 << 16
+
+# Taps of the FIR Hilbert transformer used by the "hilbert" envelope
+HILBERT_TAPS = 255
+
+ENVELOPE_METHODS = ["boxcar", "exponential", "hilbert"]
+
+
+def window_length(window_seconds, fs):
+    """
+    @param window_seconds: The length of the smoothing window in seconds
+    @param fs: The sampling rate of the correlation
+    @return: The length of the smoothing window in samples
+    """
+    return max(int(round(window_seconds * fs)), 1)
+
+
+def _window_means(power, window, out):
+    # The mean of every window of power, written to out. Each window sum is the previous one plus the sample entering
+    # minus the sample leaving, anchored with an exact sum of the first window
+    out[0] = power[:window].sum()
+    np.subtract(power[window:], power[:len(out) - 1], out=out[1:])
+    np.cumsum(out, out=out)
+    out /= window
+    return out
+
+
+def boxcar_envelope(corr, window, dtype=np.float64, squared=False, out=None):
+    """
+    The moving average of the squared correlation over window samples. This is the same as
+    signal.fftconvolve(corr * corr, np.ones((window,)) / window, mode="valid") but runs in linear time.
+
+    The running sum is kept in float64 and re-anchored with an exact (pairwise) sum at the start of every block, so
+    rounding errors cannot build up along the signal. A float32 envelope is the float64 one rounded once, within a
+    relative error of 6e-8. Accumulating in float32 would let the error grow to 1e-5 within a block, enough to move
+    the highest sample of the flat top of a peak by a tenth of a second.
+
+    Every block of corr is copied and squared before the envelope of that block is written, so out may be corr itself
+    and the envelope then needs no memory of its own.
+
+    @param corr: The correlation to smooth
+    @param window: The number of samples to average over
+    @param dtype: The type to return the envelope in (np.float64 or np.float32)
+    @param squared: Whether corr has already been squared
+    @param out: An array of dtype to write the envelope to, at least len(corr) - window + 1 long. A new one if None
+    @return: An array of length len(corr) - window + 1
+    """
+    n_out = len(corr) - window + 1
+    if n_out <= 0:
+        return np.zeros(0, dtype=dtype)
+
+    envelope = np.empty(n_out, dtype=dtype) if out is None else out[:n_out]
+    block = max(BLOCK_SIZE, 4 * window)
+    sums = np.empty(block, dtype=np.float64)
+
+    for start in range(0, n_out, block):
+        stop = min(start + block, n_out)
+
+        power = np.array(corr[start:stop + window - 1], dtype=np.float64)
+        if not squared:
+            power *= power
+
+        envelope[start:stop] = _window_means(power, window, sums[:stop - start])
+
+    return envelope
+
+
+def exponential_envelope(corr, window, dtype=np.float64, out=None):
+    """
+    Exponentially weighted average of the squared correlation with a time constant of window samples. Unlike the
+    boxcar, the output has the same length as corr and lags behind it.
+
+    @param corr: The correlation to smooth
+    @param window: The time constant in samples
+    @param dtype: The type to return the envelope in
+    @param out: An array of dtype the same length as corr to write the envelope to, which may be corr itself. A new
+    one if None
+    @return: An array the same length as corr
+    """
+    alpha = 1.0 - np.exp(-1.0 / window)
+    envelope = np.empty(len(corr), dtype=dtype) if out is None else out[:len(corr)]
+    state = np.zeros(1)
+
+    for start in range(0, len(corr), BLOCK_SIZE):
+        stop = min(start + BLOCK_SIZE, len(corr))
+        power = np.array(corr[start:stop], dtype=np.float64)
+        power *= power
+        envelope[start:stop], state = signal.lfilter([alpha], [1.0, alpha - 1.0], power, zi=state)
+
+    return envelope
+
+
+def hilbert_envelope(corr, window, dtype=np.float64, out=None):
+    """
+    Boxcar average of the squared magnitude of the analytic correlation, corr ** 2 + hilbert(corr) ** 2. This removes
+    the ripple at the call's carrier frequency before smoothing. The Hilbert transform is a FIR filter applied block
+    by block, so the cost stays linear in the signal length.
+
+    The power of each block goes straight into the running sum of the boxcar. The last window - 1 samples of power
+    and the few samples of corr the filter still needs are carried to the next block, so only block sized temporaries
+    are allocated even when out is corr itself.
+
+    @param corr: The correlation to smooth
+    @param window: The number of samples to average over
+    @param dtype: The type to return the envelope in
+    @param out: An array of dtype to write the envelope to, which may be corr itself. A new one if None
+    @return: An array of length len(corr) - window + 1
+    """
+    n_out = len(corr) - window + 1
+    if n_out <= 0:
+        return np.zeros(0, dtype=dtype)
+
+    taps = signal.remez(HILBERT_TAPS, [0.01, 0.49], [1], type="hilbert", fs=1.0)
+    delay = (HILBERT_TAPS - 1) // 2
+
+    envelope = np.empty(n_out, dtype=dtype) if out is None else out[:n_out]
+    block = max(BLOCK_SIZE, 4 * window, 2 * delay)
+    sums = np.empty(block, dtype=np.float64)
+    carried = np.zeros(0)
+    kept = np.zeros(0)
+
+    for start in range(0, n_out, block):
+        stop = min(start + block, n_out)
+        # The power from first to end is new, the power before first was carried from the previous block
+        first = start + len(carried)
+        end = stop + window - 1
+
+        # Include enough neighbouring samples on both sides that the filter output is exact in the block. The
+        # samples before the previous block's end may have been overwritten by its envelope, so they were kept
+        lo = max(first - delay, 0)
+        hi = min(end + delay, len(corr))
+        segment = np.concatenate((kept, np.asarray(corr[lo + len(kept):hi], dtype=np.float64)))
+        quadrature = signal.oaconvolve(segment, taps, mode="full")[first - lo + delay:end - lo + delay]
+
+        in_phase = segment[first - lo:end - lo]
+        power = np.concatenate((carried, in_phase * in_phase + quadrature * quadrature))
+
+        carried = power[stop - start:]
+        kept = np.array(corr[max(end - delay, 0):stop], dtype=np.float64)
+        envelope[start:stop] = _window_means(power, window, sums[:stop - start])
+
+    return envelope
+
+
+def compute_envelope(corr, fs, window_seconds=DEFAULT_WINDOW_SECONDS, method="boxcar", dtype=np.float64,
+                     overwrite=False):
+    """
+    @param corr: The correlation of the input signal with a call
+    @param fs: The sampling rate of the correlation
+    @param window_seconds: The length of the smoothing window in seconds
+    @param method: One of ENVELOPE_METHODS
+    @param dtype: The type to return the envelope in
+    @param overwrite: Whether the envelope may be written over corr, which must then be an array of dtype that is not
+    needed afterwards. This saves a full length array
+    @return: The envelope of the correlation
+    """
+    window = window_length(window_seconds, fs)
+    out = corr if overwrite else None
+
+    if method == "boxcar":
+        return boxcar_envelope(corr, window, dtype=dtype, out=out)
+    if method == "exponential":
+        return exponential_envelope(corr, window, dtype=dtype, out=out)
+    if method == "hilbert":
+        return hilbert_envelope(corr, window, dtype=dtype, out=out)
+
+    raise ValueError("Unknown envelope method " + str(method) + ". Use one of " + ", ".join(ENVELOPE_METHODS))
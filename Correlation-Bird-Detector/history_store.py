@@ -0,0 +1,177 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from peak_io import to_datetime64
+
+RECORD_DTYPE = np.dtype("<i8")
+MICROSECONDS_PER_DAY = 24 * 60 * 60 * 10**6
+
+
+def to_microseconds(timestamps):
+    """
+    @param timestamps: An array of np.datetime64 timestamps or of strings in peak_io.TIMESTAMP_FORMAT
+    @return: An int64 array of the microseconds since 1970-01-01
+    """
+    return np.asarray(timestamps, dtype="datetime64[us]").astype(np.int64)
+
+
+class HistoryStore:
+    """
+    The detections of every bird over the whole deployment. Each bird has an append-only log of int64 microsecond
+    timestamps, <bird>.log, and a small index of the number of detections on each day, <bird>.index.npz. Appending
+    only writes the new detections and the index, and the change checks only read the index, so neither gets slower
+    as the deployment runs.
+
+    The index records how many log entries it covers. If the process stops between writing the log and the index, the
+    uncounted entries are added to the index the next time it is read. A record cut short by a partial write is
+    dropped.
+    """
+
+    def __init__(self, directory="Detected Peaks"):
+        self.directory = directory
+        self._indices = {}
+
+    def _log_path(self, bird_name):
+        return os.path.join(self.directory, bird_name + ".log")
+
+    def _index_path(self, bird_name):
+        return os.path.join(self.directory, bird_name + ".index.npz")
+
+    def _csv_path(self, bird_name):
+        return os.path.join(self.directory, bird_name + ".csv")
+
+    def birds(self):
+        """
+        @return: The names of the birds with a log
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name.split(".log")[0] for name in os.listdir(self.directory) if name.endswith(".log"))
+
+    def _records_in_log(self, bird_name):
+        path = self._log_path(bird_name)
+        if not os.path.exists(path):
+            return 0
+
+        size = os.path.getsize(path)
+        if size % RECORD_DTYPE.itemsize:
+            # The last append was interrupted part way through a record
+            with open(path, "r+b") as log_file:
+                log_file.truncate(size - size % RECORD_DTYPE.itemsize)
+        return size // RECORD_DTYPE.itemsize
+
+    def _read_log(self, bird_name, first=0):
+        n_records = self._records_in_log(bird_name)
+        if first >= n_records:
+            return np.zeros(0, dtype=np.int64)
+        with open(self._log_path(bird_name), "rb") as log_file:
+            log_file.seek(first * RECORD_DTYPE.itemsize)
+            return np.fromfile(log_file, dtype=RECORD_DTYPE, count=n_records - first).astype(np.int64)
+
+    def _load_index(self, bird_name):
+        if bird_name in self._indices:
+            return self._indices[bird_name]
+
+        days = np.zeros(0, dtype=np.int64)
+        counts = np.zeros(0, dtype=np.int64)
+        records = 0
+        try:
+            with np.load(self._index_path(bird_name)) as index:
+                days, counts, records = index["days"], index["counts"], int(index["records"])
+        except (IOError, ValueError, KeyError):
+            pass
+
+        n_records = self._records_in_log(bird_name)
+        if records > n_records:
+            # The log is shorter than the index says, so count it again from the start
+            days = np.zeros(0, dtype=np.int64)
+            counts = np.zeros(0, dtype=np.int64)
+            records = 0
+
+        self._indices[bird_name] = (days, counts, records)
+        if records < n_records:
+            self._count(bird_name, self._read_log(bird_name, records))
+        return self._indices[bird_name]
+
+    def _count(self, bird_name, microseconds):
+        days, counts, records = self._indices[bird_name]
+
+        new_days, new_counts = np.unique(microseconds // MICROSECONDS_PER_DAY, return_counts=True)
+        all_days = np.union1d(days, new_days)
+        all_counts = np.zeros(len(all_days), dtype=np.int64)
+        all_counts[np.searchsorted(all_days, days)] += counts
+        all_counts[np.searchsorted(all_days, new_days)] += new_counts
+
+        self._indices[bird_name] = (all_days, all_counts, records + len(microseconds))
+        self._save_index(bird_name)
+
+    def _save_index(self, bird_name):
+        days, counts, records = self._indices[bird_name]
+        path = self._index_path(bird_name)
+        temporary_path = path + ".tmp"
+
+        # Replacing the old index in one step means a crash leaves either the old or the new one, never half of each
+        with open(temporary_path, "wb") as index_file:
+            np.savez(index_file, days=days, counts=counts, records=np.array(records))
+            index_file.flush()
+            os.fsync(index_file.fileno())
+        os.replace(temporary_path, path)
+
+    def _migrate(self, bird_name):
+        # Import the csv written before the store existed the first time the bird is used
+        if os.path.exists(self._log_path(bird_name)) or not os.path.exists(self._csv_path(bird_name)):
+            return
+        try:
+            historical_peaks = pd.read_csv(self._csv_path(bird_name), header=None)
+        except ValueError:
+            return
+        timestamps = historical_peaks[historical_peaks.columns[0]].dropna().values.astype(str)
+        self._write(bird_name, to_microseconds(timestamps))
+
+    def append(self, bird_name, timestamps):
+        """
+        @param bird_name: The name of the bird that was detected
+        @param timestamps: An array of np.datetime64 timestamps or of strings in peak_io.TIMESTAMP_FORMAT
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self._migrate(bird_name)
+        self._write(bird_name, to_microseconds(timestamps))
+
+    def _write(self, bird_name, microseconds):
+        self._load_index(bird_name)
+        if len(microseconds) == 0:
+            return
+
+        with open(self._log_path(bird_name), "ab") as log_file:
+            log_file.write(microseconds.astype(RECORD_DTYPE).tobytes())
+            log_file.flush()
+            os.fsync(log_file.fileno())
+        self._count(bird_name, microseconds)
+
+    def timestamps(self, bird_name):
+        """
+        @param bird_name: The name of the bird
+        @return: An array of the np.datetime64 timestamps of every detection of the bird in the order they were added
+        """
+        self._migrate(bird_name)
+        return self._read_log(bird_name).astype("datetime64[us]")
+
+    def daily_counts(self, bird_name, start=None, days=0):
+        """
+        @param bird_name: The name of the bird
+        @param start: The first day which must appear in the counts even without detections
+        @param days: How many days from start must appear
+        @return: A Series of the number of detections on each day, indexed by date in ascending order
+        """
+        self._migrate(bird_name)
+        index_days, counts, records = self._load_index(bird_name)
+
+        daily_counts = pd.Series(counts, index=pd.DatetimeIndex(index_days.astype("datetime64[D]")), dtype=np.int64)
+        if start is not None and days > 0:
+            first_day = to_datetime64(start).astype("datetime64[D]")
+            empty_days = pd.DatetimeIndex(first_day + np.arange(days))
+            daily_counts = daily_counts.reindex(daily_counts.index.union(empty_days), fill_value=0)
+        return daily_counts
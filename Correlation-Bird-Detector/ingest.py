@@ -0,0 +1,158 @@
+#!/usr/bin/python
+
+import argparse
+import datetime
+import resource
+import sys
+import time
+
+import numpy as np
+from scipy.io import wavfile
+
+from adaptive_threshold import ADAPTIVE_THRESHOLDS, DEFAULT_NOISE_SECONDS, THRESHOLD_MODES
+from batch_runner import DEFAULT_START, DEFAULT_THRESHOLDS, run_directory
+from envelope import DEFAULT_WINDOW_SECONDS, window_length
+from peak_io import DetectionWriter
+from peak_sweep import PeakSweep
+from streaming_detector import StreamingDetector
+from template_bank import TemplateBank
+
+DEFAULT_MEMORY_BUDGET = 512 * 2**20
+
+
+def open_wav(filename):
+    """
+    @param filename: The path of a wav file
+    @return: The sampling rate and a memory map of the first channel, so only the pages being read are held in memory
+    """
+    fs, samples = wavfile.read(filename, mmap=True)
+    if samples.ndim > 1:
+        samples = samples[:, 0]
+    return fs, samples
+
+
+def estimate_memory(template_bank, nfft, rate=44100, envelope_seconds=DEFAULT_WINDOW_SECONDS):
+    """
+    A rough count of the bytes a StreamingDetector holds at once: the cached spectra, the product with the input
+    spectrum and the correlations of one block for every call, plus each tracker's window of envelope samples.
+
+    @param template_bank: The TemplateBank holding the calls to detect
+    @param nfft: The FFT size of the detector
+    @param rate: The sampling rate of the input
+    @param envelope_seconds: How long the squared correlation is averaged over
+    @return: The estimated number of bytes
+    """
+    k = len(template_bank)
+    per_sample = 24 * k + 48
+    history = k * (3 * max(template_bank.rates) + window_length(envelope_seconds, rate)) * 8
+    return int(nfft) * per_sample + history
+
+
+def block_size_for_budget(template_bank, memory_budget, rate=44100, envelope_seconds=DEFAULT_WINDOW_SECONDS):
+    """
+    @param template_bank: The TemplateBank holding the calls to detect
+    @param memory_budget: The number of bytes the detector may use
+    @param rate: The sampling rate of the input
+    @param envelope_seconds: How long the squared correlation is averaged over
+    @return: The largest block size whose estimated memory fits in the budget
+    """
+    history = int(template_bank.lengths.max()) - 1
+    fixed = estimate_memory(template_bank, 0, rate, envelope_seconds)
+    nfft = (memory_budget - fixed) // (estimate_memory(template_bank, 1, rate, envelope_seconds) - fixed)
+
+    if nfft - history <= history:
+        needed = estimate_memory(template_bank, 2 * history + 1, rate, envelope_seconds)
+        raise ValueError("A memory budget of " + str(memory_budget) + " bytes is too small for these calls. At least " +
+                         str(needed) + " bytes are needed")
+    return int(nfft - history)
+
+
+def peak_rss_megabytes():
+    """
+    @return: The most memory this process has held at once so far, in megabytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS bytes
+    if sys.platform == "darwin":
+        return peak / 2.0**20
+    return peak / 2.0**10
+
+
+def sweep_file(filename, template_bank, memory_budget=DEFAULT_MEMORY_BUDGET, envelope_seconds=DEFAULT_WINDOW_SECONDS,
+               threshold_mode="global", noise_seconds=DEFAULT_NOISE_SECONDS):
+    """
+    Sweeps a recording of any length against every call without loading it. The memory mapped samples are pushed
+    through a StreamingDetector one block at a time, which carries the overlap between blocks, so calls on a block
+    edge are found exactly as in the whole-signal correlation.
+
+    @param filename: The path of the input signal
+    @param template_bank: The TemplateBank holding the calls to detect
+    @param memory_budget: The number of bytes the detector may use
+    @param envelope_seconds: How long the squared correlation is averaged over
+    @param threshold_mode: One of adaptive_threshold.THRESHOLD_MODES
+    @param noise_seconds: How long the noise floor of the adaptive modes is measured over
+    @return: The sampling rate of the input and the PeakSweep of every call in bank order
+    """
+    fs, samples = open_wav(filename)
+    block_size = block_size_for_budget(template_bank, memory_budget, fs, envelope_seconds)
+    detector = StreamingDetector(template_bank, height=None, rate=fs, envelope_seconds=envelope_seconds,
+                                 block_size=block_size, threshold_mode=threshold_mode, noise_seconds=noise_seconds)
+
+    peaks = [[] for _ in range(len(template_bank))]
+    heights = [[] for _ in range(len(template_bank))]
+
+    def collect(detections):
+        for index, sample, height in detections:
+            peaks[index].append(sample)
+            heights[index].append(height)
+
+    for start in range(0, len(samples), detector.block_size):
+        collect(detector.push(np.asarray(samples[start:start + detector.block_size])))
+    collect(detector.flush())
+
+    if threshold_mode != "global":
+        # The heights are already scores against the noise floor, as PeakSweep.from_scores makes
+        return fs, [PeakSweep(peaks[i], heights[i], 0.0, 1.0) for i in range(len(template_bank))]
+    sweeps = [PeakSweep(peaks[i], heights[i], moments.mean, moments.std) for i, moments in enumerate(detector.moments)]
+    return fs, sweeps
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Correlates long recordings with every bird call in bounded memory")
+    parser.add_argument("run_name", help="The name of the run. It must be unique")
+    parser.add_argument("inputs", nargs="+", help="The input signals")
+    parser.add_argument("--calls", default="Test Bird Calls", help="The folder of known bird calls")
+    parser.add_argument("--output", default="Detected Peaks", help="The folder to write the detections to")
+    parser.add_argument("--budget", type=float, default=DEFAULT_MEMORY_BUDGET / 2.0**20,
+                        help="The memory budget of the detector in megabytes")
+    parser.add_argument("--start", default=DEFAULT_START.isoformat(),
+                        help="The time of the first sample of every input, in ISO format")
+    parser.add_argument("--from-zero", action="store_true",
+                        help="Measure the thresholds from zero instead of the mean, as read_audio.py does in DEBUG_MODE")
+    parser.add_argument("--threshold-mode", choices=THRESHOLD_MODES, default="global",
+                        help="Measure the thresholds against the whole envelope or a rolling noise floor")
+    parser.add_argument("--noise-seconds", type=float, default=DEFAULT_NOISE_SECONDS,
+                        help="How long the rolling noise floor is measured over")
+    args = parser.parse_args()
+    thresholds = DEFAULT_THRESHOLDS if args.threshold_mode == "global" else ADAPTIVE_THRESHOLDS
+
+    template_bank = TemplateBank.from_directory(args.calls)
+    start = datetime.datetime.strptime(args.start, "%Y-%m-%dT%H:%M:%S")
+
+    for filename in args.inputs:
+        start_time = time.time()
+        print("Testing input signal: " + filename)
+        fs, sweeps = sweep_file(filename, template_bank, memory_budget=int(args.budget * 2**20),
+                                threshold_mode=args.threshold_mode, noise_seconds=args.noise_seconds)
+
+        writer = DetectionWriter(start=start, rate=fs)
+        for name, sweep in zip(template_bank.names, sweeps):
+            counts = sweep.sweep(thresholds, relative_to_mean=not args.from_zero)
+            writer.add_sweep(name, thresholds, sweep, counts)
+
+        output_filename = args.output + "/" + run_directory(filename, args.run_name, args.threshold_mode) + ".npz"
+        writer.save(output_filename)
+        print("Saved " + output_filename)
+        # ru_maxrss never goes down, so this is the most any input so far has needed rather than this one's peak
+        print("--- Took %s seconds, peak RSS of the process so far %.1f MB ---" %
+              (time.time() - start_time, peak_rss_megabytes()))
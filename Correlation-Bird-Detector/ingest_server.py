@@ -0,0 +1,520 @@
+#!/usr/bin/python
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from adaptive_threshold import DEFAULT_NOISE_SECONDS, THRESHOLD_MODES
+from detector import MIN_THRESHOLD, save_streamed_peaks
+from envelope import DEFAULT_WINDOW_SECONDS
+from history_store import HistoryStore
+from ingest import open_wav
+from instrumentation import DISABLED, Metrics
+from streaming_detector import StreamingDetector, process_blocks
+from template_bank import TemplateBank
+
+# Every connection starts with one line of JSON, {"site": "north-creek", "start": "2024-01-01T06:00:00", "rate": 44100},
+# which the server answers with {"accepted": true}, or {"error": ...} if it refuses the stream. The recorder then
+# sends little-endian int16 mono PCM until it closes its side, and the server answers with one more line of JSON
+# holding the counters of the stream once every block has been processed. If processing the stream fails, the server
+# answers with {"error": ...} straight away instead and drops the rest of the stream
+PORT = 7843
+CHUNK = 1024
+READ_BYTES = 1 << 16
+# The blocks of one stream waiting to be correlated. A recorder that is further ahead is not read from until the
+# detector catches up, which TCP passes back to it as a full send buffer
+QUEUE_BLOCKS = 4
+# The most streams correlated together in one FFT
+MAX_BATCH = 16
+STATS_SECONDS = 10
+# The threshold of the adaptive modes, in standard deviations of the noise floor, as read_audio.py streams with
+STREAM_THRESHOLD = 5
+
+
+class _Connection:
+    """
+    The state and counters of one recorder's stream. Its blocks are only ever correlated one at a time, in order.
+    """
+
+    def __init__(self, site, start, rate, detector, store, queue_blocks):
+        self.site = site
+        self.start = start
+        self.rate = rate
+        self.detector = detector
+        self.store = store
+        self.queue = asyncio.Queue(queue_blocks)
+        self.busy = False
+        self.finished = asyncio.Event()
+        # Why the stream was closed before all of it was processed, or None
+        self.error = None
+        self.connected = time.perf_counter()
+
+        self.bytes_received = 0
+        self.frames_queued = 0
+        self.frames_processed = 0
+        self.detections = 0
+        self.backpressure_waits = 0
+        self.backpressure_seconds = 0.0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.blocks = 0
+
+    def stats(self):
+        elapsed = time.perf_counter() - self.connected
+        return {
+            "site": self.site,
+            "frames": self.frames_processed,
+            "audio_seconds": self.frames_processed / float(self.rate),
+            "detections": self.detections,
+            "queued_blocks": self.queue.qsize(),
+            # Frames received per second of the connection. A real-time recorder sends one rate's worth
+            "frames_per_second": self.bytes_received / 2.0 / elapsed if elapsed > 0 else 0.0,
+            # From the last byte of a block arriving to its detections being in the store
+            "mean_latency_seconds": self.latency_total / self.blocks if self.blocks else 0.0,
+            "max_latency_seconds": self.latency_max,
+            "backpressure_waits": self.backpressure_waits,
+            "backpressure_seconds": self.backpressure_seconds,
+        }
+
+
+class IngestServer:
+    """
+    Receives int16 PCM streams from many field recorders at once and detects the known calls in all of them. Each
+    stream has a StreamingDetector of its own, but every detector shares one TemplateBank and its cached spectra, and
+    the waiting blocks of up to max_batch streams are correlated together in one batched FFT on a pool of worker
+    threads. The detections of each site go to a HistoryStore of its own under output_directory/<site>, which keeps
+    the site's daily counts.
+
+    Backpressure is per connection: a stream with queue_blocks blocks waiting is not read from until one of them has
+    been correlated, so a recorder sending faster than real time is slowed down without holding back the others.
+    """
+
+    def __init__(self, template_bank, output_directory="Detected Peaks", height=None,
+                 envelope_seconds=DEFAULT_WINDOW_SECONDS, block_size=None, threshold_mode="global",
+                 noise_seconds=DEFAULT_NOISE_SECONDS, min_height=None, workers=1, queue_blocks=QUEUE_BLOCKS,
+                 max_batch=MAX_BATCH, metrics=DISABLED):
+        """
+        @param template_bank: The TemplateBank holding the calls to detect
+        @param output_directory: The folder holding a HistoryStore for each site
+        @param height: The minimum envelope height of a detection, or the minimum score in the adaptive modes
+        @param envelope_seconds: How long the squared correlation is averaged over
+        @param block_size: The number of new samples of each stream correlated per FFT. Defaults to the longest call
+        @param threshold_mode: One of adaptive_threshold.THRESHOLD_MODES
+        @param noise_seconds: How long the noise floor of the adaptive modes is measured over
+        @param min_height: An envelope height the adaptive modes never detect below
+        @param workers: The number of threads correlating batches
+        @param queue_blocks: How many blocks of one stream may wait before it stops being read
+        @param max_batch: The most streams correlated in one FFT
+        @param metrics: The instrumentation.Metrics to report to
+        """
+        self.template_bank = template_bank
+        self.output_directory = output_directory
+        self.workers = max(1, workers)
+        self.queue_blocks = queue_blocks
+        self.max_batch = max_batch
+        self.metrics = metrics
+        self.rate = template_bank.rates[0]
+        self._detector_arguments = dict(height=height, rate=self.rate, envelope_seconds=envelope_seconds,
+                                        block_size=block_size, threshold_mode=threshold_mode,
+                                        noise_seconds=noise_seconds, min_height=min_height)
+        # Every detector has the same FFT size, so the spectra are only computed once
+        self.block_size = StreamingDetector(template_bank, **self._detector_arguments).block_size
+
+        self._connections = {}
+        self._stores = {}
+        self._work_ready = asyncio.Event()
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="IngestWorker")
+        self._next = 0
+        self._started = time.perf_counter()
+        self._cpu_started = time.process_time()
+        self.frames_processed = 0
+        self.batches = 0
+        self.streams_served = 0
+        self._frames_reported = 0
+
+    def _store_for(self, site):
+        if site not in self._stores:
+            self._stores[site] = HistoryStore(os.path.join(self.output_directory, site))
+        return self._stores[site]
+
+    async def handle(self, reader, writer):
+        """
+        Serves one recorder until it closes its stream. Used as the callback of asyncio.start_server.
+        """
+        connection = None
+        reading = None
+        try:
+            try:
+                header = json.loads((await reader.readline()).decode("utf-8"))
+                connection = self._open(header)
+            except (ValueError, KeyError, TypeError) as error:
+                # A header that is not valid JSON, lacks a field or holds one of the wrong type, such as "rate": null
+                writer.write((json.dumps({"error": str(error)}) + "\n").encode("utf-8"))
+                await writer.drain()
+                return
+
+            writer.write((json.dumps({"accepted": True}) + "\n").encode("utf-8"))
+            reading = asyncio.ensure_future(self._read_stream(connection, reader))
+            await connection.finished.wait()
+            if connection.error is not None:
+                # The recorder is told as soon as its stream fails. What it still sends is read and dropped
+                writer.write((json.dumps({"error": connection.error}) + "\n").encode("utf-8"))
+                await writer.drain()
+            await reading
+            if connection.error is None:
+                writer.write((json.dumps(connection.stats()) + "\n").encode("utf-8"))
+                await writer.drain()
+        except ConnectionError:
+            # The recorder went away before it was answered
+            pass
+        finally:
+            if reading is not None and not reading.done():
+                reading.cancel()
+            if connection is not None:
+                del self._connections[connection.site]
+            writer.close()
+
+    def _open(self, header):
+        site = str(header["site"])
+        if not site or site.strip(".") == "" or "/" in site or "\\" in site:
+            raise ValueError("Invalid site " + repr(site))
+        if site in self._connections:
+            raise ValueError("Site " + site + " is already streaming")
+        rate = int(header["rate"])
+        if rate != self.rate:
+            raise ValueError("The stream is at " + str(rate) + "Hz but the calls are at " + str(self.rate) + "Hz")
+        start = datetime.datetime.strptime(header["start"], "%Y-%m-%dT%H:%M:%S")
+
+        detector = StreamingDetector(self.template_bank, **self._detector_arguments)
+        connection = _Connection(site, start, rate, detector, self._store_for(site), self.queue_blocks)
+        self._connections[site] = connection
+        self.streams_served += 1
+        return connection
+
+    async def _read_stream(self, connection, reader):
+        block_bytes = 2 * self.block_size
+        buffered = bytearray()
+        while True:
+            try:
+                data = await reader.read(READ_BYTES)
+            except ConnectionError:
+                # A recorder that drops is treated as the end of its stream, so what it sent is still processed
+                break
+            if not data:
+                break
+            connection.bytes_received += len(data)
+            buffered.extend(data)
+            while len(buffered) >= block_bytes:
+                block = np.frombuffer(bytes(buffered[:block_bytes]), dtype="<i2")
+                del buffered[:block_bytes]
+                await self._enqueue(connection, block, final=False)
+
+        # A trailing odd byte is not a whole sample
+        remainder = np.frombuffer(bytes(buffered[:len(buffered) // 2 * 2]), dtype="<i2")
+        await self._enqueue(connection, remainder, final=True)
+
+    async def _enqueue(self, connection, samples, final):
+        if connection.error is not None:
+            return
+        if connection.queue.full():
+            connection.backpressure_waits += 1
+            waited = time.perf_counter()
+            await connection.queue.put((samples, time.perf_counter(), final))
+            connection.backpressure_seconds += time.perf_counter() - waited
+        else:
+            connection.queue.put_nowait((samples, time.perf_counter(), final))
+        connection.frames_queued += len(samples)
+        self._work_ready.set()
+
+    def _take_batch(self):
+        # The next block of up to max_batch idle streams, starting after the last stream served so none is starved
+        connections = list(self._connections.values())
+        blocks = []
+        finishing = []
+        for k in range(len(connections)):
+            connection = connections[(self._next + k) % len(connections)]
+            if connection.busy or connection.error is not None or connection.queue.empty():
+                continue
+            samples, received, final = connection.queue.get_nowait()
+            connection.busy = True
+            if final:
+                finishing.append((connection, samples, received))
+            else:
+                blocks.append((connection, samples, received))
+            if len(blocks) + len(finishing) >= self.max_batch:
+                self._next = (self._next + k + 1) % len(connections)
+                break
+        return blocks, finishing
+
+    def _process(self, blocks, finishing):
+        # Runs on a worker thread. Only this job touches the detectors and stores of its connections
+        found = []
+        if blocks:
+            detectors = [connection.detector for connection, samples, received in blocks]
+            totals = []
+            for detector, (connection, samples, received) in zip(detectors, blocks):
+                detector.samples_received += len(samples)
+                totals.append(detector.samples_received)
+            with self.metrics.span("correlate", samples=len(blocks) * self.block_size):
+                found.extend(process_blocks(detectors, [samples for connection, samples, received in blocks],
+                                            totals))
+
+        for connection, samples, received in finishing:
+            with self.metrics.span("correlate", samples=len(samples)):
+                found.append(connection.detector.push(samples) + connection.detector.flush())
+
+        with self.metrics.span("serialize"):
+            for (connection, samples, received), detections in zip(blocks + finishing, found):
+                save_streamed_peaks(detections, self.template_bank.filenames, connection.start, rate=connection.rate,
+                                    store=connection.store)
+        return [len(detections) for detections in found]
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            blocks, finishing = self._take_batch()
+            if not blocks and not finishing:
+                self._work_ready.clear()
+                await self._work_ready.wait()
+                continue
+
+            try:
+                counts = await loop.run_in_executor(self._executor, self._process, blocks, finishing)
+            except Exception as error:
+                # A worker that dies would leave its streams waiting forever and stop serving every other stream, so
+                # the streams of the failed batch are closed with the error and the worker carries on
+                self._fail(blocks + finishing, error)
+                self._work_ready.set()
+                continue
+            done = time.perf_counter()
+            self.batches += 1
+            for (connection, samples, received), count in zip(blocks + finishing, counts):
+                connection.busy = False
+                connection.frames_processed += len(samples)
+                connection.detections += count
+                connection.blocks += 1
+                connection.latency_total += done - received
+                connection.latency_max = max(connection.latency_max, done - received)
+                self.frames_processed += len(samples)
+            for connection, samples, received in finishing:
+                connection.finished.set()
+            # The streams just served may have more blocks waiting
+            self._work_ready.set()
+
+    def _fail(self, batch, error):
+        message = "%s: %s" % (type(error).__name__, error)
+        print("Closing the streams of " + ", ".join(connection.site for connection, samples, received in batch) +
+              " after an error. " + message)
+        for connection, samples, received in batch:
+            connection.busy = False
+            connection.error = message
+            # Frees a stream waiting to queue another block, which is then dropped
+            while not connection.queue.empty():
+                connection.queue.get_nowait()
+            connection.finished.set()
+
+    def stats(self):
+        """
+        @return: The counters of the server and of every connected stream
+        """
+        wall_seconds = time.perf_counter() - self._started
+        cpu_seconds = time.process_time() - self._cpu_started
+        audio_seconds = self.frames_processed / float(self.rate)
+        return {
+            "time": time.time(),
+            "streams": len(self._connections),
+            "streams_served": self.streams_served,
+            "batches": self.batches,
+            "frames_processed": self.frames_processed,
+            "frames_per_second": self.frames_processed / wall_seconds if wall_seconds > 0 else 0.0,
+            # How many real-time streams one core could keep up with at the current load
+            "streams_per_core": audio_seconds / cpu_seconds if cpu_seconds > 0 else None,
+            "queued_frames": sum(c.frames_queued - c.frames_processed for c in self._connections.values()),
+            "connections": [connection.stats() for connection in self._connections.values()],
+        }
+
+    async def _report(self, stats_seconds, stats_filename):
+        while True:
+            reported = time.perf_counter()
+            await asyncio.sleep(stats_seconds)
+            stats = self.stats()
+            frames = self.frames_processed - self._frames_reported
+            self._frames_reported = self.frames_processed
+            stats["interval_frames_per_second"] = frames / (time.perf_counter() - reported)
+            self.metrics.set_queue_depth(stats["queued_frames"])
+            self.metrics.end_batch(frames, self.rate)
+            if stats_filename is not None:
+                with open(stats_filename, "a") as stats_file:
+                    stats_file.write(json.dumps(stats) + "\n")
+            print("%d streams, %.0f frames per second, %s real-time streams per core, %d frames queued" %
+                  (stats["streams"], stats["interval_frames_per_second"],
+                   "%.1f" % stats["streams_per_core"] if stats["streams_per_core"] else "-", stats["queued_frames"]))
+
+    async def serve(self, host=None, port=PORT, path=None, stats_seconds=STATS_SECONDS, stats_filename=None,
+                    ready=None):
+        """
+        Accepts recorders until cancelled.
+
+        @param host: The address to listen on for TCP. Every interface if None
+        @param port: The TCP port
+        @param path: A Unix socket to listen on instead of TCP
+        @param stats_seconds: How often to report the counters
+        @param stats_filename: A JSON lines file to append the counters to
+        @param ready: An asyncio.Event set once the server is listening
+        """
+        if path is not None:
+            server = await asyncio.start_unix_server(self.handle, path)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+        tasks.append(asyncio.ensure_future(self._report(stats_seconds, stats_filename)))
+        if ready is not None:
+            ready.set()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+            self._executor.shutdown(wait=True)
+
+
+async def replay(filename, site, host="127.0.0.1", port=PORT, path=None, speed=1.0, start=None, chunk=CHUNK):
+    """
+    Streams a wav file to an IngestServer as a field recorder would.
+
+    @param filename: The wav file to replay
+    @param site: The ID of the site the recording is from
+    @param host: The address of the server
+    @param port: Its TCP port
+    @param path: Its Unix socket, instead of TCP
+    @param speed: How many times faster than real time to send. None sends as fast as the server takes it
+    @param start: The time of the first sample. Now if None
+    @param chunk: The frames sent at once
+    @return: The counters the server answers with once it has processed the whole stream, or the reason it refused it
+    """
+    rate, samples = open_wav(filename)
+    if path is not None:
+        reader, writer = await asyncio.open_unix_connection(path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+
+    if start is None:
+        start = datetime.datetime.now()
+    header = {"site": site, "start": start.strftime("%Y-%m-%dT%H:%M:%S"), "rate": rate}
+    writer.write((json.dumps(header) + "\n").encode("utf-8"))
+    reply = json.loads((await reader.readline()).decode("utf-8"))
+    if "error" in reply:
+        writer.close()
+        return reply
+
+    started = time.perf_counter()
+    for position in range(0, len(samples), chunk):
+        frames = np.asarray(samples[position:position + chunk], dtype="<i2")
+        if speed:
+            # Wait until the last frame of the chunk would have been recorded
+            delay = started + (position + len(frames)) / float(rate * speed) - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        writer.write(frames.tobytes())
+        # Waits while the server is not reading this stream
+        await writer.drain()
+
+    writer.write_eof()
+    reply = json.loads((await reader.readline()).decode("utf-8"))
+    writer.close()
+    return reply
+
+
+async def load_test(filename, n_streams, host="127.0.0.1", port=PORT, path=None, speed=1.0):
+    """
+    Replays the same recording from n_streams client processes at once, each as a site of its own.
+
+    @return: The counters the server answered each client with
+    """
+    address = ["--path", path] if path is not None else ["--host", host, "--port", str(port)]
+    clients = [await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), "replay", filename,
+                                                    "--site", "load-%03d" % i, "--speed", str(speed), *address,
+                                                    stdout=asyncio.subprocess.PIPE)
+               for i in range(n_streams)]
+    outputs = await asyncio.gather(*[client.communicate() for client in clients])
+    return [json.loads(stdout.decode("utf-8").strip().splitlines()[-1]) for stdout, stderr in outputs]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Detects the known calls in audio streamed from many field recorders")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    for name in ["serve", "replay", "load"]:
+        subparser = subparsers.add_parser(name)
+        subparser.add_argument("--host", default=None if name == "serve" else "127.0.0.1",
+                               help="The TCP address of the server")
+        subparser.add_argument("--port", type=int, default=PORT, help="The TCP port of the server")
+        subparser.add_argument("--path", default=None, help="A Unix socket to use instead of TCP")
+
+    serve = subparsers.choices["serve"]
+    serve.description = "Accepts streams and writes the detections of each site to its own history"
+    serve.add_argument("--calls", default="Test Bird Calls", help="The folder of known bird calls")
+    serve.add_argument("--output", default="Detected Peaks", help="The folder holding the history of every site")
+    serve.add_argument("--workers", type=int, default=1, help="The number of threads correlating batches")
+    serve.add_argument("--max-batch", type=int, default=MAX_BATCH, help="The most streams correlated in one FFT")
+    serve.add_argument("--queue-blocks", type=int, default=QUEUE_BLOCKS,
+                       help="How many blocks of one stream may wait before it stops being read")
+    serve.add_argument("--threshold-mode", choices=THRESHOLD_MODES, default="global",
+                       help="Use the minimum threshold alone or a number of standard deviations of the noise floor")
+    serve.add_argument("--noise-seconds", type=float, default=DEFAULT_NOISE_SECONDS,
+                       help="How long the rolling noise floor is measured over")
+    serve.add_argument("--stats-seconds", type=float, default=STATS_SECONDS, help="How often to report the counters")
+    serve.add_argument("--stats-file", default=None, help="A JSON lines file to append the counters to")
+    serve.add_argument("--metrics-log", default=None, help="A JSON lines file for the instrumentation batches")
+    serve.add_argument("--prometheus-file", default=None, help="A Prometheus text format file of the running totals")
+
+    for name in ["replay", "load"]:
+        subparsers.choices[name].add_argument("input", help="The wav file to replay")
+        subparsers.choices[name].add_argument("--speed", type=float, default=1.0,
+                                              help="How many times faster than real time to send. 0 sends as fast "
+                                                   "as the server takes it")
+    subparsers.choices["replay"].add_argument("--site", required=True, help="The ID of the recorder's site")
+    subparsers.choices["load"].add_argument("--streams", type=int, default=4,
+                                            help="The number of client processes to replay from at once")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        template_bank = TemplateBank.from_directory(args.calls)
+        # As in read_audio.py, the global mode detects above the minimum threshold and the adaptive modes above
+        # STREAM_THRESHOLD standard deviations of the noise floor, never below the minimum threshold
+        if args.threshold_mode == "global":
+            height, min_height = template_bank.scale_height(MIN_THRESHOLD), None
+        else:
+            height, min_height = STREAM_THRESHOLD, template_bank.scale_height(MIN_THRESHOLD)
+        metrics = Metrics(log_filename=args.metrics_log, prometheus_filename=args.prometheus_file)
+        server = IngestServer(template_bank, args.output, height=height, threshold_mode=args.threshold_mode,
+                              noise_seconds=args.noise_seconds, min_height=min_height, workers=args.workers,
+                              queue_blocks=args.queue_blocks, max_batch=args.max_batch, metrics=metrics)
+        print("Listening on " + (args.path or "%s:%d" % (args.host or "*", args.port)))
+        try:
+            asyncio.run(server.serve(args.host, args.port, args.path, args.stats_seconds, args.stats_file))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            metrics.close()
+    elif args.command == "replay":
+        print(json.dumps(asyncio.run(replay(args.input, args.site, args.host, args.port, args.path,
+                                            args.speed or None))))
+    else:
+        started = time.time()
+        replies = asyncio.run(load_test(args.input, args.streams, args.host, args.port, args.path, args.speed))
+        for reply in replies:
+            print(json.dumps(reply))
+        failed = [reply for reply in replies if "error" in reply]
+        print("--- %d streams took %s seconds, %d refused, worst latency %.3f seconds ---" %
+              (len(replies), time.time() - started, len(failed),
+               max([reply.get("max_latency_seconds", 0.0) for reply in replies] or [0.0])))
@@ -0,0 +1,250 @@
+import json
+import os
+import threading
+import time
+
+# The stages of the pipeline, in the order they run
+STAGES = ["capture", "correlate", "envelope", "peak-find", "serialize", "change-check"]
+# Capture mostly waits for audio to arrive, so it is left out of the real-time factor
+PROCESSING_STAGES = [stage for stage in STAGES if stage != "capture"]
+METRIC_PREFIX = "bird_detector_"
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("metrics", "stage", "species", "samples", "_started")
+
+    def __init__(self, metrics, stage, species, samples):
+        self.metrics = metrics
+        self.stage = stage
+        self.species = species
+        self.samples = samples
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics._record(self.stage, time.perf_counter() - self._started, self.species, self.samples)
+        return False
+
+
+class Metrics:
+    """
+    Times the stages of the detector and counts what it processes. Time is measured in named spans:
+
+        with metrics.span("envelope", species=bird_name):
+            envelope = compute_envelope(corr, rate)
+
+    and every call to end_batch() writes one JSON line with the time each stage and each species took in the batch,
+    the samples processed, the real-time factor, the audio frames dropped and the capture queue depth. The running
+    totals are also written to a Prometheus text format file, which node_exporter's textfile collector or any local
+    scraper can read.
+
+    Disabled metrics, with no log, Prometheus file or echo, hand out one shared span that does nothing, so the
+    instrumented code costs a method call per span. Spans may be timed on several threads at once.
+    """
+
+    def __init__(self, log_filename=None, prometheus_filename=None, echo=False, log_spans=False):
+        """
+        @param log_filename: The JSON lines file to append the batches to
+        @param prometheus_filename: The Prometheus text format file to rewrite after every batch
+        @param echo: Whether to print the time every span takes, as the old verbose output did
+        @param log_spans: Whether to also write a JSON line for every span, not only for every batch
+        """
+        self.log_filename = log_filename
+        self.prometheus_filename = prometheus_filename
+        self.echo = echo
+        self.log_spans = log_spans
+        self.enabled = bool(log_filename or prometheus_filename or echo)
+
+        self.batches = 0
+        self.samples = 0
+        self.dropped_frames = 0
+        self.queue_depth = 0
+        self.real_time_factor = float("nan")
+        self.stage_seconds = dict((stage, 0.0) for stage in STAGES)
+        self.stage_spans = dict((stage, 0) for stage in STAGES)
+        self.species_seconds = {}
+        self._log_file = None
+        self._lock = threading.RLock()
+        self._start_batch()
+
+    def _start_batch(self):
+        self._batch_started = time.perf_counter()
+        self._batch_stages = {}
+        self._batch_species = {}
+        self._batch_dropped = 0
+
+    def span(self, stage, species=None, samples=0):
+        """
+        @param stage: One of STAGES
+        @param species: The name of the bird the work is for, if it is for one
+        @param samples: The number of audio samples the work covers
+        @return: A context manager timing the code inside it
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, stage, species, samples)
+
+    def _record(self, stage, seconds, species, samples):
+        with self._lock:
+            self._record_locked(stage, seconds, species, samples)
+
+    def _record_locked(self, stage, seconds, species, samples):
+        self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+        self.stage_spans[stage] = self.stage_spans.get(stage, 0) + 1
+        self._batch_stages[stage] = self._batch_stages.get(stage, 0.0) + seconds
+
+        if species is not None:
+            key = (species, stage)
+            self.species_seconds[key] = self.species_seconds.get(key, 0.0) + seconds
+            by_stage = self._batch_species.setdefault(species, {})
+            by_stage[stage] = by_stage.get(stage, 0.0) + seconds
+
+        if self.echo:
+            print("--- " + stage + ("" if species is None else " of " + species) + " took %s seconds ---" % seconds)
+        if self.log_spans:
+            self._write_line({"event": "span", "time": time.time(), "batch": self.batches + 1, "stage": stage,
+                              "species": species, "seconds": seconds, "samples": samples})
+
+    def add_dropped_frames(self, frames):
+        """
+        @param frames: The number of audio frames lost since the last call
+        """
+        if frames > 0:
+            with self._lock:
+                self.dropped_frames += frames
+                self._batch_dropped += frames
+
+    def set_queue_depth(self, frames):
+        """
+        @param frames: The number of captured frames waiting to be processed
+        """
+        self.queue_depth = frames
+
+    def end_batch(self, samples, rate):
+        """
+        Reports the batch that has just been processed and starts the next one.
+
+        @param samples: The number of audio samples in the batch
+        @param rate: The sampling rate of the audio
+        @return: The batch record, or None if the metrics are disabled
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            return self._end_batch(samples, rate)
+
+    def _end_batch(self, samples, rate):
+        self.batches += 1
+        self.samples += samples
+        processing_seconds = sum(self._batch_stages.get(stage, 0.0) for stage in PROCESSING_STAGES)
+        audio_seconds = samples / float(rate) if rate else 0.0
+        self.real_time_factor = processing_seconds / audio_seconds if audio_seconds > 0 else float("nan")
+
+        record = {
+            "event": "batch",
+            "time": time.time(),
+            "batch": self.batches,
+            "seconds": time.perf_counter() - self._batch_started,
+            "samples": samples,
+            "audio_seconds": audio_seconds,
+            # Below 1 keeps up with the audio
+            "real_time_factor": self.real_time_factor,
+            "stages": self._batch_stages,
+            "species": self._batch_species,
+            "dropped_frames": self._batch_dropped,
+            "queue_depth": self.queue_depth,
+        }
+        self._write_line(record)
+        self.write_prometheus()
+        if self.echo:
+            print("--- Batch %d: %.3f seconds of processing for %.1f seconds of audio, real-time factor %.4f ---" %
+                  (self.batches, processing_seconds, audio_seconds, self.real_time_factor))
+        self._start_batch()
+        return record
+
+    def _write_line(self, record):
+        if self.log_filename is None:
+            return
+        if self._log_file is None:
+            directory = os.path.dirname(self.log_filename)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._log_file = open(self.log_filename, "a")
+        # NaN is not valid JSON
+        if record.get("real_time_factor") != record.get("real_time_factor"):
+            record["real_time_factor"] = None
+        self._log_file.write(json.dumps(record) + "\n")
+        self._log_file.flush()
+
+    def prometheus_text(self):
+        """
+        @return: The running totals in the Prometheus text exposition format
+        """
+        lines = []
+
+        def metric(name, kind, description, samples):
+            lines.append("# HELP " + METRIC_PREFIX + name + " " + description)
+            lines.append("# TYPE " + METRIC_PREFIX + name + " " + kind)
+            for labels, value in samples:
+                label_text = ",".join('%s="%s"' % (key, _escape_label(label)) for key, label in labels)
+                lines.append(METRIC_PREFIX + name + ("{" + label_text + "}" if label_text else "") + " " +
+                             _format_value(value))
+
+        metric("stage_seconds_total", "counter", "Time spent in each stage of the pipeline.",
+               [([("stage", stage)], seconds) for stage, seconds in sorted(self.stage_seconds.items())])
+        metric("stage_spans_total", "counter", "Number of times each stage ran.",
+               [([("stage", stage)], spans) for stage, spans in sorted(self.stage_spans.items())])
+        metric("species_seconds_total", "counter", "Time spent in each stage for each species.",
+               [([("species", species), ("stage", stage)], seconds)
+                for (species, stage), seconds in sorted(self.species_seconds.items())])
+        metric("samples_total", "counter", "Audio samples processed.", [([], self.samples)])
+        metric("batches_total", "counter", "Batches processed.", [([], self.batches)])
+        metric("dropped_frames_total", "counter", "Audio frames lost before they could be processed.",
+               [([], self.dropped_frames)])
+        metric("queue_depth_frames", "gauge", "Captured audio frames waiting to be processed.",
+               [([], self.queue_depth)])
+        metric("real_time_factor", "gauge", "Processing time over audio time of the last batch.",
+               [([], self.real_time_factor)])
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self):
+        if self.prometheus_filename is None:
+            return
+        # Scrapers must never see half a file, so it is written aside and moved into place
+        temporary_filename = self.prometheus_filename + ".tmp"
+        with open(temporary_filename, "w") as prometheus_file:
+            prometheus_file.write(self.prometheus_text())
+        os.replace(temporary_filename, self.prometheus_filename)
+
+    def close(self):
+        if self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
+
+
+def _format_value(value):
+    value = float(value)
+    if value != value:
+        return "NaN"
+    return repr(value)
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+# Used wherever no metrics are handed in
+DISABLED = Metrics()
@@ -0,0 +1,219 @@
+#!/usr/bin/python
+
+import argparse
+import datetime
+import time
+
+import numpy as np
+from scipy.io import wavfile
+
+from adaptive_threshold import ADAPTIVE_THRESHOLDS, DEFAULT_NOISE_SECONDS, THRESHOLD_MODES, make_sweep
+from batch_runner import DEFAULT_START, DEFAULT_THRESHOLDS, run_directory
+from envelope import DEFAULT_WINDOW_SECONDS, ENVELOPE_METHODS, compute_envelope
+from instrumentation import DISABLED
+from peak_io import DetectionWriter
+from template_bank import PRECISIONS, TemplateBank
+
+# Detections on different channels within FUSE_SECONDS of each other are taken to be the same call. This covers the
+# delay between microphones a few metres apart and the jitter of the envelope's peak
+FUSE_SECONDS = 0.25
+# How many channels must detect a call for the fused list to keep it
+MIN_CHANNELS = 2
+
+
+def read_channels(filename):
+    """
+    @param filename: The path of a wav file with one or more channels
+    @return: The sampling rate and an (n_channels, n_samples) view of a memory map of the samples
+    """
+    fs, samples = wavfile.read(filename, mmap=True)
+    if samples.ndim == 1:
+        samples = samples[:, np.newaxis]
+    return fs, samples.T
+
+
+def sweep_channels(template_bank, channels, rate, envelope_seconds=DEFAULT_WINDOW_SECONDS, envelope_method="boxcar",
+                   threshold_mode="global", noise_seconds=DEFAULT_NOISE_SECONDS, min_height=None, batch_size=1,
+                   metrics=DISABLED):
+    """
+    Correlates every channel with every call in one batched FFT per batch of calls, then sweeps the envelope of each
+    channel on its own. Each channel's sweep is the one a mono recording of that channel would give.
+
+    @param template_bank: The TemplateBank holding the calls to detect
+    @param channels: An (n_channels, n_samples) array of audio
+    @param rate: The sampling rate of the audio
+    @param envelope_seconds: How long the squared correlation is averaged over
+    @param envelope_method: One of envelope.ENVELOPE_METHODS
+    @param threshold_mode: One of adaptive_threshold.THRESHOLD_MODES
+    @param noise_seconds: How long the noise floor of the adaptive modes is measured over
+    @param min_height: An envelope height the adaptive modes never detect below
+    @param batch_size: How many calls to correlate at once. Each one holds a correlation of every channel
+    @param metrics: The instrumentation.Metrics the time of each step is reported to
+    @return: A list of the PeakSweep of every channel for each call, in bank order
+    """
+    sweeps = []
+    correlations = template_bank.iter_correlations(channels, batch_size=batch_size)
+    for index in range(len(template_bank)):
+        bird_name = template_bank.names[index]
+        with metrics.span("correlate", species=bird_name, samples=channels.shape[0] * channels.shape[1]):
+            index, channel_correlations = next(correlations)
+
+        channel_sweeps = []
+        for corr in channel_correlations:
+            with metrics.span("envelope", species=bird_name, samples=len(corr)):
+                envelope = compute_envelope(corr, rate, window_seconds=envelope_seconds, method=envelope_method,
+                                            dtype=template_bank.dtype, overwrite=True)
+            with metrics.span("peak-find", species=bird_name, samples=len(envelope)):
+                channel_sweeps.append(make_sweep(envelope, template_bank.rates[index], rate, threshold_mode,
+                                                 noise_seconds, min_height))
+        sweeps.append(channel_sweeps)
+    return sweeps
+
+
+def fuse_peaks(peaks, scores, tolerance, min_channels=MIN_CHANNELS):
+    """
+    Merges the detections of a call on several channels into one. Detections are chained together while each is
+    within tolerance samples of the one before it, and the chain is reported at its highest scoring detection.
+
+    @param peaks: An array of the detections of each channel, in samples
+    @param scores: An array of the score of each detection, such as its height in standard deviations of its channel
+    @param tolerance: How many samples apart the detections of one call on different channels may be
+    @param min_channels: How many channels must detect a call for it to be kept
+    @return: The sample of every fused detection in time order, and how many channels detected it
+    """
+    samples = np.concatenate([np.asarray(p, dtype=np.int64) for p in peaks])
+    if len(samples) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    channels = np.concatenate([np.full(len(p), c, dtype=np.int64) for c, p in enumerate(peaks)])
+    scores = np.concatenate([np.asarray(s, dtype=np.float64) for s in scores])
+
+    order = np.argsort(samples, kind="stable")
+    samples, channels, scores = samples[order], channels[order], scores[order]
+    cluster = np.concatenate(([0], np.cumsum(np.diff(samples) > tolerance)))
+    n_clusters = int(cluster[-1]) + 1
+
+    # Each (cluster, channel) pair is only counted once, however many peaks the channel has in the cluster
+    pairs = np.unique(cluster * len(peaks) + channels)
+    n_channels = np.bincount(pairs // len(peaks), minlength=n_clusters)
+
+    best = np.lexsort((-scores, cluster))
+    first = np.flatnonzero(np.diff(np.concatenate(([-1], cluster[best]))))
+    fused = samples[best[first]]
+
+    kept = n_channels >= min_channels
+    return fused[kept], n_channels[kept]
+
+
+def fuse_sweeps(channel_sweeps, counts, tolerance, min_channels=MIN_CHANNELS):
+    """
+    @param channel_sweeps: The PeakSweep of every channel for one call
+    @param counts: The number of detections of each channel at every threshold, as returned by sweep.sweep()
+    @param tolerance: How many samples apart the detections of one call on different channels may be
+    @param min_channels: How many channels must detect a call for it to be kept. At most every channel
+    @return: An array of the fused detections in samples at each threshold
+    """
+    min_channels = min(min_channels, len(channel_sweeps))
+    # The channels are compared in standard deviations, as their gains differ
+    scores = [(sweep.heights - sweep.mean) / sweep.std if sweep.std > 0 else sweep.heights
+              for sweep in channel_sweeps]
+
+    fused = []
+    for t in range(len(counts[0])):
+        samples, n_channels = fuse_peaks([sweep.peaks[:count[t]] for sweep, count in zip(channel_sweeps, counts)],
+                                         [score[:count[t]] for score, count in zip(scores, counts)], tolerance,
+                                         min_channels)
+        fused.append(samples)
+    return fused
+
+
+def detect_channels(template_bank, channels, rate, thresholds, relative_to_mean=True, min_height=None, fuse=True,
+                    fuse_seconds=FUSE_SECONDS, min_channels=MIN_CHANNELS, **kwargs):
+    """
+    @param template_bank: The TemplateBank holding the calls to detect
+    @param channels: An (n_channels, n_samples) array of audio
+    @param rate: The sampling rate of the audio
+    @param thresholds: The thresholds in standard deviations
+    @param relative_to_mean: Whether the thresholds are measured from the mean of the envelope or from zero
+    @param min_height: An envelope height the thresholds are never allowed to go below
+    @param fuse: Whether to also fuse the detections of the channels
+    @param fuse_seconds: How far apart the detections of one call on different channels may be
+    @param min_channels: How many channels must detect a call for the fused list to keep it
+    @param kwargs: Passed on to sweep_channels
+    @return: The PeakSweep of every channel for each call, the number of detections of each at every threshold as
+    sweep.sweep() returns them, and the fused detections of each call at every threshold, or None if fuse is False
+    """
+    adaptive = kwargs.get("threshold_mode", "global") != "global"
+    sweeps = sweep_channels(template_bank, channels, rate, min_height=min_height if adaptive else None, **kwargs)
+    if adaptive:
+        # The minimum height has already been applied to the envelope
+        min_height = None
+
+    counts = [[sweep.sweep(thresholds, relative_to_mean=relative_to_mean, min_height=min_height)
+               for sweep in channel_sweeps] for channel_sweeps in sweeps]
+    fused = None
+    if fuse:
+        fused = [fuse_sweeps(channel_sweeps, channel_counts, int(fuse_seconds * rate), min_channels)
+                 for channel_sweeps, channel_counts in zip(sweeps, counts)]
+    return sweeps, counts, fused
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Correlates every channel of multi-channel recordings with every "
+                                                 "bird call in one batched pass")
+    parser.add_argument("run_name", help="The name of the run. It must be unique")
+    parser.add_argument("inputs", nargs="+", help="The input signals, each with one channel per microphone")
+    parser.add_argument("--calls", default="Test Bird Calls", help="The folder of known bird calls")
+    parser.add_argument("--output", default="Detected Peaks", help="The folder to write the detections to")
+    parser.add_argument("--start", default=DEFAULT_START.isoformat(),
+                        help="The time of the first sample of every input, in ISO format")
+    parser.add_argument("--from-zero", action="store_true",
+                        help="Measure the thresholds from zero instead of the mean, as read_audio.py does in DEBUG_MODE")
+    parser.add_argument("--envelope-method", choices=ENVELOPE_METHODS, default="boxcar",
+                        help="How the envelope of the correlation is found")
+    parser.add_argument("--threshold-mode", choices=THRESHOLD_MODES, default="global",
+                        help="Measure the thresholds against the whole envelope or a rolling noise floor")
+    parser.add_argument("--noise-seconds", type=float, default=DEFAULT_NOISE_SECONDS,
+                        help="How long the rolling noise floor is measured over")
+    parser.add_argument("--no-fuse", action="store_true", help="Only write the detections of each channel")
+    parser.add_argument("--fuse-seconds", type=float, default=FUSE_SECONDS,
+                        help="How far apart the detections of one call on different channels may be")
+    parser.add_argument("--min-channels", type=int, default=MIN_CHANNELS,
+                        help="How many channels must detect a call for the fused detections to keep it")
+    parser.add_argument("--batch-size", type=int, default=1, help="How many calls to correlate at once")
+    parser.add_argument("--precision", choices=PRECISIONS, default="float64",
+                        help="Correlate the raw samples in float64 or the normalised samples in float32")
+    parser.add_argument("--fft-workers", type=int, default=None,
+                        help="The number of threads the FFTs of the channels are split over. -1 uses every core")
+    args = parser.parse_args()
+    thresholds = DEFAULT_THRESHOLDS if args.threshold_mode == "global" else ADAPTIVE_THRESHOLDS
+
+    template_bank = TemplateBank.from_directory(args.calls, precision=args.precision, workers=args.fft_workers)
+    start = datetime.datetime.strptime(args.start, "%Y-%m-%dT%H:%M:%S")
+
+    for filename in args.inputs:
+        start_time = time.time()
+        print("Testing input signal: " + filename)
+        fs, channels = read_channels(filename)
+        sweeps, counts, fused = detect_channels(template_bank, channels, fs, thresholds,
+                                                relative_to_mean=not args.from_zero, fuse=not args.no_fuse,
+                                                fuse_seconds=args.fuse_seconds, min_channels=args.min_channels,
+                                                envelope_method=args.envelope_method,
+                                                threshold_mode=args.threshold_mode, noise_seconds=args.noise_seconds,
+                                                batch_size=args.batch_size)
+
+        # One run per channel, named like the mono runs so check_results.py scores each of them
+        for channel in range(channels.shape[0]):
+            writer = DetectionWriter(start=start, rate=fs)
+            for name, channel_sweeps, channel_counts in zip(template_bank.names, sweeps, counts):
+                writer.add_sweep(name, thresholds, channel_sweeps[channel], channel_counts[channel])
+            run_name = args.run_name + " channel %d" % (channel + 1)
+            writer.save(args.output + "/" + run_directory(filename, run_name, args.threshold_mode) + ".npz")
+
+        if fused is not None:
+            writer = DetectionWriter(start=start, rate=fs)
+            for name, call_fused in zip(template_bank.names, fused):
+                for threshold, samples in zip(thresholds, call_fused):
+                    writer.add(name, threshold, samples)
+            writer.save(args.output + "/" + run_directory(filename, args.run_name + " fused", args.threshold_mode) +
+                        ".npz")
+        print("--- " + str(channels.shape[0]) + " channels took %s seconds ---" % (time.time() - start_time))
@@ -0,0 +1,117 @@
+from collections import deque
+
+import numpy as np
+from scipy.special import gammaln
+
+HAZARD = 1.0 / 100
+PRIOR_SHAPE = 1.0
+PRIOR_RATE = 0.1
+MAX_RUN_LENGTH = 365
+LOOK_BACK = 5
+THRESHOLD = 0.5
+
+
+class PoissonGammaChangepoint:
+    """
+    Online Bayesian changepoint detection (Adams and MacKay, 2007) for daily or hourly call counts.
+
+    The counts of each run between changes are Poisson with a Gamma(PRIOR_SHAPE, PRIOR_RATE) prior on the rate, and a
+    change happens before any count with probability hazard. The posterior over the run length, the number of counts
+    since the last change, is updated with the negative binomial predictive of each run length as every count arrives.
+    Run lengths past max_run_length are dropped, so memory and the cost of an update stay constant.
+
+    The change probability is the probability that the current run is at most look_back counts long.
+    """
+
+    def __init__(self, hazard=HAZARD, prior_shape=PRIOR_SHAPE, prior_rate=PRIOR_RATE, max_run_length=MAX_RUN_LENGTH,
+                 look_back=LOOK_BACK, threshold=THRESHOLD):
+        """
+        @param hazard: The probability of a change before each count
+        @param prior_shape: The shape of the Gamma prior on the rate of a run
+        @param prior_rate: The rate of the Gamma prior on the rate of a run
+        @param max_run_length: The longest run length kept in the posterior
+        @param look_back: How many of the latest counts a change may be in to be reported
+        @param threshold: The change probability at which change is declared
+        """
+        self.hazard = hazard
+        self.prior_shape = prior_shape
+        self.prior_rate = prior_rate
+        self.max_run_length = max_run_length
+        self.look_back = look_back
+        self.threshold = threshold
+
+        self.days = 0
+        # Entry r - 1 holds run length r: its probability and the Gamma posterior of its rate
+        self.run_length_probability = np.zeros(0)
+        self._shape = np.zeros(0)
+        self._rate = np.zeros(0)
+        self._counts = deque(maxlen=2 * max_run_length)
+        # The most likely run length after each count, to find where the run before a change started
+        self._run_lengths = deque(maxlen=max_run_length + 1)
+
+        self.change_probability = 0.0
+        self.rate_before = self.rate_after = float("nan")
+
+    @staticmethod
+    def _log_predictive(count, shape, rate):
+        # The negative binomial probability of the count under a Gamma(shape, rate) posterior on the rate
+        return (gammaln(shape + count) - gammaln(shape) - gammaln(count + 1) +
+                shape * np.log(rate / (rate + 1)) - count * np.log(rate + 1))
+
+    def update(self, count):
+        """
+        @param count: The next count
+        @return: Whether change was detected and a message, like detect_historical_cusum
+        """
+        count = float(count)
+        self.days += 1
+        self._counts.append(count)
+
+        if len(self.run_length_probability) == 0:
+            log_probability = np.zeros(1)
+        else:
+            log_joint = (np.log(np.maximum(self.run_length_probability, 1e-300)) +
+                         self._log_predictive(count, self._shape, self._rate))
+            # A new run starts with this count, which is only predicted by the prior
+            log_change = np.log(self.hazard) + self._log_predictive(count, self.prior_shape, self.prior_rate)
+            log_probability = np.concatenate(([log_change], log_joint + np.log(1 - self.hazard)))
+
+        # Every run length now includes this count
+        self._shape = np.concatenate(([self.prior_shape], self._shape)) + count
+        self._rate = np.concatenate(([self.prior_rate], self._rate)) + 1
+
+        if len(log_probability) > self.max_run_length:
+            log_probability = log_probability[:self.max_run_length]
+            self._shape = self._shape[:self.max_run_length]
+            self._rate = self._rate[:self.max_run_length]
+
+        probability = np.exp(log_probability - log_probability.max())
+        self.run_length_probability = probability / probability.sum()
+        self._estimate()
+        self._run_lengths.append(self.most_likely_run_length())
+
+        if self.days <= self.look_back:
+            return False, "Not enough data to detect change "
+        if self.change_probability < self.threshold:
+            return False, "--- No change detected "
+        if self.rate_after > self.rate_before:
+            return True, "--- Change detected! Average calls went up "
+        return True, "--- Change detected! Average calls went down "
+
+    def _estimate(self):
+        recent = self.run_length_probability[:self.look_back]
+        self.change_probability = float(recent.sum())
+
+        # The rate since the most likely recent change, and the rate of the run that was going on before it
+        run_length = int(np.argmax(recent)) + 1
+        self.rate_after = float(self._shape[run_length - 1] / self._rate[run_length - 1])
+
+        previous_run_length = self.max_run_length
+        if run_length <= len(self._run_lengths):
+            previous_run_length = self._run_lengths[-run_length]
+        counts = np.array(self._counts)
+        before = counts[max(len(counts) - run_length - previous_run_length, 0):len(counts) - run_length]
+        self.rate_before = float((self.prior_shape + before.sum()) / (self.prior_rate + len(before)))
+
+    def most_likely_run_length(self):
+        return int(np.argmax(self.run_length_probability)) + 1 if len(self.run_length_probability) else 0
@@ -0,0 +1,165 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+def to_datetime64(timestamp):
+    """
+    @param timestamp: A datetime.datetime, np.datetime64 or pd.Timestamp
+    @return: The timestamp as a np.datetime64 in microseconds
+    """
+    return np.datetime64(pd.Timestamp(timestamp).to_datetime64(), "us")
+
+
+def samples_to_datetime64(samples, rate, start):
+    """
+    Vectorised version of start + datetime.timedelta(seconds=sample / rate), rounded to the microsecond in the same
+    way as datetime.timedelta.
+
+    @param samples: An array of sample offsets from the start of the recording
+    @param rate: The sampling rate of the recording
+    @param start: The time of the first sample
+    @return: An array of np.datetime64 timestamps in microseconds
+    """
+    microseconds = np.round(np.asarray(samples, dtype=np.float64) / float(rate) * 1e6).astype(np.int64)
+    return to_datetime64(start) + microseconds.astype("timedelta64[us]")
+
+
+def format_timestamps(timestamps, unit="us"):
+    """
+    @param timestamps: An array of np.datetime64 timestamps
+    @param unit: "us" for microseconds, or "ms" for the milliseconds MATLAB's datestr writes
+    @return: An array of strings in the TIMESTAMP_FORMAT used by the csv files
+    """
+    return np.datetime_as_string(np.asarray(timestamps).astype("datetime64[" + unit + "]"), unit=unit)
+
+
+class DetectionWriter:
+    """
+    Collects the detections of every bird and threshold in a run and saves them as one columnar .npz file, instead of
+    one csv of formatted strings per bird and threshold.
+
+    Each row is one detection: the index of the bird, the threshold it was detected at and its sample offset from
+    the start of the recording. Every (bird, threshold) pair that was tested is listed separately, so thresholds
+    without any detections are still scored.
+    """
+
+    def __init__(self, start, rate):
+        """
+        @param start: The time of the first sample of the input signal
+        @param rate: The sampling rate of the input signal
+        """
+        self.start = to_datetime64(start)
+        self.rate = rate
+        self.birds = []
+        self._bird_index = {}
+        self._columns = {"bird": [], "threshold": [], "sample": []}
+        self._tested = {"tested_bird": [], "tested_threshold": []}
+
+    def _index_of(self, bird_name):
+        if bird_name not in self._bird_index:
+            self._bird_index[bird_name] = len(self.birds)
+            self.birds.append(bird_name)
+        return self._bird_index[bird_name]
+
+    def add(self, bird_name, threshold, samples):
+        """
+        @param bird_name: The name of the bird that was detected
+        @param threshold: The threshold the detections were made at
+        @param samples: The sample offsets of the detections
+        """
+        samples = np.sort(np.asarray(samples, dtype=np.int64))
+        self._tested["tested_bird"].append(self._index_of(bird_name))
+        self._tested["tested_threshold"].append(threshold)
+        self._columns["bird"].append(np.full(len(samples), self._index_of(bird_name), dtype=np.int32))
+        self._columns["threshold"].append(np.full(len(samples), threshold, dtype=np.float64))
+        self._columns["sample"].append(samples)
+
+    def add_sweep(self, bird_name, thresholds, sweep, counts):
+        """
+        @param bird_name: The name of the bird that was detected
+        @param thresholds: The thresholds that were swept
+        @param sweep: The PeakSweep of the bird's envelope
+        @param counts: The number of detections at each threshold, as returned by sweep.sweep(thresholds)
+        """
+        for threshold, count in zip(thresholds, counts):
+            self.add(bird_name, threshold, sweep.peaks[:count])
+
+    def save(self, filename):
+        """
+        @param filename: The .npz file to write
+        """
+        columns = {}
+        for name, dtype in [("bird", np.int32), ("threshold", np.float64), ("sample", np.int64)]:
+            parts = self._columns[name]
+            columns[name] = np.concatenate(parts) if parts else np.zeros(0, dtype=dtype)
+
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        np.savez(filename, birds=np.array(self.birds, dtype=str), start=np.array(self.start), rate=np.array(self.rate),
+                 tested_bird=np.array(self._tested["tested_bird"], dtype=np.int32),
+                 tested_threshold=np.array(self._tested["tested_threshold"], dtype=np.float64), **columns)
+
+
+def load_detections(filename):
+    """
+    @param filename: An .npz file written by DetectionWriter
+    @return: A DataFrame with one row per detection and the columns Bird, Threshold, Sample and Timestamp, a
+    DataFrame of every Bird and Threshold that was tested, the start time and the sampling rate of the recording
+    """
+    with np.load(filename) as data:
+        birds = data["birds"]
+        start = data["start"][()]
+        rate = data["rate"][()]
+
+        detections = pd.DataFrame({
+            "Bird": pd.Categorical.from_codes(data["bird"], categories=birds),
+            "Threshold": data["threshold"],
+            "Sample": data["sample"],
+        })
+        tested = pd.DataFrame({
+            "Bird": pd.Categorical.from_codes(data["tested_bird"], categories=birds),
+            "Threshold": data["tested_threshold"],
+        })
+
+    detections["Timestamp"] = samples_to_datetime64(detections["Sample"].values, rate, start)
+    return detections, tested, start, rate
+
+
+def export_csv(filename, directory):
+    """
+    Writes a run in the original layout of one csv per bird and threshold, <directory>/<bird>/<threshold>.csv, each
+    starting with the start of the recording as the reference row
+
+    @param filename: An .npz file written by DetectionWriter
+    @param directory: The folder to write the csv files to
+    """
+    detections, tested, start, rate = load_detections(filename)
+    timestamps = format_timestamps(detections["Timestamp"].values)
+    reference = format_timestamps([start])[0]
+    groups = detections.groupby(["Bird", "Threshold"], observed=True).indices
+
+    for bird_name, threshold in zip(tested["Bird"], tested["Threshold"]):
+        bird_directory = os.path.join(directory, bird_name)
+        if not os.path.isdir(bird_directory):
+            os.makedirs(bird_directory)
+
+        rows = groups.get((bird_name, threshold), [])
+        with open(os.path.join(bird_directory, str(threshold) + ".csv"), "w") as csv_file:
+            csv_file.write(reference + "\n")
+            for timestamp in timestamps[rows]:
+                csv_file.write(timestamp + "\n")
+
+
+if __name__ == "__main__":
+    # Usage: python peak_io.py "Detected Peaks/<run>.npz" [output directory]
+    run_file = sys.argv[1]
+    output_directory = sys.argv[2] if len(sys.argv) > 2 else run_file.split(".npz")[0]
+    export_csv(run_file, output_directory)
+    print("Exported " + run_file + " to " + output_directory)
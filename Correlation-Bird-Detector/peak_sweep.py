@@ -0,0 +1,92 @@
+import numpy as np
+from scipy import signal
+
+
+class PeakSweep:
+    """
+    Every peak of an envelope that survives the distance suppression, sorted from highest to lowest.
+
+    A peak is only ever suppressed by a higher peak, and a higher peak passes every threshold the lower one does. So
+    signal.find_peaks(envelope, height=h, distance=d) is exactly the peaks of the sweep with a height of at least h.
+    Any number of thresholds can then be read off with a binary search instead of another pass over the envelope.
+    """
+
+    def __init__(self, peaks, heights, mean, std):
+        """
+        @param peaks: The sample index of each peak left after distance suppression without a height limit
+        @param heights: The envelope value at each peak
+        @param mean: The mean of the whole envelope
+        @param std: The standard deviation of the whole envelope
+        """
+        order = np.argsort(heights, kind="stable")[::-1]
+        self.peaks = np.asarray(peaks, dtype=np.int64)[order]
+        self.heights = np.asarray(heights, dtype=np.float64)[order]
+        self.mean = float(mean)
+        self.std = float(std)
+
+    @classmethod
+    def from_envelope(cls, envelope, distance):
+        """
+        @param envelope: The envelope of the correlation
+        @param distance: The minimum number of samples between two detections
+        @return: The PeakSweep of the envelope
+        """
+        peaks, properties = signal.find_peaks(envelope, distance=distance)
+        return cls(peaks, envelope[peaks], envelope.mean(), envelope.std())
+
+    @classmethod
+    def from_scores(cls, scores, distance):
+        """
+        @param scores: The envelope in local standard deviations above the noise floor, from adaptive_threshold
+        @param distance: The minimum number of samples between two detections
+        @return: The PeakSweep of the scores. Its thresholds are in local standard deviations, so the mean is 0 and
+        the standard deviation 1
+        """
+        peaks, properties = signal.find_peaks(scores, distance=distance)
+        return cls(peaks, scores[peaks], 0.0, 1.0)
+
+    def __len__(self):
+        return len(self.peaks)
+
+    def height_for(self, threshold, relative_to_mean=True, min_height=None):
+        """
+        @param threshold: The threshold in standard deviations
+        @param relative_to_mean: Whether the threshold is measured from the mean of the envelope or from zero
+        @param min_height: A height the threshold is never allowed to go below
+        @return: The absolute envelope height the threshold corresponds to
+        """
+        height = threshold * self.std
+        if relative_to_mean:
+            height = height + self.mean
+        if min_height is not None and height < min_height:
+            height = min_height
+        return height
+
+    def counts(self, heights):
+        """
+        @param heights: An array of absolute envelope heights
+        @return: The number of detections at each height
+        """
+        return np.searchsorted(-self.heights, -np.asarray(heights, dtype=np.float64), side="right")
+
+    def detections(self, height):
+        """
+        @param height: The absolute envelope height
+        @return: The sorted sample indices of the peaks detected at that height
+        """
+        return np.sort(self.peaks[:self.counts(height)])
+
+    def sweep(self, thresholds, relative_to_mean=True, min_height=None):
+        """
+        @param thresholds: An array of thresholds in standard deviations
+        @param relative_to_mean: Whether the thresholds are measured from the mean of the envelope or from zero
+        @param min_height: A height the thresholds are never allowed to go below
+        @return: The number of detections at each threshold. The detections at threshold i are self.peaks[:counts[i]]
+        """
+        thresholds = np.asarray(thresholds, dtype=np.float64)
+        heights = thresholds * self.std
+        if relative_to_mean:
+            heights = heights + self.mean
+        if min_height is not None:
+            heights = np.maximum(heights, min_height)
+        return self.counts(heights)
@@ -1,126 +1,50 @@
 #!/usr/bin/python
 
-import pyaudio
-import matplotlib.pyplot as plt
-import numpy as np
-import pandas as pd
-from pandas.io.common import EmptyDataError
-from scipy import signal
-from scipy.io import wavfile
-import time
+import argparse
 import datetime
 from glob import glob
 from os import path
-import os
-
-import detect_historical_cusum as detect_cusum
-
-# Index 2 is the microphone!
-audio = pyaudio.PyAudio()
-for i in range(audio.get_device_count()):
-    dev = audio.get_device_info_by_index(i)
-    print(i, dev["name"], dev["maxInputChannels"])
-
-
-def get_audio_from_file(filename):
-    print("Using existing data...")
-    fs, amplitude = wavfile.read("Input Signals/" + filename)
-    return amplitude
-
-
-def get_mic_data():
-    audio = pyaudio.PyAudio()
-
-    stream = audio.open(
-        format=FORMAT,
-        channels=CHANNELS,
-        rate=RATE,
-        frames_per_buffer=CHUNK,
-        input_device_index=MIC_INDEX,
-        input=True)
-
-    print("recording...")
-    frames = []
-
-    for i in range(0, int(RATE / CHUNK * RECORD_SECONDS)):
-        data = stream.read(CHUNK, exception_on_overflow=False)
-        # data = stream.read(CHUNK)
-
-        frames.append(data)
-    byteAudio = b''.join(frames)
-    print("finished recording")
-
-    # stop Recording
-    stream.stop_stream()
-    stream.close()
-    audio.terminate()
-    amplitude = np.frombuffer(byteAudio, np.int16)
-    return amplitude
-
-
-def detect_correlation_peaks(inputSignal, fileNameToDetect, start_dt, thresholds=[3], use_mic=False, days=0):
-    if DEBUG_MODE:
-        print("Correlating signal...")
-    intermediate_time = time.time()
-    # Correlate the data with a plover call
-    fs, call_to_detect = wavfile.read(fileNameToDetect)
-    call_to_detect = call_to_detect[:, 0]
-    call_to_detect = call_to_detect[::-1]
-
-    corr = signal.fftconvolve(inputSignal, call_to_detect, mode="same")
-    if DEBUG_MODE:
-        print("--- Took %s seconds ---" % (time.time() - intermediate_time))
-        intermediate_time = time.time()
-
-    if DEBUG_MODE:
-        print("Finding envelope of correlation...")
-    # Find the envelope of the cross correlation by squaring and filtering
-    N = 10000
-    envelope = corr * corr
-    envelope = signal.fftconvolve(envelope, np.ones((N,)) / N, mode="valid")
-    if DEBUG_MODE:
-        print("--- Took %s seconds ---" % (time.time() - intermediate_time))
-        intermediate_time = time.time()
-
-    bird_name = fileNameToDetect.split(".wav")[0]
-    bird_name = bird_name.split("/")[-1]
-
-    print("Finding signal peaks of " + bird_name)
-    min_threshold = 1 * 10**16
-    df = pd.DataFrame()
-
-    for threshold in thresholds:
-        if DEBUG_MODE:
-            print("Using threshold of " + str(threshold) + " standard deviations")
-            smooth_std = threshold * envelope.std()
-        else:
-            smooth_std = envelope.mean() + threshold * envelope.std()
-
-        # This minimum threshold is a way to avoid the system detecting calls when there's nothing similar at all
-        if smooth_std < min_threshold and use_mic:
-            smooth_std = min_threshold
-
-        # The calls must at least be separated by 5s
-        peaks, properties = signal.find_peaks(envelope, height=smooth_std, distance=fs)
 
-        # plot_correlation_envelope(plt, envelope, peaks, smooth_std)
-
-        detected_peaks_sec = peaks / float(RATE)
-        delta = []
-        for time_s in detected_peaks_sec:
-            if DEBUG_MODE:
-                timestamp = datetime.datetime(year=2000, month=1, day=1) + datetime.timedelta(seconds=time_s)
-            else:
-                timestamp = start_dt + datetime.timedelta(seconds=time_s)
-            timestamp = timestamp + datetime.timedelta(days=days)
-            delta.append(timestamp.strftime("%Y-%m-%dT%H:%M:%S.%f"))
-
-        df[threshold] = pd.Series(delta)
+import numpy as np
+from scipy.io import wavfile
 
-    if DEBUG_MODE:
-        print("--- Took %s seconds ---" % (time.time() - intermediate_time))
+from adaptive_threshold import ADAPTIVE_THRESHOLDS, DEFAULT_NOISE_SECONDS, THRESHOLD_MODES
+from batch_runner import run_directory
+from capture import BUFFER_SECONDS, CapturePipeline, MicrophoneSource, RingBuffer, WavSource
+from detector import (DEBUG_START, MIC_INDEX, MIN_THRESHOLD, OUTPUT_DIRECTORY, RATE, RECORD_SECONDS,
+                      check_changes, detect_correlation_peaks, iter_timed_correlations, list_audio_devices,
+                      save_peak_data, save_streamed_peaks, sweep_correlation_peaks)
+from envelope import DEFAULT_WINDOW_SECONDS, ENVELOPE_METHODS
+from history_store import HistoryStore
+from instrumentation import Metrics
+from peak_io import DetectionWriter
+from template_bank import PRECISIONS, TemplateBank
+
+# The defaults of the command line flags
+USE_MIC = False
+USE_STREAMING = False
+DEBUG_MODE = True
 
-    return df
+WAVE_OUTPUT_FILENAME = "file.wav"
+# "npz" writes one file of detections per run, "csv" writes one csv per bird and threshold
+OUTPUT_FORMAT = "npz"
+# The envelope is the squared correlation averaged over this many seconds. See envelope.ENVELOPE_METHODS
+ENVELOPE_SECONDS = DEFAULT_WINDOW_SECONDS
+ENVELOPE_METHOD = "boxcar"
+# "cusum" checks the history every 5 days, "bocpd" updates online_changepoint.PoissonGammaChangepoint every day
+CHANGE_DETECTOR = "cusum"
+# "global" measures thresholds against the whole envelope, "rolling" and "robust" against the noise floor of the last
+# NOISE_SECONDS. See adaptive_threshold.THRESHOLD_MODES
+THRESHOLD_MODE = "global"
+NOISE_SECONDS = DEFAULT_NOISE_SECONDS
+# The threshold of the adaptive modes while streaming, in standard deviations of the noise floor
+STREAM_THRESHOLD = 5
+# How many seconds of the microphone stream each batch of metrics covers
+METRICS_SECONDS = 10
+# "float32" halves the memory of the correlations of the file and recording modes. See template_bank.PRECISIONS
+PRECISION = "float64"
+# The threads the inverse FFTs of the calls are split over. -1 uses every core
+FFT_WORKERS = 1
 
 
 def write_recording():
@@ -134,39 +58,6 @@ def write_recording():
     # waveFile.close()
 
 
-def save_peak_data(peaks, filename, directory=None, use_mic=False):
-    # Extract the name of the bird from filename of known signal
-    bird_name = filename.split(".")[0]
-    bird_name = bird_name.split("/")[-1]
-
-    if OUTPUT_DIRECTORY not in os.listdir(os.getcwd()):
-        os.makedirs("Detected Peaks")
-
-    if use_mic:
-        try:
-            historical_peaks = pd.read_csv(OUTPUT_DIRECTORY + "/" + bird_name + ".csv", header=None)
-            peaks.columns = historical_peaks.columns
-        except (EmptyDataError, IOError):
-            historical_peaks = pd.DataFrame()
-
-        historical_peaks = historical_peaks.append(peaks, ignore_index=True)
-        historical_peaks.to_csv(OUTPUT_DIRECTORY + "/" + bird_name + ".csv", index=False, header=None)
-    else:
-        subdirectory = directory
-        if directory is None:
-            subdirectory = "Correlation " + datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-        if subdirectory not in os.listdir(os.getcwd() + "/" + OUTPUT_DIRECTORY):
-            os.makedirs(OUTPUT_DIRECTORY + "/" + subdirectory)
-
-        if bird_name not in os.listdir(os.getcwd() + "/" + OUTPUT_DIRECTORY + "/" + subdirectory):
-            os.makedirs(OUTPUT_DIRECTORY + "/" + subdirectory + "/" + bird_name)
-
-        for threshold in peaks.columns:
-            peaks_dropped_nan = peaks[threshold].dropna(how="any")
-            peaks_dropped_nan.to_csv(OUTPUT_DIRECTORY + "/" + subdirectory + "/" + bird_name + "/" + str(threshold) + ".csv", index=False)
-
-
 def plot_correlation_envelope(plt, envelope, peaks, smooth_std):
     # Plot the correlation envelope with the detected peak values
     fig = plt.figure()
@@ -200,94 +91,265 @@ def plot_spectrogram(plt, amplitude, filename):
     fig.savefig("Graphs/" + filename + "/spectrogram.png", format="png", dpi=300, bbox_inches="tight")
 
 
-# The main method
-plt.rcParams['agg.path.chunksize'] = 20000
-
-USE_MIC = False
-DEBUG_MODE = True
+def import_pyplot():
+    # Only the debugging plots need matplotlib, so it is imported when one is drawn
+    import matplotlib.pyplot as plt
+    plt.rcParams['agg.path.chunksize'] = 20000
+    return plt
 
-FORMAT = pyaudio.paInt16
-CHANNELS = 1
-RATE = 44100
-CHUNK = 1024
-MIC_INDEX = 2
-RECORD_SECONDS = 20
-WAVE_OUTPUT_FILENAME = "file.wav"
-OUTPUT_DIRECTORY = "Detected Peaks"
 
-# TODO: get this list from /"Actual Data" instead
-# TODO: get calls from glob
+def open_source(args):
+    # A recording replayed as if it were the microphone makes the live paths testable without an audio device
+    if args.replay is not None:
+        return WavSource(args.replay, speed=args.speed or None)
+    return MicrophoneSource(rate=RATE, mic_index=args.mic_index)
 
-callsToDetect = glob("Test Bird Calls/*")
-check_change = datetime.timedelta(seconds=30)
 
-if USE_MIC:
+def run_stream(template_bank, args, metrics):
+    print("Streaming the microphone as input...")
+    start_dt = datetime.datetime.now()
+    state = {"days": 0, "batch_start": 0}
+    source = open_source(args)
+
+    samples_per_day = source.rate * args.record_seconds
+    samples_per_batch = source.rate * METRICS_SECONDS
+    store = HistoryStore(args.output)
+    changepoints = {}
+
+    def save(detections):
+        with metrics.span("serialize"):
+            save_streamed_peaks(detections, template_bank.filenames, start_dt, state["days"], rate=source.rate,
+                                store=store)
+
+    def poll(pipeline):
+        processed = min(pipeline.frames_processed)
+        while processed >= (state["days"] + 1) * samples_per_day:
+            state["days"] += 1
+            print("Day " + str(state["days"]))
+            check_changes(template_bank.filenames, start_dt, state["days"], changepoints,
+                          change_detector=args.change_detector, store=store, metrics=metrics)
+
+        if processed - state["batch_start"] >= samples_per_batch:
+            metrics.end_batch(processed - state["batch_start"], source.rate)
+            state["batch_start"] = processed
+
+    # Capture carries on in a ring buffer while the workers correlate, so no audio is missed. The detectors keep
+    # their overlap between blocks, so calls spanning two blocks are still detected.
+    # There is no whole signal to take the standard deviation of, so the global mode uses the minimum threshold on its
+    # own. The adaptive modes measure against the noise floor so far and keep the minimum threshold as a floor
+    if args.threshold_mode == "global":
+        height, min_height = template_bank.scale_height(MIN_THRESHOLD), None
+    else:
+        height, min_height = STREAM_THRESHOLD, template_bank.scale_height(MIN_THRESHOLD)
+    pipeline = CapturePipeline(source, template_bank, height=height, envelope_seconds=args.envelope_seconds,
+                               workers=args.workers, buffer_seconds=args.buffer_seconds, on_detections=save,
+                               metrics=metrics, threshold_mode=args.threshold_mode, noise_seconds=args.noise_seconds,
+                               min_height=min_height)
+    try:
+        pipeline.run(on_poll=poll)
+    finally:
+        print("Captured " + str(pipeline.frames_captured) + " frames, dropped " + str(pipeline.frames_dropped) +
+              ", coverage %.4f%%" % (100 * pipeline.coverage()))
+
+
+def run_mic(template_bank, args, metrics):
     print("Using microphone as input...")
-    startup_time = datetime.datetime.now()
     days = 0
+    store = HistoryStore(args.output)
+    changepoints = {}
+    # Recording n is dated n days after the day the program started
+    first_day = datetime.datetime.now() + datetime.timedelta(days=1)
+    # Debugging without a recording to replay searches the same file over and over
+    reuse_file = args.debug and args.replay is None
+
+    if not reuse_file:
+        # Recording carries on into a ring buffer while each recording is searched, so none of it is missed
+        source = open_source(args)
+        samples_per_recording = source.rate * args.record_seconds
+        ring = RingBuffer(samples_per_recording + source.rate * args.buffer_seconds)
+        capture_start = datetime.datetime.now()
+        source.start(ring)
+        reported_dropped = 0
 
     while True:
-        if DEBUG_MODE:
+        if reuse_file:
             fs, inputSignal = wavfile.read("Input Signals/trimmed_no_overlap.wav")
+            start_dt = datetime.datetime.now()
         else:
             days = days + 1
             print("Day " + str(days))
-            inputSignal = get_mic_data()
-
-        start_dt = datetime.datetime.now()
-        start_time = intermediate_time = time.time()
-
-        for fileNameToDetect in callsToDetect:
+            with metrics.span("capture", samples=samples_per_recording):
+                position, inputSignal = ring.read(max_frames=samples_per_recording,
+                                                  min_frames=samples_per_recording)
+            if len(inputSignal) == 0:
+                break
+
+            metrics.set_queue_depth(len(ring))
+            metrics.add_dropped_frames(ring.frames_dropped - reported_dropped)
+            reported_dropped = ring.frames_dropped
+            start_dt = capture_start + datetime.timedelta(seconds=ring.stream_position(position) / float(source.rate))
+
+        for index, corr in iter_timed_correlations(template_bank, inputSignal, metrics):
+            fileNameToDetect = template_bank.filenames[index]
+            # This minimum threshold is a way to avoid the system detecting calls when there's nothing similar at all
             detected_peaks = detect_correlation_peaks(inputSignal=inputSignal, fileNameToDetect=fileNameToDetect,
-                                                      start_dt=start_dt, use_mic=True, days=days)
-            save_peak_data(detected_peaks, fileNameToDetect, use_mic=True)
+                                                      start_dt=DEBUG_START if args.debug else start_dt,
+                                                      relative_to_mean=not args.debug,
+                                                      min_height=template_bank.scale_height(MIN_THRESHOLD), days=days,
+                                                      corr=corr, fs=template_bank.rates[index],
+                                                      envelope_seconds=args.envelope_seconds,
+                                                      envelope_method=args.envelope_method,
+                                                      threshold_mode=args.threshold_mode,
+                                                      noise_seconds=args.noise_seconds, overwrite=True,
+                                                      metrics=metrics)
+            with metrics.span("serialize", species=template_bank.names[index]):
+                save_peak_data(detected_peaks, fileNameToDetect, use_mic=True, store=store)
 
-        print("--- Batch took %s seconds to process ---" % (time.time() - start_time))
+        check_changes(template_bank.filenames, start_dt, days, changepoints, change_detector=args.change_detector,
+                      store=store, metrics=metrics, first_day=first_day)
 
-        if days % 5 == 0:
-            print("Checking for change detection...")
+        metrics.end_batch(len(inputSignal), RATE)
 
-            for fileNameToDetect in callsToDetect:
-                bird_name = fileNameToDetect.split(".wav")[0]
-                bird_name = bird_name.split("/")[-1]
 
-                # Get the csv data for the bird removed
-                try:
-                    date_range = pd.date_range(start_dt, periods=days).tolist()
-                    daily_counts = pd.Series(date_range)
-                    daily_counts = daily_counts.dt.normalize().value_counts() - 1
-
-                    historical_peaks = pd.read_csv(OUTPUT_DIRECTORY + "/" + bird_name + ".csv", header=None)
-                    historical_peaks = pd.to_datetime(historical_peaks[historical_peaks.columns[0]], format="%Y-%m-%dT%H:%M:%S.%f")
-
-                    historical_counts = historical_peaks.dt.normalize().value_counts()
-                    daily_counts = daily_counts.add(historical_counts, fill_value=0)
-                    change, message = detect_cusum.detect_historical_cusum(daily_counts, threshold=2, look_back=5)
-                    print(message + "for " + bird_name)
-                except (EmptyDataError, IOError):
-                    print("There was no data to examine for " + bird_name)
-
-else:
+def run_files(template_bank, args, metrics):
     print("Using existing data as input...")
 
-    pattern = "Input Signals/*.wav"
-    files = [path.basename(x) for x in glob(pattern)]
+    files = [path.basename(x) for x in glob(args.inputs)]
+    input_directory = path.dirname(args.inputs)
 
     start_dt = datetime.datetime.now()
+    recording_start = DEBUG_START if args.debug else start_dt
 
     for filename in files:
         print("Testing input signal: " + filename)
-        fs, inputSignal = wavfile.read("Input Signals/" + filename)
+        fs, inputSignal = wavfile.read(path.join(input_directory, filename))
 
-        SNR = filename.split(".wav")[0]
-        directory = "Correlation " + SNR + "dB " + datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        run_name = args.run_name
+        if run_name is None:
+            run_name = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        directory = run_directory(filename, run_name, args.threshold_mode)
 
-        for fileNameToDetect in callsToDetect:
+        thresholds = np.arange(0, 0.005, 0.0001)
+        if args.threshold_mode != "global":
+            thresholds = ADAPTIVE_THRESHOLDS
+        writer = DetectionWriter(start=recording_start, rate=RATE)
+
+        for index, corr in iter_timed_correlations(template_bank, inputSignal, metrics):
+            fileNameToDetect = template_bank.filenames[index]
+            bird_name = template_bank.names[index]
             # if fileNameToDetect != "Test Bird Calls/Common Koel (eudynamys-scolopacea).wav":
             #     continue
 
-            detected_peaks = detect_correlation_peaks(inputSignal=inputSignal, fileNameToDetect=fileNameToDetect,
-                                                      start_dt=start_dt, thresholds=np.arange(0, 0.005, 0.0001))
-            save_peak_data(detected_peaks, fileNameToDetect, directory=directory)
+            if args.format == "npz":
+                sweep = sweep_correlation_peaks(inputSignal, fileNameToDetect, corr=corr, fs=template_bank.rates[index],
+                                                envelope_seconds=args.envelope_seconds,
+                                                envelope_method=args.envelope_method,
+                                                threshold_mode=args.threshold_mode, noise_seconds=args.noise_seconds,
+                                                overwrite=True, metrics=metrics)
+                with metrics.span("peak-find", species=bird_name):
+                    counts = sweep.sweep(thresholds, relative_to_mean=not args.debug)
+                with metrics.span("serialize", species=bird_name):
+                    writer.add_sweep(bird_name, thresholds, sweep, counts)
+            else:
+                detected_peaks = detect_correlation_peaks(inputSignal=inputSignal, fileNameToDetect=fileNameToDetect,
+                                                          start_dt=recording_start, thresholds=thresholds,
+                                                          relative_to_mean=not args.debug, corr=corr,
+                                                          fs=template_bank.rates[index],
+                                                          envelope_seconds=args.envelope_seconds,
+                                                          envelope_method=args.envelope_method,
+                                                          threshold_mode=args.threshold_mode,
+                                                          noise_seconds=args.noise_seconds, overwrite=True,
+                                                          metrics=metrics)
+                with metrics.span("serialize", species=bird_name):
+                    save_peak_data(detected_peaks, fileNameToDetect, directory=directory, output_directory=args.output,
+                                   start_dt=recording_start)
+
+        # Every bird and threshold of the run goes into one file. Use peak_io.export_csv for the csv layout
+        if args.format == "npz":
+            with metrics.span("serialize"):
+                writer.save(args.output + "/" + directory + ".npz")
+
+        metrics.end_batch(len(inputSignal), fs)
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Detects known bird calls by correlating them with audio")
+    parser.add_argument("--mic", action="store_true", default=USE_MIC,
+                        help="Record from the microphone instead of reading the input signals")
+    parser.add_argument("--stream", action="store_true", default=USE_STREAMING,
+                        help="Correlate the microphone continuously instead of one recording at a time")
+    parser.add_argument("--debug", dest="debug", action="store_true", default=DEBUG_MODE,
+                        help="Measure thresholds from zero and date detections from 2000-01-01")
+    parser.add_argument("--no-debug", dest="debug", action="store_false",
+                        help="Measure thresholds from the mean and date detections from the current time")
+    parser.add_argument("--list-devices", action="store_true", help="List the audio devices and exit")
+    parser.add_argument("--mic-index", type=int, default=MIC_INDEX, help="The audio device to record from")
+    parser.add_argument("--record-seconds", type=int, default=RECORD_SECONDS,
+                        help="How long each recording (one simulated day) lasts")
+    parser.add_argument("--replay", default=None,
+                        help="A wav file to replay in place of the microphone, to test the live modes")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="How many times faster than real time to replay. 0 replays as fast as it is processed")
+    parser.add_argument("--workers", type=int, default=1, help="The number of threads correlating the stream")
+    parser.add_argument("--buffer-seconds", type=int, default=BUFFER_SECONDS,
+                        help="How much audio the capture buffer holds beyond one recording")
+    parser.add_argument("--change-detector", choices=["cusum", "bocpd"], default=CHANGE_DETECTOR,
+                        help="Refit a CUSUM every 5 days or update an online Bayesian changepoint detector every day")
+    parser.add_argument("--calls", default="Test Bird Calls", help="The folder of known bird calls")
+    parser.add_argument("--inputs", default="Input Signals/*.wav", help="A glob of the input signals")
+    parser.add_argument("--output", default=OUTPUT_DIRECTORY, help="The folder to write the detections to")
+    parser.add_argument("--format", choices=["npz", "csv"], default=OUTPUT_FORMAT,
+                        help="One .npz file per run or one csv per bird and threshold")
+    parser.add_argument("--run-name", default=None, help="Replaces the current time in the names of the run folders")
+    parser.add_argument("--envelope-seconds", type=float, default=ENVELOPE_SECONDS,
+                        help="How long the squared correlation is averaged over")
+    parser.add_argument("--envelope-method", choices=ENVELOPE_METHODS, default=ENVELOPE_METHOD,
+                        help="How the envelope of the correlation is found")
+    parser.add_argument("--threshold-mode", choices=THRESHOLD_MODES, default=THRESHOLD_MODE,
+                        help="Measure the thresholds against the whole envelope or a rolling noise floor")
+    parser.add_argument("--noise-seconds", type=float, default=NOISE_SECONDS,
+                        help="How long the rolling noise floor is measured over")
+    parser.add_argument("--precision", choices=PRECISIONS, default=PRECISION,
+                        help="Correlate the raw samples in float64 or the normalised samples in float32")
+    parser.add_argument("--fft-workers", type=int, default=FFT_WORKERS,
+                        help="The number of threads the inverse FFTs of the calls are split over. -1 uses every core")
+    parser.add_argument("--timings", action="store_true", help="Print the time every stage takes for every bird")
+    parser.add_argument("--metrics-log", default=None,
+                        help="A JSON lines file to append the stage timings, real-time factor and dropped frames of "
+                             "every batch to")
+    parser.add_argument("--log-spans", action="store_true",
+                        help="Also write every stage of every bird to the metrics log, not only the batch totals")
+    parser.add_argument("--prometheus-file", default=None,
+                        help="A Prometheus text format file of the running totals, rewritten after every batch")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    if args.list_devices:
+        list_audio_devices()
+        return
+
+    # TODO: get this list from /"Actual Data" instead
+    template_bank = TemplateBank.from_directory(args.calls, precision=args.precision, workers=args.fft_workers)
+
+    metrics = Metrics(log_filename=args.metrics_log, prometheus_filename=args.prometheus_file, echo=args.timings,
+                      log_spans=args.log_spans)
+    if args.replay is not None:
+        args.mic = True
+
+    try:
+        if args.mic and args.stream:
+            run_stream(template_bank, args, metrics)
+        elif args.mic:
+            run_mic(template_bank, args, metrics)
+        else:
+            run_files(template_bank, args, metrics)
+    finally:
+        metrics.close()
+
+    print("finished it!")
+
 
-print("finished it!")
+if __name__ == "__main__":
+    main()
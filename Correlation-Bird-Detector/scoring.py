@@ -0,0 +1,190 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from peak_io import load_detections
+
+COLUMNS = ["Bird", "Threshold (# std)", "True Positives", "False Positives", "True Negatives", "False Negatives",
+           "False Alarm Rate", "True Positive Rate"]
+
+NANOSECONDS = 10**9
+
+# DO NOT set tolerance to an integer! Use
+TOLERANCE = 3.0
+TOTAL_EVENTS = 600
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+def to_offsets(timestamps):
+    """
+    @param timestamps: A Series or array of timestamps whose first entry is the reference time (t=0)
+    @return: A sorted int64 array of the nanoseconds from the reference to every other timestamp
+    """
+    timestamps = np.asarray(timestamps, dtype="datetime64[ns]").astype(np.int64)
+    return np.sort(timestamps[1:] - timestamps[0])
+
+
+def truth_offsets(actual_calls_df):
+    """
+    @param actual_calls_df: The actual calls of a bird as read from "Actual Results", whose first row is the reference
+    time
+    @return: A sorted int64 array of the nanoseconds from the reference to every call
+    """
+    return to_offsets(pd.to_datetime(actual_calls_df[actual_calls_df.columns[0]], format=TIMESTAMP_FORMAT))
+
+
+def _one_to_one(actual, detected, half_window):
+    # Every call takes the earliest free detection in its window. As all windows are the same width this gives the
+    # largest possible number of matches
+    detected = detected.tolist()
+    true_positive = j = 0
+    for call in actual.tolist():
+        while j < len(detected) and detected[j] <= call - half_window:
+            j += 1
+        if j < len(detected) and detected[j] < call + half_window:
+            true_positive += 1
+            j += 1
+    return true_positive
+
+
+def true_positives(actual, detections, tolerance, one_to_one=False):
+    """
+    Counts the calls with a detection strictly within tolerance / 2 seconds of them, for every threshold at once.
+
+    @param actual: A sorted int64 array of call times in nanoseconds
+    @param detections: A list with a sorted int64 array of detection times in nanoseconds for each threshold
+    @param tolerance: The width of the window around each call in seconds
+    @param one_to_one: Whether a detection can only be matched to a single call
+    @return: An array of the number of true positives at each threshold
+    """
+    half_window = int(round(tolerance * NANOSECONDS / 2))
+    actual = np.asarray(actual, dtype=np.int64)
+    detections = [np.asarray(detected, dtype=np.int64) for detected in detections]
+
+    if one_to_one:
+        return np.array([_one_to_one(actual, detected, half_window) for detected in detections], dtype=np.int64)
+
+    n_detections = sum(len(detected) for detected in detections)
+    if len(actual) == 0 or n_detections == 0:
+        return np.zeros(len(detections), dtype=np.int64)
+
+    low = min(actual.min() - half_window, min(detected.min() for detected in detections if len(detected)))
+    high = max(actual.max() + half_window, max(detected.max() for detected in detections if len(detected)))
+    span = int(high - low + 1)
+
+    if span * len(detections) >= 2**62:
+        # Too long to stack into one sorted array, so search each threshold separately
+        counts = []
+        for detected in detections:
+            lower = np.searchsorted(detected, actual - half_window, side="right")
+            upper = np.searchsorted(detected, actual + half_window, side="left")
+            counts.append(np.count_nonzero(upper > lower))
+        return np.array(counts, dtype=np.int64)
+
+    # Give every threshold its own range of a single sorted array so one search covers them all
+    offsets = np.arange(len(detections), dtype=np.int64) * span
+    keys = np.concatenate([offset + (detected - low) for offset, detected in zip(offsets, detections)])
+
+    starts = offsets[:, None] + (actual - half_window - low)[None, :]
+    lower = np.searchsorted(keys, starts, side="right")
+    upper = np.searchsorted(keys, starts + 2 * half_window, side="left")
+    return np.count_nonzero(upper > lower, axis=1)
+
+
+def score_bird(bird_name, thresholds, actual, detections, total_events, tolerance, extra_detections=0,
+               one_to_one=False):
+    """
+    Scores every threshold of a bird and returns the rows of the ROC table in one frame.
+
+    @param bird_name: The name of the bird
+    @param thresholds: The threshold of each entry of detections
+    @param actual: A sorted int64 array of call times in nanoseconds from the reference time
+    @param detections: A list with a sorted int64 array of detection times in nanoseconds for each threshold
+    @param total_events: The number of events the true negatives are counted out of
+    @param tolerance: The width of the window around each call in seconds
+    @param extra_detections: The number of detections at each threshold which are not in detections but still count
+    as false positives, such as the first row of the csv files written by read_audio.py
+    @param one_to_one: Whether a detection can only be matched to a single call
+    @return: A DataFrame with the COLUMNS of the ROC table and one row per threshold
+    """
+    n_calls = len(actual)
+    n_detections = np.array([len(detected) for detected in detections], dtype=np.int64) + np.asarray(extra_detections)
+
+    true_positive = true_positives(actual, detections, tolerance, one_to_one=one_to_one)
+    false_negative = n_calls - true_positive
+    false_positive = n_detections - true_positive
+
+    true_negative = total_events - true_positive - false_positive - false_negative
+
+    if (true_negative < 0).any():
+        print("Impossible results! True negative was " + str(true_negative.min()))
+        true_negative = np.maximum(true_negative, 0)
+    if (false_positive < 0).any():
+        print("Impossible results! False positive was " + str(false_positive.min()))
+        false_positive = np.maximum(false_positive, 0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        true_positive_rate = true_positive / (true_positive + false_negative).astype(np.float64)
+        false_alarm_rate = false_positive / (false_positive + true_negative).astype(np.float64)
+
+    return pd.DataFrame({
+        COLUMNS[0]: bird_name,
+        COLUMNS[1]: list(thresholds),
+        COLUMNS[2]: true_positive,
+        COLUMNS[3]: false_positive,
+        COLUMNS[4]: true_negative,
+        COLUMNS[5]: false_negative,
+        COLUMNS[6]: false_alarm_rate,
+        COLUMNS[7]: true_positive_rate,
+    }, columns=COLUMNS)
+
+
+def area_under_curve(false_alarm_rate, true_positive_rate):
+    """
+    The area under the ROC curve through every threshold's point, joined by straight lines from (0, 0) to (1, 1).
+
+    @param false_alarm_rate: The false alarm rate at each threshold
+    @param true_positive_rate: The true positive rate at each threshold
+    @return: The area, or NaN if no threshold has both rates
+    """
+    false_alarm_rate = np.asarray(false_alarm_rate, dtype=np.float64)
+    true_positive_rate = np.asarray(true_positive_rate, dtype=np.float64)
+    known = ~(np.isnan(false_alarm_rate) | np.isnan(true_positive_rate))
+    if not known.any():
+        return float("nan")
+
+    x = np.concatenate(([0.0], false_alarm_rate[known], [1.0]))
+    y = np.concatenate(([0.0], true_positive_rate[known], [1.0]))
+    order = np.lexsort((y, x))
+    x = x[order]
+    y = y[order]
+    return float(np.sum(np.diff(x) * (y[1:] + y[:-1]) / 2.0))
+
+
+def score_detections(filename, actual_directory="Actual Results", total_events=TOTAL_EVENTS, tolerance=TOLERANCE,
+                     one_to_one=False):
+    """
+    Scores every bird of an .npz run against its ground truth, as check_results.py does with FAST_SCORING.
+
+    @param filename: An .npz file written by peak_io.DetectionWriter
+    @param actual_directory: The folder of the ground truth csv files of every bird
+    @param total_events: The number of events the true negatives are counted out of
+    @param tolerance: The width of the window around each call in seconds
+    @param one_to_one: Whether a detection can only be matched to a single call
+    @return: A list of (bird name, results table) pairs in the order of the run's birds
+    """
+    detections, tested, start, rate = load_detections(filename)
+    offsets = (detections["Timestamp"].values.astype("datetime64[ns]").astype(np.int64) -
+               np.datetime64(start, "ns").astype(np.int64))
+    groups = detections.groupby(["Bird", "Threshold"], observed=True).indices
+
+    scores = []
+    for bird_name in tested["Bird"].cat.categories:
+        actual_calls_df = pd.read_csv(os.path.join(actual_directory, bird_name + ".csv"), header=None)
+        thresholds = tested.loc[tested["Bird"] == bird_name, "Threshold"].tolist()
+        detected_times = [np.sort(offsets[groups.get((bird_name, threshold), [])]) for threshold in thresholds]
+        scores.append((bird_name, score_bird(bird_name, [str(threshold) for threshold in thresholds],
+                                             truth_offsets(actual_calls_df), detected_times, total_events, tolerance,
+                                             one_to_one=one_to_one)))
+    return scores
@@ -0,0 +1,514 @@
+import bisect
+import math
+
+import numpy as np
+from scipy import fft as sp_fft
+from scipy import ndimage
+
+from adaptive_threshold import DEFAULT_HOP_SECONDS, DEFAULT_NOISE_SECONDS, NoiseFloor
+from envelope import DEFAULT_WINDOW_SECONDS, boxcar_envelope, window_length
+
+
+def deinterleave(samples, n_channels):
+    """
+    @param samples: Interleaved frames, as a multi-channel microphone stream delivers them
+    @param n_channels: The number of channels
+    @return: An (n_channels, n_frames) view of the samples
+    """
+    samples = np.asarray(samples)
+    if len(samples) % n_channels:
+        raise ValueError(str(len(samples)) + " samples are not a whole number of " + str(n_channels) +
+                         " channel frames")
+    return samples.reshape(-1, n_channels).T
+
+
+def select_by_distance(positions, heights, distance):
+    """
+    The distance suppression of signal.find_peaks: the highest peaks are kept first and remove every lower peak closer
+    than distance samples. Of two equal peaks the later one is kept, where signal.find_peaks leaves the order of ties
+    to its sort.
+
+    @param positions: The sorted peak positions
+    @param heights: The height of each peak
+    @param distance: The minimum number of samples between kept peaks
+    @return: A boolean array marking the kept peaks
+    """
+    kept = np.zeros(len(positions), dtype=bool)
+    kept_positions = []
+    for i in np.argsort(heights, kind="stable")[::-1]:
+        j = bisect.bisect_left(kept_positions, positions[i] - distance + 1)
+        if j == len(kept_positions) or kept_positions[j] >= positions[i] + distance:
+            kept[i] = True
+            bisect.insort(kept_positions, positions[i])
+    return kept
+
+
+class _PeakTracker:
+    """
+    Incremental version of signal.find_peaks(envelope, height=height, distance=distance). Peaks are only reported once
+    no future sample can change whether they survive the distance suppression.
+
+    A peak which is the highest sample within distance on both sides is always kept, and every other peak within its
+    reach is always removed. These dominant peaks split the stream into independent regions, so the exact suppression
+    only ever has to be run on the few peaks left over between two of them.
+    """
+
+    def __init__(self, height, distance):
+        self.height = height
+        self.distance = int(math.ceil(distance))
+        self.samples_received = 0
+
+        # The flat run at the end of the last chunk is unresolved, so only its start, its value and the value of the
+        # run before it are carried over. This keeps the state constant in size even through long silences
+        self._previous_value = None
+        self._open_start = None
+        self._open_value = None
+
+        # Envelope samples still needed to decide the pending peaks
+        self._buffer = np.zeros(0, dtype=np.float64)
+        self._buffer_start = 0
+
+        # Peaks which have been found but not yet classified
+        self._positions = np.zeros(0, dtype=np.int64)
+        self._heights = np.zeros(0, dtype=np.float64)
+
+        # The last dominant peak, and the peaks after it which were not removed by it
+        self._last_dominant = None
+        self._leftover_positions = []
+        self._leftover_heights = []
+
+    def push(self, envelope, final=False):
+        """
+        @param envelope: The next chunk of the envelope
+        @param final: Whether this is the end of the stream
+        @return: A list of (sample, height) pairs for the peaks that were settled by this chunk
+        """
+        envelope = np.asarray(envelope, dtype=np.float64)
+        offset = self.samples_received
+        self.samples_received += len(envelope)
+        self._buffer = np.concatenate((self._buffer, envelope))
+
+        if len(envelope) > 0:
+            self._find_peaks(envelope, offset)
+
+        return self._settle(final)
+
+    def _find_peaks(self, envelope, offset):
+        local_starts = np.flatnonzero(np.concatenate(([True], envelope[1:] != envelope[:-1])))
+        starts = offset + local_starts
+        values = envelope[local_starts]
+        previous_value = self._previous_value
+
+        if self._open_start is not None:
+            if values[0] == self._open_value:
+                starts[0] = self._open_start
+            else:
+                # The open run goes first, after the run before it
+                starts = np.insert(starts, 0, self._open_start)
+                values = np.insert(values, 0, self._open_value)
+
+        # Every run but the last is resolved. A run is a peak if it is higher than both of its neighbours
+        if len(values) > 1:
+            # The very first run of the stream has no left neighbour and can never be a peak
+            left = np.insert(values[:-2], 0, np.inf if previous_value is None else previous_value)
+            is_peak = (values[:-1] > left) & (values[:-1] > values[1:])
+            if self.height is not None:
+                is_peak &= values[:-1] >= self.height
+
+            peaks = (starts[:-1][is_peak] + starts[1:][is_peak] - 1) // 2
+            self._positions = np.concatenate((self._positions, peaks))
+            self._heights = np.concatenate((self._heights, values[:-1][is_peak]))
+            self._previous_value = values[-2]
+
+        self._open_start = int(starts[-1])
+        self._open_value = values[-1]
+
+    def _settle(self, final):
+        distance = self.distance
+        detections = []
+
+        # A peak is decided once the windows of every peak within its reach are complete
+        if final:
+            n_decided = len(self._positions)
+        else:
+            n_decided = np.searchsorted(self._positions, self.samples_received - 2 * distance + 2)
+
+        if n_decided > 0:
+            maxima = ndimage.maximum_filter1d(self._buffer, 2 * distance - 1, mode="constant", cval=-np.inf)
+            window_complete = final | (self._positions + distance - 1 < self.samples_received)
+            is_dominant = window_complete & (self._heights >= maxima[self._positions - self._buffer_start])
+            # Of two equal peaks the later one is kept, as in select_by_distance, so a peak tied with a later one
+            # within reach is left to the exact suppression. Ties are common in float32 envelopes
+            reach = np.searchsorted(self._positions, self._positions + distance, side="left")
+            for i in np.flatnonzero(is_dominant):
+                height = self._heights[i]
+                if (height in self._heights[i + 1:reach[i]] or
+                        (self._open_value == height and self._open_start < self._positions[i] + distance)):
+                    is_dominant[i] = False
+
+            dominant = self._positions[is_dominant]
+            if self._last_dominant is not None:
+                dominant = np.insert(dominant, 0, self._last_dominant)
+
+            positions = self._positions[:n_decided]
+            heights = self._heights[:n_decided]
+            decided_dominant = is_dominant[:n_decided]
+
+            # Peaks within reach of a dominant peak are always removed
+            right = np.searchsorted(dominant, positions - distance, side="right")
+            near = right < len(dominant)
+            near[near] = dominant[right[near]] < positions[near] + distance
+            leftover = ~decided_dominant & ~near
+
+            for i in np.flatnonzero(decided_dominant | leftover):
+                if decided_dominant[i]:
+                    # A dominant peak closes the region of leftover peaks before it. Those within its reach may have
+                    # been left over before it was known to be dominant, and it removes them too
+                    while self._leftover_positions and self._leftover_positions[-1] > positions[i] - distance:
+                        self._leftover_positions.pop()
+                        self._leftover_heights.pop()
+                    detections.extend(self._close_region())
+                    detections.append((int(positions[i]), float(heights[i])))
+                    self._last_dominant = int(positions[i])
+                elif leftover[i]:
+                    self._leftover_positions.append(int(positions[i]))
+                    self._leftover_heights.append(float(heights[i]))
+
+            self._positions = self._positions[n_decided:]
+            self._heights = self._heights[n_decided:]
+
+        if final:
+            detections.extend(self._close_region())
+
+        # Keep enough of the envelope to find the maximum around every peak that could still be undecided
+        earliest = self.samples_received if self._open_start is None else self._open_start
+        if len(self._positions) > 0:
+            earliest = min(earliest, int(self._positions[0]))
+        keep_from = max(earliest - distance + 1, self._buffer_start)
+        self._buffer = self._buffer[keep_from - self._buffer_start:]
+        self._buffer_start = keep_from
+
+        return detections
+
+    def _close_region(self):
+        positions = np.array(self._leftover_positions, dtype=np.int64)
+        heights = np.array(self._leftover_heights, dtype=np.float64)
+        self._leftover_positions = []
+        self._leftover_heights = []
+
+        kept = select_by_distance(positions, heights, self.distance)
+        return [(int(position), float(height)) for position, height in zip(positions[kept], heights[kept])]
+
+
+class RunningMoments:
+    """
+    The mean and standard deviation of a stream of values, updated a block at a time. Each block's own mean and
+    variance are merged into the totals (Chan et al.), which avoids the cancellation of summing squares.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def update(self, values):
+        """
+        @param values: The next block of values
+        """
+        n = len(values)
+        if n == 0:
+            return
+        block_mean = float(np.mean(values, dtype=np.float64))
+        block_m2 = float(np.var(values, dtype=np.float64)) * n
+
+        total = self.count + n
+        delta = block_mean - self.mean
+        self.mean = self.mean + delta * n / total
+        self._m2 = self._m2 + block_m2 + delta * delta * self.count * n / total
+        self.count = total
+
+    @property
+    def std(self):
+        return math.sqrt(self._m2 / self.count) if self.count else 0.0
+
+
+class StreamingDetector:
+    """
+    Correlates a continuous stream of audio with every call in a TemplateBank using overlap-save, then smooths and
+    peak-picks each correlation incrementally. Chunks of any size can be pushed in; memory is bounded by the block size
+    and the latency is about one block plus one call length.
+
+    Feeding a whole signal through push() and flush() gives the same peaks as
+    signal.find_peaks(envelope, height=height, distance=fs) on the batch envelope of detect_correlation_peaks.
+    Because the stream never ends, the threshold is an absolute envelope height rather than a number of standard
+    deviations. In the adaptive threshold modes it is a number of standard deviations of the noise floor of the last
+    noise_seconds instead, which costs one more hop of latency.
+
+    The stream is correlated in the bank's precision, so the envelope heights are those of the bank's correlations and
+    absolute heights such as detector.MIN_THRESHOLD have to be converted with TemplateBank.scale_height().
+    """
+
+    def __init__(self, template_bank, height=None, rate=44100, envelope_seconds=DEFAULT_WINDOW_SECONDS,
+                 block_size=None, threshold_mode="global", noise_seconds=DEFAULT_NOISE_SECONDS, min_height=None,
+                 indices=None):
+        """
+        @param template_bank: The TemplateBank holding the calls to detect
+        @param height: The minimum envelope height of a detection in the bank's scale, or the minimum score in the
+        adaptive modes. None reports every local maximum
+        @param rate: The sampling rate of the stream
+        @param envelope_seconds: How long the squared correlation is averaged over
+        @param block_size: The number of new samples correlated per FFT. Defaults to the longest call length
+        @param threshold_mode: One of adaptive_threshold.THRESHOLD_MODES
+        @param noise_seconds: How long the noise floor of the adaptive modes is measured over
+        @param min_height: An envelope height the adaptive modes never detect below
+        @param indices: The indices of the calls of the bank to detect. All of them by default. The detections still
+        carry the bank's template indices
+        """
+        self.template_bank = template_bank
+        self.indices = list(range(len(template_bank))) if indices is None else list(indices)
+        self.envelope_length = window_length(envelope_seconds, rate)
+        lengths = template_bank.lengths[self.indices]
+
+        self._history_length = int(lengths.max()) - 1
+        if block_size is None:
+            block_size = self._history_length + 1
+        self.nfft = sp_fft.next_fast_len(int(block_size + self._history_length), True)
+        self.block_size = self.nfft - self._history_length
+        # The bank caches the spectra of every call, so detectors of different calls still share them
+        self._spectra = template_bank.spectra(self.nfft)
+        if indices is not None:
+            self._spectra = self._spectra[self.indices]
+
+        self._history = np.zeros(self._history_length, dtype=template_bank.dtype)
+        self._pending = []
+        self._pending_length = 0
+        self.samples_received = 0
+
+        n_templates = len(self.indices)
+        # Full correlation samples still to drop so that the output lines up with mode="same"
+        self._lag = [int(length - 1) // 2 for length in lengths]
+        self._to_skip = list(self._lag)
+        self._corr_emitted = [0] * n_templates
+        self._corr_tail = [np.zeros(0, dtype=template_bank.dtype) for _ in range(n_templates)]
+        self._trackers = [_PeakTracker(height, template_bank.rates[i]) for i in self.indices]
+        # The mean and standard deviation of each envelope so far, for thresholds in standard deviations, in the order
+        # of indices
+        self.moments = [RunningMoments() for _ in range(n_templates)]
+        self._noise_floors = None
+        if threshold_mode != "global":
+            self._noise_floors = [NoiseFloor(noise_seconds * rate, DEFAULT_HOP_SECONDS * rate, threshold_mode,
+                                             min_height) for _ in range(n_templates)]
+
+    def push(self, chunk):
+        """
+        @param chunk: The next int16 samples from the stream
+        @return: A list of (template index, sample, envelope height) detections settled by this chunk
+        """
+        chunk = np.asarray(chunk)
+        self.samples_received += len(chunk)
+        # Every int16 sample is exact in either precision. The blocks are normalised as they are correlated
+        self._pending.append(chunk.astype(self.template_bank.dtype))
+        self._pending_length += len(chunk)
+
+        detections = []
+        if self._pending_length < self.block_size:
+            return detections
+
+        samples = np.concatenate(self._pending)
+        n_blocks = len(samples) // self.block_size
+        for b in range(n_blocks):
+            block = samples[b * self.block_size:(b + 1) * self.block_size]
+            detections.extend(self._process_block(block, self.samples_received))
+
+        remainder = samples[n_blocks * self.block_size:]
+        self._pending = [remainder]
+        self._pending_length = len(remainder)
+        return detections
+
+    def flush(self):
+        """
+        Ends the stream. The input is padded with zeros, as mode="same" does, and every remaining peak is reported.
+
+        @return: A list of (template index, sample, envelope height) detections
+        """
+        padding = np.zeros(max(self._lag) + self.block_size, dtype=self.template_bank.dtype)
+        samples = np.concatenate(self._pending + [padding])
+        self._pending = []
+        self._pending_length = 0
+
+        detections = []
+        for b in range(len(samples) // self.block_size):
+            block = samples[b * self.block_size:(b + 1) * self.block_size]
+            detections.extend(self._process_block(block, self.samples_received))
+
+        return detections + self._flush_trackers()
+
+    def _flush_trackers(self):
+        detections = []
+        for i, tracker in enumerate(self._trackers):
+            rest = np.zeros(0) if self._noise_floors is None else self._noise_floors[i].flush()
+            for sample, height in tracker.push(rest, final=True):
+                detections.append((self.indices[i], sample, height))
+        return detections
+
+    def _next_frame(self, block):
+        # The block, normalised to the bank's precision, with the history it overlaps, which becomes the history of
+        # the next block
+        frame = np.concatenate((self._history, self.template_bank._normalise(block)))
+        self._history = frame[len(frame) - self._history_length:]
+        return frame
+
+    def _process_block(self, block, total_samples):
+        frame = self._next_frame(block)
+
+        workers = self.template_bank.workers
+        spectrum = sp_fft.rfft(frame, self.nfft, workers=workers)
+        correlations = sp_fft.irfft(self._spectra * spectrum, self.nfft, axis=-1, workers=workers)
+        return self._detect_block(correlations, total_samples)
+
+    def _detect_block(self, correlations, total_samples):
+        # Only the last block_size samples are free of circular wrap-around
+        correlations = correlations[:, self._history_length:]
+
+        detections = []
+        for i in range(len(self._trackers)):
+            corr = correlations[i]
+
+            skip = min(self._to_skip[i], len(corr))
+            self._to_skip[i] -= skip
+            corr = corr[skip:]
+
+            # The correlation only has as many samples as the input, even while flushing
+            corr = corr[:max(total_samples - self._corr_emitted[i], 0)]
+            self._corr_emitted[i] += len(corr)
+
+            # The envelope needs the last envelope_length - 1 correlation samples of the previous block
+            corr = np.concatenate((self._corr_tail[i], corr))
+            envelope = boxcar_envelope(corr, self.envelope_length, dtype=corr.dtype)
+            self._corr_tail[i] = corr[len(corr) - min(len(corr), self.envelope_length - 1):]
+            self.moments[i].update(envelope)
+            if self._noise_floors is not None:
+                envelope = self._noise_floors[i].update(envelope)
+
+            for sample, height in self._trackers[i].push(envelope):
+                detections.append((self.indices[i], sample, height))
+
+        return detections
+
+
+def process_blocks(detectors, blocks, total_samples, workers=None):
+    """
+    Correlates the next block of several streams with every call in one batched FFT, so many streams cost little more
+    than one. Each detector's state moves on exactly as if it had been pushed its block alone.
+
+    @param detectors: StreamingDetectors sharing one TemplateBank and block size, e.g. one for each microphone or site
+    @param blocks: The next block_size raw samples of each detector's stream
+    @param total_samples: The number of samples each stream has received so far, including its block
+    @param workers: The number of threads the FFTs are split over
+    @return: The list of (template index, sample, envelope height) detections settled by each block
+    """
+    nfft = detectors[0].nfft
+    frames = np.empty((len(detectors), nfft), dtype=detectors[0].template_bank.dtype)
+    for row, (detector, block) in enumerate(zip(detectors, blocks)):
+        frames[row] = detector._next_frame(block)
+
+    # One (streams, templates, nfft) inverse transform for every stream and call
+    spectra = sp_fft.rfft(frames, nfft, axis=-1, workers=workers)
+    correlations = sp_fft.irfft(detectors[0]._spectra[np.newaxis] * spectra[:, np.newaxis], nfft, axis=-1,
+                                workers=workers)
+    return [detector._detect_block(correlations[row], total)
+            for row, (detector, total) in enumerate(zip(detectors, total_samples))]
+
+
+class MultiChannelStreamingDetector:
+    """
+    A StreamingDetector for every channel of a multi-channel stream, such as the microphones of one field unit. The
+    channels share the template bank and its cached spectra, and every block of all channels is correlated with every
+    call in one batched FFT. Each channel keeps its own envelope, noise floor and peaks, so its detections are the
+    same as those of a StreamingDetector fed that channel alone.
+    """
+
+    def __init__(self, template_bank, n_channels, height=None, rate=44100, envelope_seconds=DEFAULT_WINDOW_SECONDS,
+                 block_size=None, threshold_mode="global", noise_seconds=DEFAULT_NOISE_SECONDS, min_height=None):
+        """
+        @param template_bank: The TemplateBank holding the calls to detect
+        @param n_channels: The number of channels in the stream
+        @param height: The minimum envelope height of a detection, or the minimum score in the adaptive modes. None
+        reports every local maximum
+        @param rate: The sampling rate of the stream
+        @param envelope_seconds: How long the squared correlation is averaged over
+        @param block_size: The number of new samples of each channel correlated per FFT. Defaults to the longest call
+        length
+        @param threshold_mode: One of adaptive_threshold.THRESHOLD_MODES
+        @param noise_seconds: How long the noise floor of the adaptive modes is measured over
+        @param min_height: An envelope height the adaptive modes never detect below
+        """
+        self.template_bank = template_bank
+        self.n_channels = n_channels
+        self.channels = [StreamingDetector(template_bank, height=height, rate=rate, envelope_seconds=envelope_seconds,
+                                           block_size=block_size, threshold_mode=threshold_mode,
+                                           noise_seconds=noise_seconds, min_height=min_height)
+                         for _ in range(n_channels)]
+        self.nfft = self.channels[0].nfft
+        self.block_size = self.channels[0].block_size
+
+        self._pending = []
+        self._pending_length = 0
+        self.samples_received = 0
+
+    def push(self, chunk):
+        """
+        @param chunk: The next int16 samples from the stream, as an (n_channels, n_samples) array or as interleaved
+        frames
+        @return: A list of (channel, template index, sample, envelope height) detections settled by this chunk
+        """
+        chunk = np.asarray(chunk)
+        if chunk.ndim == 1:
+            chunk = deinterleave(chunk, self.n_channels)
+        self.samples_received += chunk.shape[1]
+        self._pending.append(chunk.astype(self.template_bank.dtype))
+        self._pending_length += chunk.shape[1]
+
+        detections = []
+        if self._pending_length < self.block_size:
+            return detections
+
+        samples = np.concatenate(self._pending, axis=1)
+        n_blocks = samples.shape[1] // self.block_size
+        for b in range(n_blocks):
+            block = samples[:, b * self.block_size:(b + 1) * self.block_size]
+            detections.extend(self._process_block(block, self.samples_received))
+
+        remainder = samples[:, n_blocks * self.block_size:]
+        self._pending = [remainder]
+        self._pending_length = remainder.shape[1]
+        return detections
+
+    def flush(self):
+        """
+        Ends the stream of every channel.
+
+        @return: A list of (channel, template index, sample, envelope height) detections
+        """
+        padding = np.zeros((self.n_channels, max(self.channels[0]._lag) + self.block_size),
+                           dtype=self.template_bank.dtype)
+        samples = np.concatenate(self._pending + [padding], axis=1)
+        self._pending = []
+        self._pending_length = 0
+
+        detections = []
+        for b in range(samples.shape[1] // self.block_size):
+            block = samples[:, b * self.block_size:(b + 1) * self.block_size]
+            detections.extend(self._process_block(block, self.samples_received))
+
+        for channel, detector in enumerate(self.channels):
+            detections.extend((channel, i, sample, height) for i, sample, height in detector._flush_trackers())
+        return detections
+
+    def _process_block(self, block, total_samples):
+        channel_detections = process_blocks(self.channels, block, [total_samples] * self.n_channels,
+                                            self.template_bank.workers)
+        detections = []
+        for channel, found in enumerate(channel_detections):
+            detections.extend((channel, i, sample, height) for i, sample, height in found)
+        return detections
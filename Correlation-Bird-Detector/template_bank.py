@@ -0,0 +1,168 @@
+import numpy as np
+from glob import glob
+from scipy import fft as sp_fft
+from scipy.io import wavfile
+
+# "float64" correlates the raw int16 samples, as signal.fftconvolve always has. "float32" scales the input and the calls
+# to [-1, 1) and correlates them in single precision, which halves the memory of every spectrum and correlation
+PRECISIONS = ["float64", "float32"]
+# The full scale of int16 audio, which the float32 path divides every sample by
+FULL_SCALE = 32768.0
+
+
+def bird_name_from_filename(filename):
+    # "Test Bird Calls/Common Koel (eudynamys-scolopacea).wav" -> "Common Koel (eudynamys-scolopacea)"
+    bird_name = filename.split(".wav")[0]
+    return bird_name.split("/")[-1]
+
+
+def read_call(filename):
+    """
+    @param filename: The path of the wav file holding a known bird call
+    @return: The sampling rate and the first channel of the call
+    """
+    fs, call = wavfile.read(filename)
+    if call.ndim > 1:
+        call = call[:, 0]
+    return fs, call
+
+
+class TemplateBank:
+    """
+    Keeps every known bird call in memory together with the real FFT of each reversed call, so that an input signal
+    only has to be transformed once no matter how many species are being correlated against it.
+
+    The spectra are cached per FFT size. Every input of the same length (e.g. every microphone batch) reuses them.
+
+    In float32 the correlations are those of the float64 path divided by FULL_SCALE ** 2, to within a relative error
+    of about 1e-7 * sqrt(log2(nfft)) of their largest magnitude, 3e-7 on five minutes of 44.1kHz audio. Scaling by a
+    power of two is exact, so thresholds in standard deviations mean the same in both precisions and only absolute
+    envelope heights such as detector.MIN_THRESHOLD have to be converted with scale_height(). Rounding the envelope to
+    float32 can still move a detection along the flat top of its peak, by up to 0.05 seconds on the synthetic
+    recordings of benchmark.py, whose --compare-precision flag measures how many detections agree with the float64 path.
+    """
+
+    def __init__(self, filenames, precision="float64", workers=None, calls=None):
+        """
+        @param filenames: The paths of the known bird calls
+        @param precision: One of PRECISIONS
+        @param workers: The number of threads the FFTs are split over. One by default, and -1 uses every core. A batch
+        of calls is inverse transformed one call per thread, so batch_size should be at least workers
+        @param calls: The (sampling rate, samples) of every call, if they have already been read. Read from filenames
+        if None
+        """
+        if precision not in PRECISIONS:
+            raise ValueError("Unknown precision " + str(precision) + ". Use one of " + ", ".join(PRECISIONS))
+        self.precision = precision
+        self.dtype = np.dtype(precision).type
+        self.workers = workers
+        # Every sample is divided by scale before it is correlated
+        self.scale = FULL_SCALE if precision == "float32" else 1.0
+
+        self.filenames = list(filenames)
+        self.names = [bird_name_from_filename(filename) for filename in self.filenames]
+        self.rates = []
+        self.calls = []
+
+        if calls is None:
+            calls = [read_call(filename) for filename in self.filenames]
+        for fs, call in calls:
+            self.rates.append(fs)
+            self.calls.append(call)
+
+        self.lengths = np.array([len(call) for call in self.calls], dtype=np.int64)
+        self._spectra = {}
+
+    @classmethod
+    def from_directory(cls, directory="Test Bird Calls", precision="float64", workers=None):
+        return cls(glob(directory + "/*"), precision=precision, workers=workers)
+
+    def __len__(self):
+        return len(self.calls)
+
+    def fft_size(self, n_samples):
+        """
+        @param n_samples: The length of the input signal
+        @return: The smallest fast FFT size that fits a full linear correlation with the longest call
+        """
+        return sp_fft.next_fast_len(int(n_samples + self.lengths.max() - 1), True)
+
+    def scale_height(self, height):
+        """
+        @param height: A height of the envelope of the raw int16 correlation, such as detector.MIN_THRESHOLD
+        @return: The same height for the envelopes of this bank's correlations
+        """
+        return height / self.scale ** 4
+
+    def _normalise(self, samples):
+        # The samples in the bank's precision, divided by its scale
+        if self.scale == 1:
+            return np.asarray(samples, dtype=self.dtype)
+        samples = np.array(samples, dtype=self.dtype)
+        samples *= self.dtype(1.0 / self.scale)
+        return samples
+
+    def spectra(self, nfft):
+        """
+        @param nfft: The FFT size
+        @return: A (templates, nfft // 2 + 1) array of the real FFTs of the reversed, zero-padded calls, complex64 in
+        float32 and complex128 in float64
+        """
+        if nfft not in self._spectra:
+            spectra = np.empty((len(self.calls), nfft // 2 + 1), dtype=np.result_type(self.dtype, np.complex64))
+            for i, call in enumerate(self.calls):
+                spectra[i] = sp_fft.rfft(self._normalise(call[::-1]), nfft, workers=self.workers)
+            self._spectra[nfft] = spectra
+        return self._spectra[nfft]
+
+    def iter_correlations(self, inputSignal, batch_size=None, indices=None):
+        """
+        Correlates the input with every call. The input is transformed once and the calls are multiplied and inverse
+        transformed together, batch_size calls at a time to bound memory. Every channel of a multi-channel input is
+        transformed in the same call, against the same cached spectra.
+
+        Each correlation matches signal.fftconvolve(inputSignal, call[::-1], mode="same"), divided by scale ** 2 and
+        in the bank's precision.
+
+        @param inputSignal: The audio samples to search through, or an (n_channels, n_samples) array of several
+        channels
+        @param batch_size: How many calls to inverse transform at once. All of them by default
+        @param indices: The indices of the calls to correlate with. All of them by default
+        @return: A generator of (template index, correlation) pairs in bank order. Each correlation has the shape of
+        the input
+        """
+        n_samples = np.shape(inputSignal)[-1]
+        nfft = self.fft_size(n_samples)
+        spectra = self.spectra(nfft)
+        input_spectrum = sp_fft.rfft(self._normalise(inputSignal), nfft, axis=-1, workers=self.workers)
+        # The spectra of the calls are broadcast over the channels
+        channel_axes = (1,) * (input_spectrum.ndim - 1)
+
+        if indices is None:
+            indices = range(len(self.calls))
+        indices = list(indices)
+
+        if batch_size is None:
+            batch_size = len(indices)
+
+        for start in range(0, len(indices), batch_size):
+            batch = indices[start:start + batch_size]
+            batch_spectra = spectra[batch].reshape((len(batch),) + channel_axes + (-1,))
+            correlations = sp_fft.irfft(batch_spectra * input_spectrum, nfft, axis=-1, overwrite_x=True,
+                                        workers=self.workers)
+
+            for row, i in enumerate(batch):
+                # Centre the full correlation in the same way as mode="same"
+                offset = (self.lengths[i] - 1) // 2
+                yield i, correlations[row, ..., offset:offset + n_samples]
+
+    def correlate(self, inputSignal):
+        """
+        @param inputSignal: The audio samples to search through, or an (n_channels, n_samples) array
+        @return: A (templates, samples) or (templates, n_channels, samples) array holding the correlation of the input
+        with every call
+        """
+        correlations = np.empty((len(self.calls),) + np.shape(inputSignal), dtype=self.dtype)
+        for i, corr in self.iter_correlations(inputSignal):
+            correlations[i] = corr
+        return correlations
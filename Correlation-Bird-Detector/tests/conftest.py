@@ -0,0 +1,52 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+from scipy.io import wavfile
+
+# The modules of the detector are scripts in the folder above, imported by name as they import each other
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from batch_runner import DEFAULT_START  # noqa: E402
+from benchmark import RATE, call_schedule, write_actual_results, write_calls, write_mixture  # noqa: E402
+
+DURATION = 60
+N_TEMPLATES = 3
+SNR = 10.0
+
+
+class Recording:
+    """
+    A synthetic recording with its calls and ground truth, laid out as the scripts expect them.
+    """
+
+    def __init__(self, directory, seed=0, delays=(0,)):
+        rng = np.random.RandomState(seed)
+        self.directory = str(directory)
+        self.calls_directory = os.path.join(self.directory, "Test Bird Calls")
+        self.actual_directory = os.path.join(self.directory, "Actual Results")
+        self.filename = os.path.join(self.directory, "Input Signals", "10dB.wav")
+        os.makedirs(os.path.dirname(self.filename))
+        self.rate = RATE
+        self.start = DEFAULT_START
+        self.n_samples = DURATION * RATE
+
+        self.call_filenames = write_calls(self.calls_directory, N_TEMPLATES, rng)
+        self.names = [os.path.basename(filename)[:-len(".wav")] for filename in self.call_filenames]
+        calls = [wavfile.read(filename)[1].astype(np.float64) for filename in self.call_filenames]
+        schedules = []
+        centres = []
+        for call in calls:
+            starts, call_centres = call_schedule(self.n_samples, len(call), rng)
+            schedules.append(starts)
+            centres.append(call_centres)
+        self.centres = centres
+        write_mixture(self.filename, calls, schedules, self.n_samples, SNR, rng, delays=delays)
+        write_actual_results(self.actual_directory, self.names, centres, self.start)
+
+
+@pytest.fixture(scope="session")
+def recording(tmp_path_factory):
+    return Recording(tmp_path_factory.mktemp("recording"))
+
@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+
+from benchmark import AGREEMENT_SECONDS
+from capture import CapturePipeline, WavSource
+from ingest import open_wav
+from streaming_detector import StreamingDetector
+from template_bank import TemplateBank
+
+
+@pytest.mark.parametrize("precision", ["float64", "float32"])
+def test_workers_share_the_bank(recording, precision):
+    template_bank = TemplateBank(recording.call_filenames, precision=precision)
+    detections = []
+    pipeline = CapturePipeline(WavSource(recording.filename, speed=None), template_bank, workers=2,
+                               on_detections=detections.extend)
+    pipeline.run()
+    assert pipeline.coverage() == 1.0
+    assert all(detector.template_bank is template_bank for detector in pipeline._detectors)
+
+    fs, samples = open_wav(recording.filename)
+    detector = StreamingDetector(template_bank, rate=fs)
+    expected = sorted(detector.push(samples) + detector.flush())
+    detections = sorted(detections)
+    assert [i for i, sample, height in detections] == [i for i, sample, height in expected]
+
+    # Each worker's FFT size depends on its own calls, which can move a float32 peak along its flat top
+    tolerance = 0 if precision == "float64" else AGREEMENT_SECONDS * fs
+    samples_apart = [abs(a[1] - b[1]) for a, b in zip(detections, expected)]
+    assert max(samples_apart) <= tolerance
+    # The heights are in the bank's precision and scale
+    assert np.allclose([height for i, sample, height in detections], [height for i, sample, height in expected],
+                       rtol=1e-4)
+
+
+class BurstSource(WavSource):
+    """
+    Replays the first part of a file without dropping anything, then writes a burst longer than the buffer without
+    waiting, as a microphone would after a stall, and then the rest of the file again without dropping anything.
+    """
+
+    def __init__(self, filename, burst_start, burst_frames):
+        WavSource.__init__(self, filename, speed=None)
+        self.burst_start = burst_start
+        self.burst_frames = burst_frames
+
+    def _run(self, ring):
+        burst_stop = self.burst_start + self.burst_frames
+        for start, stop, block in [(0, self.burst_start, True), (self.burst_start, burst_stop, False),
+                                   (burst_stop, len(self._samples), True)]:
+            for position in range(start, stop, self.chunk):
+                chunk = np.asarray(self._samples[position:min(position + self.chunk, stop)])
+                ring.write(chunk, block=block)
+                self.frames_captured += len(chunk)
+        ring.close()
+        self.finished.set()
+
+
+def test_dropped_frames_are_counted(recording):
+    # Replayed as fast as possible into a one second buffer, without waiting for room
+    template_bank = TemplateBank(recording.call_filenames)
+    pipeline = CapturePipeline(WavSource(recording.filename, speed=None, block=False), template_bank, workers=2,
+                               buffer_seconds=1)
+    pipeline.run()
+
+    assert pipeline.frames_captured == recording.n_samples
+    assert pipeline.frames_dropped > 0
+    for processed in pipeline.frames_processed:
+        assert processed + pipeline.frames_dropped == pipeline.frames_captured
+    assert pipeline.coverage() < 1.0
+    assert pipeline.coverage() == float(pipeline.frames_captured - pipeline.frames_dropped) / pipeline.frames_captured
+
+
+def test_detections_after_a_gap_keep_their_stream_time(recording):
+    template_bank = TemplateBank(recording.call_filenames)
+    fs = recording.rate
+    source = BurstSource(recording.filename, burst_start=20 * fs, burst_frames=15 * fs)
+    detections = []
+    pipeline = CapturePipeline(source, template_bank, buffer_seconds=5, on_detections=detections.extend)
+    pipeline.run()
+
+    # The burst is three times the buffer, so at least two thirds of it was dropped in one or more gaps
+    assert pipeline.frames_dropped >= 10 * fs
+    assert min(pipeline.frames_processed) + pipeline.frames_dropped == pipeline.frames_captured
+    gaps_start = 20 * fs
+    gaps_stop = 35 * fs
+
+    fs, samples = open_wav(recording.filename)
+    detector = StreamingDetector(template_bank, rate=fs)
+    expected = detector.push(samples) + detector.flush()
+
+    # Away from the gaps the audio is the same, so the detections are at the same stream positions. Near them the
+    # correlation, envelope and peak spacing see audio from either side
+    margin = int(template_bank.lengths.max()) + 3 * fs
+
+    def clean(found):
+        return sorted((i, sample) for i, sample, height in found
+                      if sample < gaps_start - margin or sample > gaps_stop + margin)
+
+    after = [detection for detection in clean(expected) if detection[1] > gaps_stop + margin]
+    assert len(after) > 0
+    assert clean(detections) == clean(expected)
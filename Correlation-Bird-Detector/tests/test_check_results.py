@@ -0,0 +1,88 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import check_results
+from peak_io import DetectionWriter, export_csv
+from scoring import TIMESTAMP_FORMAT, TOLERANCE
+
+
+def read_truth(recording, bird_name):
+    return pd.read_csv(os.path.join(recording.actual_directory, bird_name + ".csv"), header=None)
+
+
+def make_tests(actual_calls_df, rng):
+    # Detections near every call with some misses and false alarms, fewer of both as the threshold rises. A few land
+    # exactly on the edge of the tolerance window, which neither path counts
+    reference = pd.Timestamp(pd.to_datetime(actual_calls_df[0].iloc[0], format=TIMESTAMP_FORMAT))
+    calls = pd.to_datetime(actual_calls_df[0], format=TIMESTAMP_FORMAT).iloc[1:] - reference
+    tests = []
+    for threshold, keep, false_alarms in [(0.5, 0.95, 30), (1.0, 0.8, 10), (2.0, 0.5, 2), (4.0, 0.0, 0)]:
+        kept = calls[rng.uniform(size=len(calls)) < keep]
+        jitter = pd.to_timedelta(rng.uniform(-TOLERANCE, TOLERANCE, size=len(kept)), unit="s")
+        edges = pd.to_timedelta(np.full(min(3, len(kept)), TOLERANCE / 2), unit="s")
+        alarms = pd.to_timedelta(rng.uniform(0, 60, size=false_alarms), unit="s")
+        offsets = np.concatenate([(kept + jitter).values, (kept[:len(edges)] + edges).values, alarms.values])
+        start = reference.to_datetime64()
+        tests.append((threshold, pd.Series(np.concatenate([[start], start + np.sort(offsets)]))))
+    return tests
+
+
+def score(monkeypatch, fast, bird_name, threshold_tests, actual_calls_df, reference_is_detection):
+    monkeypatch.setattr(check_results, "FAST_SCORING", fast)
+    results = check_results.score_tests(bird_name, threshold_tests, actual_calls_df,
+                                        reference_is_detection=reference_is_detection)
+    return results.reset_index(drop=True).astype({column: np.float64 for column in check_results.columns[2:]})
+
+
+@pytest.mark.parametrize("reference_is_detection", [True, False])
+def test_fast_scoring_matches_score_threshold(recording, monkeypatch, reference_is_detection):
+    rng = np.random.RandomState(1)
+    runs = [(bird_name, make_tests(read_truth(recording, bird_name), rng), read_truth(recording, bird_name))
+            for bird_name in recording.names]
+
+    # A bird with no detections at any threshold
+    runs.append(("Silent", [(threshold, None) for threshold in [0.5, 1.0]], read_truth(recording, recording.names[0])))
+    # A bird without any calls in the ground truth, only its reference row
+    no_calls = read_truth(recording, recording.names[0]).iloc[:1]
+    runs.append(("Absent", make_tests(read_truth(recording, recording.names[1]), rng)[:2] + [(1.0, None)], no_calls))
+
+    for bird_name, threshold_tests, actual_calls_df in runs:
+        fast = score(monkeypatch, True, bird_name, threshold_tests, actual_calls_df, reference_is_detection)
+        legacy = score(monkeypatch, False, bird_name, threshold_tests, actual_calls_df, reference_is_detection)
+        pd.testing.assert_frame_equal(fast, legacy, check_dtype=False)
+        if bird_name in recording.names:
+            assert fast["True Positives"].iloc[0] > 0
+
+    assert legacy["True Positive Rate"].isnull().all()
+
+
+def test_cached_scores_match_rescore(recording, tmp_path, monkeypatch):
+    # The ground truth is read from "Actual Results" in the working directory
+    monkeypatch.chdir(recording.directory)
+    monkeypatch.setattr(check_results, "_actual_calls", {})
+    rng = np.random.RandomState(2)
+    writer = DetectionWriter(start=recording.start, rate=recording.rate)
+    for bird_name, centres in zip(recording.names, recording.centres):
+        for threshold, keep in [(0.5, 0.9), (1.0, 0.6), (2.0, 0.0)]:
+            kept = centres[rng.uniform(size=len(centres)) < keep]
+            samples = np.round(np.concatenate([kept, rng.uniform(0, 60, size=3)]) * recording.rate).astype(np.int64)
+            writer.add(bird_name, threshold, np.sort(samples))
+
+    detected = tmp_path / "Detected Peaks"
+    detected.mkdir()
+    roc_directory = str(tmp_path / "ROC Data")
+    writer.save(str(detected / "Correlation 10dB first.npz"))
+    check_results.evaluate(str(detected), roc_directory, workers=1)
+
+    # The first run's scores come from the cache and the second run's are scored afresh
+    export_csv(str(detected / "Correlation 10dB first.npz"), str(detected / "Correlation 10dB second"))
+    incremental, incremental_auc = check_results.evaluate(str(detected), roc_directory, workers=1)
+    rescored, rescored_auc = check_results.evaluate(str(detected), roc_directory, workers=1, rescore=True)
+
+    assert set(incremental["Run"]) == {"Correlation 10dB first.npz", "Correlation 10dB second"}
+    assert all(isinstance(threshold, str) for threshold in incremental["Threshold (# std)"])
+    pd.testing.assert_frame_equal(incremental, rescored)
+    pd.testing.assert_frame_equal(incremental_auc, rescored_auc)
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from detect_historical_cusum import MESSAGES, OnlineCusum, detect_cusum_matrix, detect_historical_cusum
+
+# (look_back, look_back_mean, whether to weight the days)
+VARIANTS = [(5, None, False), (5, None, True), (3, 8, False), (4, 10, True), (6, 3, False), (2, None, False)]
+
+
+def random_counts(rng, n_species, n_days):
+    # Whole numbers of calls, with the level of some species stepping up or down part way through
+    rates = rng.uniform(1, 20, size=(n_species, 1)) * np.where(np.arange(n_days) < rng.randint(0, n_days + 1), 1.0,
+                                                              rng.choice([0.3, 1.0, 3.0], size=(n_species, 1)))
+    return rng.poisson(rates).astype(np.float64)
+
+
+# detect_historical_cusum takes the mean of an empty reference window when the history is too short for it
+@pytest.mark.filterwarnings("ignore:Mean of empty slice", "ignore:invalid value encountered")
+@pytest.mark.parametrize("look_back, look_back_mean, weighted", VARIANTS)
+@pytest.mark.parametrize("n_days", [1, 2, 3, 7, 30])
+def test_matrix_matches_detect_historical_cusum(look_back, look_back_mean, weighted, n_days):
+    rng = np.random.RandomState(n_days * 100 + look_back)
+    counts = random_counts(rng, 6, n_days)
+    weights = rng.uniform(0, 3, size=look_back) if weighted else None
+    threshold = 8
+
+    changes, cusum_pos, cusum_neg = detect_cusum_matrix(counts, look_back, threshold, weights=weights,
+                                                        look_back_mean=look_back_mean)
+    assert changes.shape == counts.shape
+    for s in range(len(counts)):
+        online = OnlineCusum(look_back, threshold, weights=weights, look_back_mean=look_back_mean)
+        for t in range(n_days):
+            change, message = detect_historical_cusum(counts[s, :t + 1], look_back, threshold, weights=weights,
+                                                      look_back_mean=look_back_mean)
+            assert MESSAGES[changes[s, t]] == message
+            assert online.update(counts[s, t]) == (change, message)
+
+
+def test_short_history():
+    changes, cusum_pos, cusum_neg = detect_cusum_matrix(np.array([[3., 4., 5.]]), 6, 2)
+    assert [MESSAGES[change] for change in changes[0]] == [detect_historical_cusum([3., 4., 5.], 6, 2)[1]] * 3
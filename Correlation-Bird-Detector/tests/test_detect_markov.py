@@ -0,0 +1,46 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from detect_markov import daily_counts_from_csv, daily_counts_from_store, detect_markov
+from history_store import HistoryStore
+from peak_io import format_timestamps, samples_to_datetime64
+
+
+def calls(rng, start, rates):
+    # Detections at random times of each day, rates[d] of them on day d
+    seconds = np.concatenate([day * 86400 + np.sort(rng.uniform(0, 86400, count)) for day, count in enumerate(rates)])
+    return samples_to_datetime64(seconds, 1, start)
+
+
+def test_counts_come_from_the_store(tmp_path):
+    rng = np.random.RandomState(0)
+    start = datetime.datetime(2024, 5, 1)
+    # The bird calls less often from day 20, and not at all on day 5
+    rates = list(rng.poisson(30, 20)) + list(rng.poisson(5, 20))
+    rates[5] = 0
+    timestamps = calls(rng, start, rates)
+
+    store = HistoryStore(str(tmp_path / "history"))
+    # Appended in two batches, as the microphone mode does once a day
+    store.append("Test Bird", timestamps[:len(timestamps) // 2])
+    store.append("Test Bird", timestamps[len(timestamps) // 2:])
+    legacy_csv = str(tmp_path / "Test Bird.csv")
+    pd.Series(format_timestamps(timestamps)).to_csv(legacy_csv, index=False, header=False)
+
+    counts = daily_counts_from_store("Test Bird", store)
+    assert list(counts.values) == rates
+    legacy_counts = daily_counts_from_csv(legacy_csv)
+    assert list(counts.index.date) == list(legacy_counts.index.date)
+    assert list(counts.values) == list(legacy_counts.values)
+
+    changed, tau, overlap = detect_markov("Test Bird", store)
+    assert changed
+    assert abs(tau - 20) <= 1
+    assert detect_markov("Test Bird", legacy_csv=legacy_csv) == (changed, tau, overlap)
+
+
+def test_bird_without_detections(tmp_path):
+    changed, tau, overlap = detect_markov("Test Bird", HistoryStore(str(tmp_path)))
+    assert not changed
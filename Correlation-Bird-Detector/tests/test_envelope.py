@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+from scipy import signal
+
+import envelope
+from envelope import HILBERT_TAPS, hilbert_envelope
+
+
+def reference_hilbert_envelope(corr, window):
+    # The whole analytic power at once, then the boxcar as a convolution
+    taps = signal.remez(HILBERT_TAPS, [0.01, 0.49], [1], type="hilbert", fs=1.0)
+    delay = (HILBERT_TAPS - 1) // 2
+    quadrature = signal.fftconvolve(corr, taps, mode="full")[delay:delay + len(corr)]
+    power = corr * corr + quadrature * quadrature
+    return signal.fftconvolve(power, np.ones(window) / window, mode="valid")
+
+
+@pytest.mark.parametrize("block_size", [1000, 1 << 16])
+@pytest.mark.parametrize("window", [1, 40, 127, 300])
+@pytest.mark.parametrize("overwrite", [False, True])
+def test_hilbert_envelope_matches_whole_signal(monkeypatch, block_size, window, overwrite):
+    # Blocks smaller than the signal check what is carried between them, including windows shorter than the filter
+    monkeypatch.setattr(envelope, "BLOCK_SIZE", block_size)
+    rng = np.random.RandomState(window)
+    corr = np.sin(np.arange(20000) * 0.3) * rng.uniform(0, 10, size=20000) + rng.normal(size=20000)
+    expected = reference_hilbert_envelope(corr, window)
+
+    for dtype, rtol in [(np.float64, 1e-9), (np.float32, 1e-6)]:
+        data = corr.astype(dtype)
+        result = hilbert_envelope(data, window, dtype=dtype, out=data if overwrite else None)
+        assert result.dtype == dtype
+        assert len(result) == len(expected)
+        np.testing.assert_allclose(result, expected, rtol=rtol, atol=rtol * expected.max())
+
+
+def test_hilbert_envelope_shorter_than_window():
+    assert len(hilbert_envelope(np.ones(10), 20)) == 0
@@ -0,0 +1,150 @@
+import asyncio
+import datetime
+import json
+import os
+
+import numpy as np
+import pytest
+
+import ingest_server
+from detector import MIN_THRESHOLD, save_streamed_peaks
+from history_store import HistoryStore
+from ingest import open_wav
+from streaming_detector import StreamingDetector
+from template_bank import TemplateBank
+
+START = datetime.datetime(2024, 5, 1, 6, 0, 0)
+# A stream the server stops serving would otherwise hang the test
+TIMEOUT = 60
+
+# Headers the server must refuse without dropping the connection or stopping
+BAD_HEADERS = [
+    b"not json\n",
+    b"[1, 2, 3]\n",
+    b'{"start": "2024-05-01T06:00:00", "rate": 44100}\n',
+    b'{"site": "..", "start": "2024-05-01T06:00:00", "rate": 44100}\n',
+    b'{"site": "north", "start": "2024-05-01T06:00:00", "rate": 8000}\n',
+    b'{"site": "north", "start": "2024-05-01T06:00:00", "rate": null}\n',
+    b'{"site": "north", "start": 20240501, "rate": 44100}\n',
+    b'{"site": "north", "start": "yesterday", "rate": 44100}\n',
+]
+
+
+async def send_header(path, header):
+    reader, writer = await asyncio.open_unix_connection(path)
+    writer.write(header)
+    reply = json.loads((await reader.readline()).decode("utf-8"))
+    writer.close()
+    return reply
+
+
+async def with_server(template_bank, output, path, client):
+    # Runs client(path) against a server, recording anything asyncio reports as unhandled
+    unhandled = []
+    asyncio.get_running_loop().set_exception_handler(lambda loop, context: unhandled.append(context))
+    server = ingest_server.IngestServer(template_bank, output, height=template_bank.scale_height(MIN_THRESHOLD))
+    ready = asyncio.Event()
+    task = asyncio.ensure_future(server.serve(path=path, ready=ready))
+    await ready.wait()
+    try:
+        result = await asyncio.wait_for(client(path), TIMEOUT)
+    finally:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    return result, unhandled
+
+
+@pytest.fixture(scope="module")
+def template_bank(recording):
+    return TemplateBank(recording.call_filenames)
+
+
+@pytest.fixture(scope="module")
+def served(recording, template_bank, tmp_path_factory):
+    directory = str(tmp_path_factory.mktemp("ingest"))
+
+    async def client(path):
+        refused = [await send_header(path, header) for header in BAD_HEADERS]
+        replies = await asyncio.gather(*[ingest_server.replay(recording.filename, site, path=path, speed=None,
+                                                              start=START) for site in ["north", "south"]])
+        return refused, replies
+
+    (refused, replies), unhandled = asyncio.run(with_server(template_bank, os.path.join(directory, "served"),
+                                                            os.path.join(directory, "ingest.sock"), client))
+    assert unhandled == []
+    return directory, template_bank, refused, replies
+
+
+def test_refuses_bad_headers(served):
+    directory, template_bank, refused, replies = served
+    assert all(list(reply) == ["error"] for reply in refused)
+    # The server carried on serving after refusing them
+    assert all("error" not in reply for reply in replies)
+
+
+def test_replay_matches_streaming_detector(recording, served):
+    directory, template_bank, refused, replies = served
+    fs, samples = open_wav(recording.filename)
+    detector = StreamingDetector(template_bank, height=template_bank.scale_height(MIN_THRESHOLD), rate=fs)
+    detections = []
+    for start in range(0, len(samples), ingest_server.CHUNK):
+        detections.extend(detector.push(samples[start:start + ingest_server.CHUNK]))
+    detections.extend(detector.flush())
+    reference = HistoryStore(os.path.join(directory, "reference"))
+    save_streamed_peaks(detections, template_bank.filenames, START, rate=fs, store=reference)
+
+    assert len(detections) > 0
+    for reply in replies:
+        assert reply["frames"] == len(samples)
+        assert reply["detections"] == len(detections)
+        store = HistoryStore(os.path.join(directory, "served", reply["site"]))
+        assert sorted(store.birds()) == sorted(reference.birds())
+        for bird_name in reference.birds():
+            assert np.array_equal(np.sort(store.timestamps(bird_name)), np.sort(reference.timestamps(bird_name)))
+
+
+def test_failed_batch_closes_its_stream(recording, template_bank, tmp_path, monkeypatch):
+    failures = [OSError("disk full")]
+
+    def save_streamed_peaks_once(*args, **kwargs):
+        if failures:
+            raise failures.pop()
+        return save_streamed_peaks(*args, **kwargs)
+
+    monkeypatch.setattr(ingest_server, "save_streamed_peaks", save_streamed_peaks_once)
+
+    async def client(path):
+        failed = await ingest_server.replay(recording.filename, "east", path=path, speed=None, start=START)
+        served = await ingest_server.replay(recording.filename, "west", path=path, speed=None, start=START)
+        return failed, served
+
+    (failed, served), unhandled = asyncio.run(with_server(template_bank, str(tmp_path / "served"),
+                                                          str(tmp_path / "ingest.sock"), client))
+    assert failed == {"error": "OSError: disk full"}
+    # The worker carried on with the next stream
+    assert served["frames"] == open_wav(recording.filename)[1].shape[0]
+    assert unhandled == []
+
+
+def test_recorder_dropping_after_eof(recording, template_bank, tmp_path):
+    fs, samples = open_wav(recording.filename)
+
+    async def client(path):
+        reader, writer = await asyncio.open_unix_connection(path)
+        header = {"site": "north", "start": START.strftime("%Y-%m-%dT%H:%M:%S"), "rate": fs}
+        writer.write((json.dumps(header) + "\n").encode("utf-8"))
+        await reader.readline()
+        writer.write(samples[:fs].astype("<i2").tobytes())
+        writer.write_eof()
+        # Goes away without waiting for the counters of its stream
+        writer.transport.abort()
+        # A second recorder is still served once the first one's stream has been processed
+        return await ingest_server.replay(recording.filename, "south", path=path, speed=None, start=START)
+
+    reply, unhandled = asyncio.run(with_server(template_bank, str(tmp_path / "served"), str(tmp_path / "ingest.sock"),
+                                               client))
+    assert reply["frames"] == len(samples)
+    assert unhandled == []
@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+
+from adaptive_threshold import make_sweep
+from batch_runner import DEFAULT_THRESHOLDS
+from envelope import compute_envelope
+from ingest import open_wav
+from multichannel import fuse_peaks, sweep_channels
+from streaming_detector import MultiChannelStreamingDetector, StreamingDetector
+from template_bank import TemplateBank
+
+BLOCK = 30000
+
+
+@pytest.fixture(scope="module")
+def bank(recording):
+    return TemplateBank(recording.call_filenames)
+
+
+@pytest.fixture(scope="module")
+def channels(recording):
+    # The same recording on three microphones, one of them late and one of them quieter
+    fs, samples = open_wav(recording.filename)
+    return fs, np.stack([samples, np.roll(samples, 200), (samples * 0.5).astype(samples.dtype)])
+
+
+def test_sweep_channels_matches_mono(bank, channels):
+    fs, audio = channels
+    channel_sweeps = sweep_channels(bank, audio, fs, batch_size=2)
+
+    for c in range(len(audio)):
+        for index, corr in bank.iter_correlations(audio[c]):
+            mono = make_sweep(compute_envelope(corr, fs), bank.rates[index], fs)
+            sweep = channel_sweeps[index][c]
+            assert np.array_equal(sweep.peaks, mono.peaks)
+            np.testing.assert_allclose(sweep.heights, mono.heights, rtol=1e-12)
+            assert np.array_equal(sweep.sweep(DEFAULT_THRESHOLDS), mono.sweep(DEFAULT_THRESHOLDS))
+            assert len(mono.peaks) > 0
+
+
+def test_streaming_channels_match_mono(bank, channels):
+    fs, audio = channels
+    detector = MultiChannelStreamingDetector(bank, len(audio), rate=fs)
+    interleaved = audio.T.reshape(-1)
+    detections = []
+    for start in range(0, len(interleaved), len(audio) * BLOCK):
+        detections.extend(detector.push(interleaved[start:start + len(audio) * BLOCK]))
+    detections.extend(detector.flush())
+
+    for c in range(len(audio)):
+        mono = StreamingDetector(bank, rate=fs)
+        expected = []
+        for start in range(0, audio.shape[1], BLOCK):
+            expected.extend(mono.push(audio[c, start:start + BLOCK]))
+        expected.extend(mono.flush())
+
+        found = sorted((index, sample, height) for channel, index, sample, height in detections if channel == c)
+        expected = sorted(expected)
+        assert len(expected) > 0
+        assert [(index, sample) for index, sample, height in found] == \
+            [(index, sample) for index, sample, height in expected]
+        np.testing.assert_allclose([height for index, sample, height in found],
+                                   [height for index, sample, height in expected], rtol=1e-9)
+
+
+def test_fuse_peaks_clusters_within_tolerance():
+    peaks = [np.array([100, 5000, 20000]), np.array([150, 9000, 20250]), np.array([120, 20101])]
+    scores = [np.array([1.0, 2.0, 1.0]), np.array([3.0, 1.0, 1.0]), np.array([0.5, 5.0])]
+
+    # 100, 120 and 150 chain together and are reported at the best score. 20000 and 20101 are 101 samples apart,
+    # one more than the tolerance, so they stay apart, while 20101 and 20250 are too far apart as well
+    samples, n_channels = fuse_peaks(peaks, scores, 100, min_channels=1)
+    assert samples.tolist() == [150, 5000, 9000, 20000, 20101, 20250]
+    assert n_channels.tolist() == [3, 1, 1, 1, 1, 1]
+
+    # A chain can be longer than the tolerance as long as each step is within it
+    samples, n_channels = fuse_peaks(peaks, scores, 150, min_channels=1)
+    assert samples.tolist() == [150, 5000, 9000, 20101]
+    assert n_channels.tolist() == [3, 1, 1, 3]
+
+
+def test_fuse_peaks_min_channels():
+    peaks = [np.array([100, 5000, 5040]), np.array([150, 9000]), np.array([120])]
+    scores = [np.array([1.0, 2.0, 4.0]), np.array([3.0, 1.0]), np.array([0.5])]
+
+    # Two peaks of one channel in a cluster only count as one channel
+    samples, n_channels = fuse_peaks(peaks, scores, 100, min_channels=2)
+    assert samples.tolist() == [150]
+    assert n_channels.tolist() == [3]
+
+    samples, n_channels = fuse_peaks(peaks, scores, 100, min_channels=1)
+    assert samples.tolist() == [150, 5040, 9000]
+    assert n_channels.tolist() == [3, 1, 1]
+
+    samples, n_channels = fuse_peaks(peaks, scores, 100, min_channels=4)
+    assert len(samples) == 0 and len(n_channels) == 0
+    samples, n_channels = fuse_peaks([np.zeros(0), np.zeros(0)], [np.zeros(0), np.zeros(0)], 100)
+    assert len(samples) == 0 and len(n_channels) == 0
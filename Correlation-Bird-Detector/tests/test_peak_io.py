@@ -0,0 +1,79 @@
+import os
+
+import pandas as pd
+import pytest
+
+import check_results
+from detector import detect_correlation_peaks, save_peak_data, sweep_correlation_peaks
+from ingest import open_wav
+from peak_io import DetectionWriter, export_csv
+from scoring import TIMESTAMP_FORMAT
+
+# The last threshold is too high for any detection, so its csv files are empty
+THRESHOLDS = [1.0, 3.0, 5.0, 1000.0]
+
+
+@pytest.fixture(scope="module")
+def run(recording, tmp_path_factory):
+    fs, samples = open_wav(recording.filename)
+
+    output = str(tmp_path_factory.mktemp("Detected Peaks"))
+    writer = DetectionWriter(start=recording.start, rate=fs)
+    peaks = {}
+    for filename, bird_name in zip(recording.call_filenames, recording.names):
+        detected_peaks = detect_correlation_peaks(samples, filename, start_dt=recording.start, thresholds=THRESHOLDS,
+                                                  rate=fs)
+        save_peak_data(detected_peaks, filename, directory="csv", output_directory=output, start_dt=recording.start)
+        peaks[bird_name] = detected_peaks
+
+        sweep = sweep_correlation_peaks(samples, filename, rate=fs)
+        writer.add_sweep(bird_name, THRESHOLDS, sweep, sweep.sweep(THRESHOLDS))
+
+    writer.save(os.path.join(output, "run.npz"))
+    export_csv(os.path.join(output, "run.npz"), os.path.join(output, "exported"))
+    return output, peaks
+
+
+def score(monkeypatch, recording, test_name):
+    # The ground truth is read from "Actual Results" in the working directory
+    monkeypatch.chdir(recording.directory)
+    monkeypatch.setattr(check_results, "_actual_calls", {})
+    return dict((bird_name, results.sort_values(check_results.columns[1]).reset_index(drop=True))
+                for bird_name, results in check_results.score_run(test_name))
+
+
+def test_csv_round_trip(recording, run, monkeypatch):
+    output, peaks = run
+    scores = score(monkeypatch, recording, os.path.join(output, "csv"))
+    assert sorted(scores) == sorted(recording.names)
+
+    start = pd.Series([pd.Timestamp(recording.start)])
+    for bird_name, detected_peaks in peaks.items():
+        threshold_tests = []
+        for threshold in THRESHOLDS:
+            timestamps = pd.to_datetime(detected_peaks[threshold].dropna(), format=TIMESTAMP_FORMAT)
+            threshold_tests.append((str(threshold), pd.concat([start, timestamps], ignore_index=True)))
+        expected = check_results.score_tests(bird_name, threshold_tests, check_results.read_actual_calls(bird_name),
+                                             reference_is_detection=False)
+        expected = expected.sort_values(check_results.columns[1]).reset_index(drop=True)
+        pd.testing.assert_frame_equal(scores[bird_name], expected, check_dtype=False)
+        assert scores[bird_name]["True Positives"].iloc[0] > 0
+
+
+def test_npz_export_csv_round_trip(recording, run, monkeypatch):
+    output, peaks = run
+    for bird_name in recording.names:
+        for threshold in THRESHOLDS:
+            filenames = [os.path.join(output, run_name, bird_name, str(threshold) + ".csv")
+                         for run_name in ["csv", "exported"]]
+            written, exported = [open(filename).read() for filename in filenames]
+            assert exported == written
+
+    # The run and its export are scored against the same reference, so their tables are the same
+    npz = score(monkeypatch, recording, os.path.join(output, "run.npz"))
+    assert sorted(npz) == sorted(recording.names)
+    for run_name in ["exported", "csv"]:
+        scores = score(monkeypatch, recording, os.path.join(output, run_name))
+        assert sorted(scores) == sorted(npz)
+        for bird_name in npz:
+            pd.testing.assert_frame_equal(scores[bird_name], npz[bird_name], check_dtype=False)
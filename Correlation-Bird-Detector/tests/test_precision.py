@@ -0,0 +1,76 @@
+import pytest
+
+from batch_runner import DEFAULT_THRESHOLDS
+from benchmark import AGREEMENT_SECONDS, detection_agreement
+from detector import MIN_THRESHOLD
+from envelope import compute_envelope
+from ingest import open_wav, sweep_file
+from peak_sweep import PeakSweep
+from streaming_detector import StreamingDetector
+from template_bank import TemplateBank
+
+
+def whole_file_sweeps(template_bank, samples):
+    sweeps = []
+    for index, corr in template_bank.iter_correlations(samples, batch_size=1):
+        envelope = compute_envelope(corr, template_bank.rates[index], dtype=template_bank.dtype, overwrite=True)
+        sweeps.append(PeakSweep.from_envelope(envelope, distance=template_bank.rates[index]))
+    return sweeps
+
+
+def with_counts(sweeps):
+    return [(sweep, sweep.sweep(DEFAULT_THRESHOLDS)) for sweep in sweeps]
+
+
+@pytest.fixture(scope="module")
+def banks(recording):
+    return dict((precision, TemplateBank(recording.call_filenames, precision=precision))
+                for precision in ["float64", "float32"])
+
+
+@pytest.fixture(scope="module")
+def sweeps(recording, banks):
+    fs, samples = open_wav(recording.filename)
+    results = {}
+    for precision, template_bank in banks.items():
+        results["whole", precision] = with_counts(whole_file_sweeps(template_bank, samples))
+        results["stream", precision] = with_counts(sweep_file(recording.filename, template_bank)[1])
+    return results
+
+
+@pytest.mark.parametrize("path", ["whole", "stream"])
+def test_float32_detections_agree_with_float64(recording, sweeps, path):
+    tolerance = AGREEMENT_SECONDS * recording.rate
+    assert detection_agreement(sweeps[path, "float32"], sweeps[path, "float64"], tolerance) == 1.0
+
+
+@pytest.mark.parametrize("precision", ["float64", "float32"])
+def test_streaming_agrees_with_whole_file(recording, sweeps, precision):
+    tolerance = AGREEMENT_SECONDS * recording.rate
+    assert detection_agreement(sweeps["stream", precision], sweeps["whole", precision], tolerance) == 1.0
+
+
+def test_float32_heights_are_scaled(sweeps, banks):
+    # The float32 envelopes are the float64 ones divided by scale ** 4, so absolute heights convert with scale_height
+    for path in ["whole", "stream"]:
+        for (sweep, counts), (reference, reference_counts) in zip(sweeps[path, "float32"], sweeps[path, "float64"]):
+            assert sweep.heights[0] == pytest.approx(banks["float32"].scale_height(reference.heights[0]), rel=1e-4)
+
+
+def test_streaming_min_threshold(recording, banks):
+    fs, samples = open_wav(recording.filename)
+    detections = {}
+    for precision, template_bank in banks.items():
+        detector = StreamingDetector(template_bank, height=template_bank.scale_height(MIN_THRESHOLD), rate=fs)
+        found = []
+        for start in range(0, len(samples), 44100):
+            found.extend(detector.push(samples[start:start + 44100]))
+        found.extend(detector.flush())
+        detections[precision] = found
+
+    assert len(detections["float64"]) > 0
+    assert len(detections["float32"]) == len(detections["float64"])
+    for (index, sample, height), (reference_index, reference_sample, reference_height) in \
+            zip(sorted(detections["float32"]), sorted(detections["float64"])):
+        assert index == reference_index
+        assert abs(sample - reference_sample) <= AGREEMENT_SECONDS * fs
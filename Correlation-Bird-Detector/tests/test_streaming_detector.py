@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+from scipy import signal
+
+from adaptive_threshold import local_scores
+from detector import MIN_THRESHOLD
+from envelope import compute_envelope
+from ingest import open_wav
+from streaming_detector import StreamingDetector, _PeakTracker, select_by_distance
+from template_bank import TemplateBank
+
+CHUNK = 5000
+# Shorter than the recording, so the noise floor slides along it
+NOISE_SECONDS = 10.0
+
+
+def track(envelope, height, distance, chunk):
+    tracker = _PeakTracker(height, distance)
+    found = []
+    for start in range(0, len(envelope), chunk):
+        found.extend(tracker.push(envelope[start:start + chunk]))
+    found.extend(tracker.push(np.zeros(0), final=True))
+    return np.array(sorted(sample for sample, height in found), dtype=np.int64)
+
+
+@pytest.mark.parametrize("chunk", [1, 2, 7, 1000])
+def test_tracker_matches_find_peaks(chunk):
+    rng = np.random.RandomState(0)
+    for trial in range(50):
+        envelope = np.abs(np.cumsum(rng.randn(rng.randint(50, 2000)))) + rng.rand(1)
+        distance = rng.randint(2, 100)
+        height = None if trial % 2 else float(np.median(envelope))
+        expected = signal.find_peaks(envelope, height=height, distance=distance)[0]
+        assert np.array_equal(track(envelope, height, distance, chunk), expected)
+
+
+@pytest.mark.parametrize("chunk", [1, 2, 7, 1000])
+def test_tracker_resolves_ties(chunk):
+    # Rounded envelopes, like float32 ones, have equal peaks within the distance of each other
+    rng = np.random.RandomState(1)
+    for trial in range(200):
+        envelope = np.round(rng.rand(rng.randint(5, 300)) * rng.randint(1, 5))
+        distance = rng.randint(2, 20)
+        height = None if trial % 3 else 1.0
+        peaks = signal.find_peaks(envelope, height=height)[0]
+        expected = peaks[select_by_distance(peaks, envelope[peaks], distance)]
+        assert np.array_equal(track(envelope, height, distance, chunk), expected)
+
+
+def test_peak_at_the_end_of_a_chunk():
+    envelope = np.array([2.0, 2.0, 3.0, 1.0, 0.0])
+    assert list(track(envelope, None, 5, 1)) == [2]
+
+
+@pytest.mark.parametrize("threshold_mode", ["rolling", "robust"])
+def test_adaptive_modes_match_batch(recording, threshold_mode):
+    fs, samples = open_wav(recording.filename)
+    bank = TemplateBank(recording.call_filenames)
+    min_height = bank.scale_height(MIN_THRESHOLD)
+    detector = StreamingDetector(bank, height=3.0, rate=fs, threshold_mode=threshold_mode,
+                                 noise_seconds=NOISE_SECONDS, min_height=min_height)
+    detections = []
+    for start in range(0, len(samples), CHUNK):
+        detections.extend(detector.push(samples[start:start + CHUNK]))
+    detections.extend(detector.flush())
+
+    for index, corr in bank.iter_correlations(samples):
+        scores = local_scores(compute_envelope(corr, fs), fs, threshold_mode, NOISE_SECONDS, min_height=min_height)
+        expected = signal.find_peaks(scores, height=3.0, distance=bank.rates[index])[0]
+        found = sorted((sample, height) for i, sample, height in detections if i == index)
+        assert len(expected) > 0
+        assert [sample for sample, height in found] == list(expected)
+        np.testing.assert_allclose([height for sample, height in found], scores[expected], rtol=1e-9)
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from scipy import signal
+
+from template_bank import TemplateBank
+
+RATE = 44100
+
+
+@pytest.fixture(scope="module")
+def bank_calls():
+    # Calls of odd and even lengths, so both ways of centring mode="same" are covered
+    rng = np.random.RandomState(0)
+    return [(RATE, rng.randint(-20000, 20000, size=length).astype(np.int16)) for length in [1001, 2500, 64, 4097]]
+
+
+@pytest.fixture(scope="module")
+def audio():
+    rng = np.random.RandomState(1)
+    return rng.randint(-32768, 32767, size=(2, 30011)).astype(np.int16)
+
+
+def expected_correlation(samples, call):
+    return signal.fftconvolve(samples.astype(np.float64), call[::-1].astype(np.float64), mode="same")
+
+
+@pytest.mark.parametrize("precision, rtol", [("float64", 1e-10), ("float32", 2e-6)])
+@pytest.mark.parametrize("batch_size, indices", [(None, None), (1, None), (3, None), (None, [3, 0]), (1, [2]),
+                                                 (2, [1, 3, 2])])
+@pytest.mark.parametrize("channels", [False, True])
+def test_iter_correlations_matches_fftconvolve(bank_calls, audio, precision, rtol, batch_size, indices, channels):
+    template_bank = TemplateBank(["Call %d.wav" % i for i in range(len(bank_calls))], precision=precision,
+                                 calls=bank_calls)
+    samples = audio if channels else audio[0]
+
+    found = list(template_bank.iter_correlations(samples, batch_size=batch_size, indices=indices))
+    assert [i for i, corr in found] == (list(range(len(bank_calls))) if indices is None else indices)
+
+    for i, corr in found:
+        assert corr.shape == samples.shape
+        assert corr.dtype == np.dtype(precision)
+        for channel in range(len(audio)) if channels else [None]:
+            expected = expected_correlation(audio[channel] if channels else samples, bank_calls[i][1])
+            expected /= template_bank.scale ** 2
+            result = corr[channel] if channels else corr
+            # The FFT rounds every sample to within a tiny fraction of the largest one
+            np.testing.assert_allclose(result, expected, rtol=rtol, atol=rtol * np.abs(expected).max())
@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+from wavelet_detector import (LEVEL, RESOLUTION_SECONDS, SYM6, WAVELET, WaveletTemplateBank, packet_coefficients,
+                              read_decimated)
+
+# A little over BLOCK_SAMPLES columns, so that even the largest block size leaves a partial block at the end
+N_COLUMNS = 2**18 + 5000
+BLOCK_SIZES = [2**18, 3001, 997]
+# The full resolution shifts are only checked this far either side of where the masks start and stop overlapping the
+# input
+EDGE = 300
+
+
+def itau_loop(mask, spectrum, taus):
+    # The iTau loop of detectCallWavelet.m with indices from 0: the sum of the mask times the input where they overlap
+    call_length = mask.shape[1]
+    input_length = spectrum.shape[1]
+    outputs = []
+    for tau in taus:
+        mask_start = max(-tau, 0)
+        mask_end = min(call_length, input_length - tau)
+        if mask_start >= mask_end:
+            outputs.append(0.0)
+            continue
+        outputs.append((mask[:, mask_start:mask_end] * spectrum[:, tau + mask_start:tau + mask_end]).sum())
+    return np.array(outputs)
+
+
+@pytest.fixture(scope="module")
+def bank(recording):
+    return WaveletTemplateBank(recording.call_filenames)
+
+
+@pytest.fixture(scope="module")
+def input_spectrum(recording, bank):
+    fs, samples = read_decimated(recording.filename)
+    return bank.spectrum_of(samples[:N_COLUMNS])
+
+
+@pytest.fixture(scope="module")
+def reference(bank, input_spectrum):
+    # The direct loop is slow, so it is run once per step for every block size to be compared with
+    spectrum = input_spectrum.spectrum()
+    outputs = {}
+
+    def loop(index, step):
+        if (index, step) not in outputs:
+            length = int(bank.lengths[index])
+            outputs[index, step] = itau_loop(bank.masks[index], spectrum, range(-length, len(spectrum[0]) + 1, step))
+        return outputs[index, step]
+    return loop
+
+
+@pytest.mark.parametrize("block_size", BLOCK_SIZES)
+def test_iter_correlations_matches_itau_loop(bank, input_spectrum, reference, block_size):
+    # The step of detectCallWavelet.m and a step that does not divide the block sizes
+    for step in [int(RESOLUTION_SECONDS * bank.mask_rates[0]), 97]:
+        indices = range(len(bank)) if step > 100 else [0]
+        for index, output in bank.iter_correlations(input_spectrum, step=step, indices=indices, block_size=block_size):
+            expected = reference(index, step)
+            assert len(output) == len(expected)
+            np.testing.assert_allclose(output, expected, rtol=1e-9, atol=1e-12 * np.abs(expected).max())
+
+
+@pytest.mark.parametrize("block_size", BLOCK_SIZES)
+def test_partial_overlaps_at_every_shift(bank, input_spectrum, block_size):
+    spectrum = input_spectrum.spectrum()
+    for index, output in bank.iter_correlations(input_spectrum, block_size=block_size):
+        length = int(bank.lengths[index])
+        assert len(output) == N_COLUMNS + length + 1
+        # The shifts around where the mask starts and stops overlapping the input. Shift tau is output number
+        # tau + length
+        masked = np.flatnonzero(bank.masks[index].any(axis=0))
+        scale = np.abs(output).max()
+        for edge in [-int(masked[-1]), N_COLUMNS - int(masked[0])]:
+            taus = np.arange(max(edge - EDGE, -length), min(edge + EDGE, N_COLUMNS + 1))
+            expected = itau_loop(bank.masks[index], spectrum, taus)
+            np.testing.assert_allclose(output[taus + length], expected, rtol=1e-9, atol=1e-12 * scale)
+            assert expected.any() and not expected.all()
+
+
+@pytest.mark.parametrize("wavelet", [WAVELET, "db4"])
+def test_packet_coefficients_match_pywt(wavelet):
+    pywt = pytest.importorskip("pywt")
+    if wavelet == "sym6":
+        np.testing.assert_allclose(SYM6, pywt.Wavelet("sym6").dec_lo, rtol=1e-12)
+
+    rng = np.random.RandomState(0)
+    for n_samples in [1000, 1001, 4097]:
+        samples = rng.randn(n_samples)
+        packet = pywt.WaveletPacket(samples, wavelet, mode="symmetric", maxlevel=LEVEL)
+        expected = np.array([node.data for node in packet.get_level(LEVEL, order="freq")])
+        np.testing.assert_allclose(packet_coefficients(samples, LEVEL, wavelet), expected, rtol=1e-9, atol=1e-12)
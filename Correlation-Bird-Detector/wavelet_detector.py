@@ -0,0 +1,400 @@
+#!/usr/bin/python
+
+import argparse
+import datetime
+import os
+from glob import glob
+
+import numpy as np
+from scipy import fft as sp_fft
+from scipy import signal
+from scipy.io import wavfile
+
+from adaptive_threshold import DEFAULT_NOISE_SECONDS, THRESHOLD_MODES, make_sweep
+from instrumentation import DISABLED, Metrics
+from peak_io import format_timestamps, samples_to_datetime64, to_datetime64
+from template_bank import TemplateBank
+
+# The settings of Wavelet-Birdcall-Detector/detectCallWavelet.m. Bird calls are within 50Hz - 12kHz, so the audio is
+# decimated before the level 4 sym6 wavelet packet transform
+COMPRESS_FACTOR = 2
+LEVEL = 4
+WAVELET = "sym6"
+# A call's mask is every cell of its spectrum more than MASK_STDS standard deviations above the spectrum's mean
+MASK_STDS = 5
+# The mask is slid along the input RESOLUTION_SECONDS at a time
+RESOLUTION_SECONDS = 0.05
+# Peaks of the detector output must be at least MIN_PEAK_SECONDS apart
+MIN_PEAK_SECONDS = 1.0
+THRESHOLDS = np.arange(0, 20.5, 0.5)
+OUTPUT_DIRECTORY = "Detected Peaks"
+DEFAULT_START = datetime.datetime(year=2000, month=1, day=1)
+# The input spectrum is correlated with the masks this many columns at a time, which bounds the memory of long inputs
+BLOCK_SAMPLES = 2**18
+
+# The sym6 decomposition low-pass filter, as MATLAB's wfilters("sym6") gives it. Other wavelets need PyWavelets
+SYM6 = np.array([-0.007800708325034148, 0.0017677118642428036, 0.04472490177066578, -0.021060292512300564,
+                 -0.07263752278646252, 0.3379294217276218, 0.787641141030194, 0.4910559419267466,
+                 -0.048311742585633, -0.11799011114819057, 0.0034907120842174702, 0.015404109327027373])
+
+
+def wavelet_filters(wavelet=WAVELET):
+    """
+    @param wavelet: The name of an orthogonal wavelet
+    @return: The decomposition low-pass and high-pass filters of the wavelet
+    """
+    if wavelet == "sym6":
+        low_pass = SYM6
+    else:
+        import pywt
+
+        low_pass = np.array(pywt.Wavelet(wavelet).dec_lo)
+    # The quadrature mirror of the low-pass filter
+    high_pass = low_pass[::-1] * (-1) ** np.arange(len(low_pass))
+    return low_pass, high_pass
+
+
+def dwt(samples, low_pass, high_pass):
+    """
+    One level of the discrete wavelet transform with MATLAB's default symmetric extension, as dwt() computes it.
+
+    @param samples: The signal to transform
+    @param low_pass: The decomposition low-pass filter
+    @param high_pass: The decomposition high-pass filter
+    @return: The approximation and detail coefficients, each floor((len(samples) + len(filter) - 1) / 2) long
+    """
+    extended = np.pad(samples, len(low_pass) - 1, mode="symmetric")
+    approximation = np.convolve(extended, low_pass, mode="valid")[1::2]
+    detail = np.convolve(extended, high_pass, mode="valid")[1::2]
+    return approximation, detail
+
+
+def packet_coefficients(samples, level=LEVEL, wavelet=WAVELET):
+    """
+    @param samples: The signal to decompose
+    @param level: The depth of the wavelet packet tree
+    @param wavelet: The name of the wavelet
+    @return: A (2**level, coefficients) array of the terminal nodes of the tree, from the lowest frequency band to
+    the highest
+    """
+    low_pass, high_pass = wavelet_filters(wavelet)
+
+    # Each node is kept with whether its band is mirrored. Downsampling the high-pass output flips its spectrum, so the
+    # children of a mirrored node swap places to keep the nodes in frequency order (the Gray code order)
+    nodes = [(np.asarray(samples, dtype=np.float64), False)]
+    for depth in range(level):
+        children = []
+        for coefficients, mirrored in nodes:
+            approximation, detail = dwt(coefficients, low_pass, high_pass)
+            if mirrored:
+                children.extend([(detail, False), (approximation, True)])
+            else:
+                children.extend([(approximation, False), (detail, True)])
+        nodes = children
+
+    return np.array([coefficients for coefficients, mirrored in nodes])
+
+
+class PacketSpectrum:
+    """
+    The wavelet packet spectrum of a signal as MATLAB's wpspectrum computes it: a row for every terminal node in
+    frequency order, holding the energy of each coefficient repeated 2**level times and cropped about the centre to
+    the length of the signal.
+
+    Only the energies of the coefficients are kept and columns are expanded when asked for, so a long input is never
+    held as a (bands, samples) array.
+    """
+
+    def __init__(self, samples, level=LEVEL, wavelet=WAVELET):
+        """
+        @param samples: The signal to decompose
+        @param level: The depth of the wavelet packet tree
+        @param wavelet: The name of the wavelet
+        """
+        self.level = level
+        self.length = len(samples)
+        self.energies = packet_coefficients(samples, level, wavelet) ** 2
+        # wkeep1 keeps the middle of the repeated coefficients
+        self.offset = (self.energies.shape[1] * 2**level - self.length) // 2
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def n_bands(self):
+        return len(self.energies)
+
+    def columns(self, start, stop):
+        """
+        @param start: The first column
+        @param stop: The column after the last
+        @return: A (bands, stop - start) array of the spectrum. Columns outside the signal are zero
+        """
+        columns = np.zeros((self.n_bands, stop - start), dtype=np.float64)
+        first = max(start, 0)
+        last = min(stop, self.length)
+        if first < last:
+            columns[:, first - start:last - start] = self.energies[:, (np.arange(first, last) + self.offset) >> self.level]
+        return columns
+
+    def spectrum(self):
+        """
+        @return: The whole (bands, samples) spectrum
+        """
+        return self.columns(0, self.length)
+
+
+def call_mask(spectrum, n_stds=MASK_STDS):
+    """
+    @param spectrum: The (bands, samples) wavelet packet spectrum of a call
+    @param n_stds: How many standard deviations above its mean a cell of the spectrum must be to be in the mask
+    @return: The binary mask of the call as floats
+    """
+    threshold = spectrum.mean() + n_stds * spectrum.std(ddof=1)
+    return (spectrum > threshold).astype(np.float64)
+
+
+def read_decimated(filename, compress_factor=COMPRESS_FACTOR):
+    """
+    @param filename: The path of a wav file
+    @return: The sampling rate after decimation and the decimated first channel
+    """
+    fs, samples = wavfile.read(filename, mmap=True)
+    if samples.ndim > 1:
+        samples = samples[:, 0]
+    # The same order 8 Chebyshev filter run forwards and backwards as MATLAB's decimate
+    return fs // compress_factor, signal.decimate(np.asarray(samples, dtype=np.float64), compress_factor)
+
+
+class WaveletTemplateBank(TemplateBank):
+    """
+    A TemplateBank of the binary wavelet packet masks of the calls rather than their samples. The real FFTs of the
+    reversed masks are cached per FFT size in the same way, so each block of the input spectrum is transformed once and
+    every mask is multiplied with it, summed over the bands and inverse transformed together.
+    """
+
+    def __init__(self, filenames, level=LEVEL, wavelet=WAVELET, compress_factor=COMPRESS_FACTOR, n_stds=MASK_STDS):
+        """
+        @param filenames: The paths of the known bird calls
+        @param level: The depth of the wavelet packet tree
+        @param wavelet: The name of the wavelet
+        @param compress_factor: How much the calls and the inputs are decimated by
+        @param n_stds: How many standard deviations above its mean a cell of a call's spectrum must be to be masked
+        """
+        TemplateBank.__init__(self, filenames)
+        self.level = level
+        self.wavelet = wavelet
+        self.compress_factor = compress_factor
+
+        self.mask_rates = [fs // compress_factor for fs in self.rates]
+        self.masks = []
+        for call in self.calls:
+            decimated = signal.decimate(np.asarray(call, dtype=np.float64), compress_factor)
+            self.masks.append(call_mask(PacketSpectrum(decimated, level, wavelet).spectrum(), n_stds))
+        # The masks are as long as the decimated calls, so FFT sizes are worked out from them
+        self.lengths = np.array([mask.shape[1] for mask in self.masks], dtype=np.int64)
+
+    @classmethod
+    def from_directory(cls, directory="Test Bird Calls"):
+        return cls(glob(directory + "/*"))
+
+    def spectrum_of(self, samples):
+        """
+        @param samples: The decimated input signal
+        @return: The PacketSpectrum of the input, decomposed in the same way as the calls
+        """
+        return PacketSpectrum(samples, self.level, self.wavelet)
+
+    def spectra(self, nfft):
+        """
+        @param nfft: The FFT size
+        @return: A (templates, bands, nfft // 2 + 1) array of the real FFTs of the reversed, zero-padded masks
+        """
+        if nfft not in self._spectra:
+            spectra = np.empty((len(self.masks), 2**self.level, nfft // 2 + 1), dtype=np.complex128)
+            for i, mask in enumerate(self.masks):
+                spectra[i] = sp_fft.rfft(mask[:, ::-1], nfft, axis=-1)
+            self._spectra[nfft] = spectra
+        return self._spectra[nfft]
+
+    def iter_correlations(self, input_spectrum, step=1, indices=None, block_size=BLOCK_SAMPLES):
+        """
+        Slides every mask over the input spectrum, as the iTau loop of detectCallWavelet.m does. The output at shift
+        tau is the sum of the mask times the spectrum where they overlap, for tau = -len(mask), -len(mask) + step, ...
+        up to len(input_spectrum), so the shifts where the call only partly overlaps the input are included.
+
+        All the shifts of a block are the correlation of the mask with the block along time, summed over the bands.
+        The blocks are added together where they overlap and only every step-th shift is kept.
+
+        @param input_spectrum: The PacketSpectrum of the decimated input
+        @param step: The number of samples between shifts
+        @param indices: The indices of the masks to slide. All of them by default
+        @param block_size: How many columns of the input spectrum to correlate at once
+        @return: A generator of (template index, detector output) pairs in bank order
+        """
+        if indices is None:
+            indices = range(len(self.masks))
+        indices = list(indices)
+
+        n_samples = len(input_spectrum)
+        block_size = int(min(block_size, n_samples))
+        nfft = self.fft_size(block_size)
+        spectra = self.spectra(nfft)[indices]
+        lengths = self.lengths[indices]
+        outputs = [np.zeros((n_samples + length) // step + 1, dtype=np.float64) for length in lengths]
+
+        for start in range(0, n_samples, block_size):
+            columns = input_spectrum.columns(start, min(start + block_size, n_samples))
+            block_spectrum = sp_fft.rfft(columns, nfft, axis=-1)
+            correlations = sp_fft.irfft(np.einsum("tbf,bf->tf", spectra, block_spectrum), nfft, axis=-1)
+
+            for row, length in enumerate(lengths):
+                # Lag k of the block's full correlation is the shift tau = start - length + 1 + k, whose output is
+                # number (tau + length) / step
+                first = (-start - 1) % step
+                lags = np.arange(first, columns.shape[1] + length - 1, step)
+                outputs[row][(start + 1 + lags) // step] += correlations[row, lags]
+
+        for row, i in enumerate(indices):
+            yield i, outputs[row]
+
+    def correlate(self, input_spectrum, step=1):
+        """
+        @param input_spectrum: The PacketSpectrum of the decimated input
+        @param step: The number of samples between shifts
+        @return: A list of the detector output of every mask
+        """
+        return [output for i, output in self.iter_correlations(input_spectrum, step)]
+
+    def output_samples(self, index, n_outputs, step):
+        """
+        @param index: The index of the mask
+        @param n_outputs: The length of its detector output
+        @param step: The number of samples between shifts
+        @return: The decimated sample at the centre of the call for every output, clipped to the start of the input
+        """
+        centres = -self.lengths[index] / 2.0 + np.arange(n_outputs) * step
+        return np.maximum(centres, 0)
+
+
+def detect_wavelet_peaks(template_bank, inputSignal, rate, start_dt=DEFAULT_START, thresholds=THRESHOLDS,
+                         resolution_seconds=RESOLUTION_SECONDS, threshold_mode="global",
+                         noise_seconds=DEFAULT_NOISE_SECONDS, block_size=BLOCK_SAMPLES, metrics=DISABLED):
+    """
+    @param template_bank: The WaveletTemplateBank of the calls
+    @param inputSignal: The decimated audio samples to search through
+    @param rate: The sampling rate of the decimated input
+    @param start_dt: The time of the first sample of the input
+    @param thresholds: The thresholds in standard deviations of the detector output, measured from zero as
+    detectCallWavelet.m does, or of its local noise floor
+    @param resolution_seconds: How far the masks are moved along the input at a time
+    @param threshold_mode: One of adaptive_threshold.THRESHOLD_MODES
+    @param noise_seconds: How long the noise floor of the adaptive modes is measured over
+    @param block_size: How many columns of the input spectrum to correlate at once
+    @param metrics: The instrumentation.Metrics the time of each step is reported to
+    @return: A dictionary of the detection timestamps at each threshold for every bird
+    """
+    for fs in template_bank.mask_rates:
+        if fs != rate:
+            raise ValueError("Frequencies do not match: the calls are at %d Hz and the input is at %d Hz" % (fs, rate))
+
+    step = int(resolution_seconds * rate)
+    output_rate = rate / float(step)
+
+    with metrics.span("correlate", samples=len(inputSignal)):
+        input_spectrum = template_bank.spectrum_of(inputSignal)
+        outputs = list(template_bank.iter_correlations(input_spectrum, step, block_size=block_size))
+
+    detections = {}
+    for index, output in outputs:
+        bird_name = template_bank.names[index]
+
+        with metrics.span("peak-find", species=bird_name, samples=len(output)):
+            sweep = make_sweep(output, MIN_PEAK_SECONDS * output_rate, output_rate, threshold_mode, noise_seconds)
+            counts = sweep.sweep(thresholds, relative_to_mean=False)
+
+        with metrics.span("serialize", species=bird_name):
+            samples = template_bank.output_samples(index, len(output), step)[sweep.peaks[:counts.max(initial=0)]]
+            timestamps = samples_to_datetime64(samples, rate, start_dt)
+            detections[bird_name] = [(threshold, np.sort(timestamps[:count])) for threshold, count in zip(thresholds,
+                                                                                                           counts)]
+
+    return detections
+
+
+def save_wavelet_peaks(detections, run_directory, start_dt=DEFAULT_START):
+    """
+    Writes the detections in the layout of detectCallWavelet.m: <run directory>/<bird>/<threshold>.csv, each starting
+    with the reference time of the first sample followed by one timestamp per line to the millisecond.
+
+    @param detections: A dictionary of the detection timestamps at each threshold for every bird
+    @param run_directory: The folder to write the run to
+    @param start_dt: The time of the first sample of the input
+    """
+    reference = format_timestamps([to_datetime64(start_dt)], unit="ms")
+
+    for bird_name, tests in detections.items():
+        bird_directory = run_directory + "/" + bird_name
+        if not os.path.isdir(bird_directory):
+            os.makedirs(bird_directory)
+
+        for threshold, timestamps in tests:
+            # num2str names the files 0, 0.5, 1, ...
+            with open(bird_directory + "/" + "%g" % threshold + ".csv", "w") as csv_file:
+                for timestamp in np.concatenate((reference, format_timestamps(timestamps, unit="ms"))):
+                    csv_file.write(timestamp + "\n")
+
+
+def run_name_for(input_filename, run_name=None):
+    """
+    @param input_filename: The path of the input signal, named after its SNR e.g. "Input Signals/10.wav"
+    @param run_name: The name shared by every input of the run. The current time as MATLAB writes it if None
+    @return: The name of the run's output for that input
+    """
+    snr = os.path.basename(input_filename).split(".wav")[0]
+    try:
+        snr = "%0.2f" % float(snr)
+    except ValueError:
+        pass
+    if run_name is None:
+        run_name = datetime.datetime.now().strftime("%d-%b-%Y %H:%M:%S")
+    return "Wavelet " + snr + "dB " + run_name
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Detects bird calls by sliding wavelet packet masks of the calls "
+                                                 "over the wavelet packet spectrum of each input")
+    parser.add_argument("inputs", nargs="*", help="The input signals. The first of \"Input Signals\" by default")
+    parser.add_argument("--calls", default="Test Bird Calls/*", help="A glob of the known bird calls")
+    parser.add_argument("--output", default=OUTPUT_DIRECTORY, help="The folder to write the runs to")
+    parser.add_argument("--run-name", default=None, help="Replaces the current time in the names of the runs")
+    parser.add_argument("--start", default=DEFAULT_START.isoformat(),
+                        help="The time of the first sample of every input, in ISO format")
+    parser.add_argument("--resolution", type=float, default=RESOLUTION_SECONDS,
+                        help="How far the masks are moved along the input at a time in seconds")
+    parser.add_argument("--threshold-mode", choices=THRESHOLD_MODES, default="global",
+                        help="Measure the thresholds against the whole detector output or a rolling noise floor")
+    parser.add_argument("--noise-seconds", type=float, default=DEFAULT_NOISE_SECONDS,
+                        help="How long the rolling noise floor is measured over")
+    parser.add_argument("--block-size", type=int, default=BLOCK_SAMPLES,
+                        help="How many spectrum columns to correlate at once. Lower it to use less memory")
+    parser.add_argument("--timings", action="store_true", help="Print the time every step takes")
+    args = parser.parse_args()
+
+    input_filenames = args.inputs or sorted(glob("Input Signals/*.wav"))[:1]
+    start = datetime.datetime.strptime(args.start, "%Y-%m-%dT%H:%M:%S")
+    metrics = Metrics(echo=args.timings)
+    template_bank = WaveletTemplateBank(sorted(glob(args.calls)))
+
+    for input_filename in input_filenames:
+        rate, inputSignal = read_decimated(input_filename, template_bank.compress_factor)
+        detections = detect_wavelet_peaks(template_bank, inputSignal, rate, start_dt=start,
+                                          resolution_seconds=args.resolution, threshold_mode=args.threshold_mode,
+                                          noise_seconds=args.noise_seconds, block_size=args.block_size,
+                                          metrics=metrics)
+        run_directory = args.output + "/" + run_name_for(input_filename, args.run_name)
+        if args.threshold_mode != "global":
+            run_directory = run_directory + " " + args.threshold_mode
+        save_wavelet_peaks(detections, run_directory, start)
+        print("Saved " + run_directory)
+    print("finished it!")